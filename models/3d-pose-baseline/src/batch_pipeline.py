@@ -0,0 +1,159 @@
+"""Streaming input pipeline that feeds batches to the linear model"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import threading
+import numpy as np
+from six.moves import queue
+from six.moves import xrange  # pylint: disable=redefined-builtin
+
+def stack_data( data_x, data_y, camera_frame, dtype=np.float32 ):
+  """
+  Stack the 2d inputs and their matching 3d outputs of every sequence into two
+  big arrays. This only needs to happen once per dataset, not once per epoch.
+
+  Args
+    data_x: dictionary with 2d inputs
+    data_y: dictionary with 3d expected outputs
+    camera_frame: whether the 3d data is in camera coordinates
+    dtype: data type of the stacked arrays
+  Returns
+    encoder_inputs: nx(2d dims) array with all the 2d inputs
+    decoder_outputs: nx(3d dims) array with the matching 3d outputs
+  """
+  def get_key3d( key2d ):
+    (subj, b, fname) = key2d
+    # keys should be the same if 3d is in camera coordinates
+    key3d = key2d if (camera_frame) else (subj, b, '{0}.h5'.format(fname.split('.')[0]))
+    key3d = (subj, b, fname[:-3]) if fname.endswith('-sh') and camera_frame else key3d
+    return key3d
+
+  keys2d = list( data_x.keys() )
+  n = sum( data_x[ key2d ].shape[0] for key2d in keys2d )
+
+  encoder_inputs  = np.zeros((n, data_x[ keys2d[0] ].shape[1]), dtype=dtype)
+  decoder_outputs = np.zeros((n, data_y[ get_key3d(keys2d[0]) ].shape[1]), dtype=dtype)
+
+  # Put all the data into big arrays
+  idx = 0
+  for key2d in keys2d:
+    n2d, _ = data_x[ key2d ].shape
+    encoder_inputs[idx:idx+n2d, :]  = data_x[ key2d ]
+    decoder_outputs[idx:idx+n2d, :] = data_y[ get_key3d(key2d) ]
+    idx = idx + n2d
+
+  return encoder_inputs, decoder_outputs
+
+
+class PrefetchingBatchIterator(object):
+  """
+  Iterates over the batches of one epoch. Only an index array is shuffled;
+  each batch is gathered from the stacked arrays when it is needed, on a
+  background thread that keeps the next `prefetch` batches ready while the
+  model runs on the current one. Examples that do not fill a whole batch are
+  dropped, as in LinearModel.get_all_batches.
+
+  With num_shards > 1 the iterator only visits the batches of one shard (every
+  num_shards-th batch, starting at shard_index), for data-parallel training.
+  Shards of the same epoch must share the seed, so that they agree on the order.
+  """
+
+  def __init__( self, encoder_inputs, decoder_outputs, batch_size, shuffle=True, prefetch=2,
+                seed=None, num_shards=1, shard_index=0 ):
+    """
+    Args
+      encoder_inputs: nx(2d dims) array with the stacked 2d inputs
+      decoder_outputs: nx(3d dims) array with the stacked 3d outputs
+      batch_size: integer. Number of examples in each batch
+      shuffle: whether to visit the examples in a random order
+      prefetch: integer. Number of batches to prepare ahead of time
+      seed: (Optional) integer. Seed of the shuffle
+      num_shards: integer. Number of shards the batches are split into
+      shard_index: integer. Shard visited by this iterator
+    """
+    assert encoder_inputs.shape[0] == decoder_outputs.shape[0]
+    n = encoder_inputs.shape[0]
+
+    self.encoder_inputs  = encoder_inputs
+    self.decoder_outputs = decoder_outputs
+    self.batch_size = batch_size
+    # Every shard gets the same number of batches; the leftover ones are dropped
+    self.nbatches   = (n // batch_size) // num_shards
+    self.shuffle    = shuffle
+    self.order      = None
+    if shuffle:
+      self.order = np.random.permutation( n ) if seed is None else np.random.RandomState( seed ).permutation( n )
+    self.num_shards  = num_shards
+    self.shard_index = shard_index
+    self.prefetch   = prefetch
+
+    self._queue  = None
+    self._thread = None
+    self._stop   = threading.Event()
+
+  def __len__( self ):
+    return self.nbatches
+
+  def get_batch( self, i ):
+    """Gather the i-th batch of the epoch (of this shard)"""
+    i = i * self.num_shards + self.shard_index
+    start, end = i * self.batch_size, (i+1) * self.batch_size
+    if not self.shuffle:
+      return self.encoder_inputs[start:end], self.decoder_outputs[start:end]
+    idx = self.order[start:end]
+    return np.take( self.encoder_inputs, idx, axis=0 ), np.take( self.decoder_outputs, idx, axis=0 )
+
+  def _produce( self ):
+    try:
+      for i in xrange( self.nbatches ):
+        batch = self.get_batch( i )
+        while not self._put( batch ):
+          if self._stop.is_set():
+            return
+      self._put( None, block=True )
+    except Exception as e: # pylint: disable=broad-except
+      self._put( e, block=True )
+
+  def _put( self, item, block=False ):
+    try:
+      self._queue.put( item, timeout=None if block else 0.1 )
+      return True
+    except queue.Full:
+      return False
+
+  def __iter__( self ):
+    if self.prefetch <= 0:
+      for i in xrange( self.nbatches ):
+        yield self.get_batch( i )
+      return
+
+    self._queue  = queue.Queue( maxsize=self.prefetch )
+    self._stop.clear()
+    self._thread = threading.Thread( target=self._produce )
+    self._thread.daemon = True
+    self._thread.start()
+    try:
+      while True:
+        item = self._queue.get()
+        if item is None:
+          break
+        if isinstance( item, Exception ):
+          raise item
+        yield item
+    finally:
+      self.close()
+
+  def close( self ):
+    """Stop the background thread, e.g. when the epoch is abandoned early"""
+    self._stop.set()
+    if self._thread is not None:
+      # Unblock the producer if it is waiting on a full queue
+      while self._thread.is_alive():
+        try:
+          self._queue.get_nowait()
+        except queue.Empty:
+          pass
+        self._thread.join( 0.1 )
+      self._thread = None
@@ -3,6 +3,7 @@
 
 from __future__ import division
 
+import math
 import h5py
 import numpy as np
 import matplotlib.pyplot as plt
@@ -30,27 +31,75 @@ def project_point_radial( P, R, T, f, c, k, p ):
     tan: 1xN tangential distortion per point
     r2: 1xN squared radius of the projected points before distortion
   """
+  cams = stack_cameras( [(R, T, f, c, k, p)] )
+  Proj, D, radial, tan, r2 = project_point_radial_multi( P, cams )
+
+  return Proj[0], D[0], radial[0], tan[0], r2[0]
+
+def stack_cameras( cams ):
+  """
+  Stack the parameters of several cameras, so that points can be projected
+  into all of them at once with project_point_radial_multi
+
+  Args
+    cams: list of camera parameter tuples (R, T, f, c, k, p[, name]), e.g.
+      [rcams[(subj, c+1)] for c in range(4)]
+  Returns
+    stacked: tuple (R, RT, f, c, k, p) of arrays with a leading camera axis.
+      RT is R.dot(T), the translation in camera space
+  """
+  R = np.stack( [cam[0] for cam in cams] )        # Cx3x3
+  T = np.stack( [cam[1] for cam in cams] )        # Cx3x1
+  f = np.stack( [cam[2] for cam in cams] )        # Cx2x1
+  c = np.stack( [cam[3] for cam in cams] )        # Cx2x1
+  k = np.stack( [cam[4] for cam in cams] )[:,:,0] # Cx3
+  p = np.stack( [cam[5] for cam in cams] )[:,:,0] # Cx2
+
+  return R, np.matmul( R, T ), f, c, k, p
+
+def project_point_radial_multi( P, cams, out=None ):
+  """
+  Project the same points from 3d to 2d into several cameras at once,
+  including radial and tangential distortion
+
+  Args
+    P: Nx3 points in world coordinates
+    cams: stacked camera parameters of C cameras, from stack_cameras
+    out: optional CxNx2 buffer for the projected points
+  Returns
+    Proj: CxNx2 points in pixel space
+    D: CxN depth of each point in camera space
+    radial: CxN radial distortion per point
+    tan: CxN tangential distortion per point
+    r2: CxN squared radius of the projected points before distortion
+  """
 
   # P is a matrix of 3-dimensional points
   assert len(P.shape) == 2
   assert P.shape[1] == 3
 
-  N = P.shape[0]
-  X = R.dot( P.T - T ) # rotate and translate
-  XX = X[:2,:] / X[2,:]
-  r2 = XX[0,:]**2 + XX[1,:]**2
+  R, RT, f, c, k, p = cams
+  C, N = R.shape[0], P.shape[0]
 
-  radial = 1 + np.einsum( 'ij,ij->j', np.tile(k,(1, N)), np.array([r2, r2**2, r2**3]) );
-  tan = p[0]*XX[1,:] + p[1]*XX[0,:]
+  X = np.matmul( R, P.T ) - RT # rotate and translate, Cx3xN
+  XX = X[:,:2,:] / X[:,2:,:]
+  r2 = XX[:,0,:]**2 + XX[:,1,:]**2
 
-  XXX = XX * np.tile(radial+tan,(2,1)) + np.outer(np.array([p[1], p[0]]).reshape(-1), r2 )
+  radial = 1 + r2*(k[:,0:1] + r2*(k[:,1:2] + r2*k[:,2:3]))
+  tan = p[:,0:1]*XX[:,1,:] + p[:,1:2]*XX[:,0,:]
 
-  Proj = (f * XXX) + c
-  Proj = Proj.T
+  # Distort in place; XX is no longer needed undistorted
+  XX *= (radial+tan)[:,None,:]
+  XX += p[:,::-1,None] * r2[:,None,:]
 
-  D = X[2,]
+  if out is None:
+    out = np.empty( (C, N, 2), dtype=XX.dtype )
+  assert out.shape == (C, N, 2)
+  np.transpose( out, (0,2,1) )[:] = f*XX + c
 
-  return Proj, D, radial, tan, r2
+  D = X[:,2,:]
+
+  return out, D, radial, tan, r2
 
 def world_to_camera_frame(P, R, T):
   """
@@ -126,7 +175,7 @@ def load_cameras( bpath='cameras.h5', subjects=[1,5,6,7,8,9,11] ):
     bpath: path to hdf5 file with h36m camera data
     subjects: List of ints representing the subject IDs for which cameras are requested
   Returns
-    rcams: dictionary of 4 tuples per subject ID containing its camera parameters for the 4 h36m cams
+    rcams: CameraRegistry (a dictionary) of 4 tuples per subject ID containing its camera parameters for the 4 h36m cams
   """
   rcams = {}
 
@@ -135,4 +184,122 @@ def load_cameras( bpath='cameras.h5', subjects=[1,5,6,7,8,9,11] ):
       for c in range(4): # There are 4 cameras in human3.6m
         rcams[(s, c+1)] = load_camera_params(hf, 'subject%d/camera%d/{0}' % (s,c+1) )
 
-  return rcams
+  return CameraRegistry( rcams )
+
+def is_rotation_matrix( R ):
+  """Checks if a matrix is a valid rotation matrix"""
+  Rt = np.transpose(R)
+  shouldBeIdentity = np.dot(Rt, R)
+  I = np.identity(3, dtype = R.dtype)
+  n = np.linalg.norm(I - shouldBeIdentity)
+  return n < 1e-6
+
+def rotation_matrix_to_euler_angles( R ):
+  """
+  Calculates rotation matrix to euler angles
+  The result is the same as MATLAB except the order
+  of the euler angles ( x and z are swapped ).
+  """
+  assert(is_rotation_matrix(R))
+  sy = math.sqrt(R[0,0] * R[0,0] +  R[1,0] * R[1,0])
+  singular = sy < 1e-6
+  if  not singular :
+    x = math.atan2(R[2,1] , R[2,2])
+    y = math.atan2(-R[2,0], sy)
+    z = math.atan2(R[1,0], R[0,0])
+  else :
+    x = math.atan2(-R[1,2], R[1,1])
+    y = math.atan2(-R[2,0], sy)
+    z = 0
+  return np.array([x, y, z])
+
+def euler_angles_to_rotation_matrix( theta ):
+  """Calculates Rotation Matrix given euler angles"""
+  R_x = np.array([[1,         0,                  0                   ],
+                  [0,         math.cos(theta[0]), -math.sin(theta[0]) ],
+                  [0,         math.sin(theta[0]), math.cos(theta[0])  ]
+                  ])
+  R_y = np.array([[math.cos(theta[1]),    0,      math.sin(theta[1])  ],
+                  [0,                     1,      0                   ],
+                  [-math.sin(theta[1]),   0,      math.cos(theta[1])  ]
+                  ])
+  R_z = np.array([[math.cos(theta[2]),    -math.sin(theta[2]),    0],
+                  [math.sin(theta[2]),    math.cos(theta[2]),     0],
+                  [0,                     0,                      1]
+                  ])
+  R = np.dot(R_z, np.dot( R_y, R_x ))
+  return R
+
+def no_tilt_rotation( R ):
+  """
+  The rotation R with its x and y euler angles set to zero, i.e. a camera
+  that only turns around the vertical axis
+  """
+  theta = rotation_matrix_to_euler_angles(R)
+  theta[0] = 0
+  theta[1] = 0
+  return euler_angles_to_rotation_matrix(theta)
+
+class CameraRegistry(dict):
+  """
+  The cameras of h36m, as returned by load_cameras. This is the usual
+  dictionary of (subject, camera) -> (R, T, f, c, k, p, name), which also
+  keeps the no-tilt rotation of every camera and the stacked parameters of the
+  cameras of every subject, computed once, for batched transforms.
+  """
+
+  def __init__( self, rcams ):
+    """
+    Args
+      rcams: dictionary of (subject, camera) -> camera parameters
+    """
+    super(CameraRegistry, self).__init__( rcams )
+    self.no_tilt = {key: no_tilt_rotation( cam[0] ) for key, cam in self.items()}
+    self._stacked = {}
+
+  def rotation( self, key, experimental=False ):
+    """Rotation of a camera, without tilt if experimental"""
+    return self.no_tilt[ key ] if experimental else self[ key ][0]
+
+  def stacked( self, subj, ncams=4, experimental=False ):
+    """
+    Parameters of the first ncams cameras of a subject, stacked as in
+    stack_cameras. If experimental, the no-tilt rotations are used
+    """
+    skey = (subj, ncams, experimental)
+    if skey not in self._stacked:
+      cams = [(self.rotation( (subj, c+1), experimental ),) + tuple( self[ (subj, c+1) ][1:] ) for c in range( ncams )]
+      self._stacked[ skey ] = stack_cameras( cams )
+    return self._stacked[ skey ]
+
+  def world_to_camera( self, P, subj, ncams=4, experimental=False ):
+    """
+    Convert points from world coordinates to the coordinates of every camera
+    of a subject at once
+
+    Args
+      P: Nx3 3d points in world coordinates
+      subj: integer. Subject whose cameras are used
+      ncams: integer. Number of cameras of the subject
+      experimental: whether to use the no-tilt rotations
+    Returns
+      X_cam: ncamsxNx3 3d points in the coordinates of every camera
+    """
+    assert len(P.shape) == 2
+    assert P.shape[1] == 3
+
+    R, RT = self.stacked( subj, ncams, experimental )[:2]
+    return np.matmul( P, np.transpose( R, (0,2,1) )) - np.transpose( RT, (0,2,1) )
+
+  def camera_to_world( self, P, key, experimental=False ):
+    """
+    Inverse of world_to_camera for a single camera
+
+    Args
+      P: Nx3 points in camera coordinates
+      key: (subject, camera) of the camera
+      experimental: whether the no-tilt rotation was used
+    Returns
+      X_world: Nx3 points in world coordinates
+    """
+    return camera_to_world_frame( P, self.rotation( key, experimental ), self[ key ][1] )
@@ -0,0 +1,339 @@
+"""Synchronous data-parallel training of the linear model on one machine
+
+N processes each hold a full replica of the model. Every batch is split into N
+equal sub-batches; in every step each replica runs forward and backward on its
+own sub-batch, the gradients of all the replicas are averaged (which, with equal
+sub-batches, is the gradient of the whole batch), and every replica applies the same averaged gradients with its own
+optimizer. Since the replicas start from the same variables and apply the same
+updates, they stay identical, and any of them can be checkpointed.
+
+Gradients are exchanged through shared memory, with no network involved:
+every replica writes its gradients to its own slot of a shared buffer, each
+one then averages one contiguous chunk of all the slots, and finally every
+replica reads the whole averaged vector. Each process thus moves about
+3x the size of the model per step, however many replicas there are. The
+buffers are double-buffered on the parity of the step, so two barriers per
+step are enough to keep the replicas in lockstep.
+
+The moving statistics of batch normalization are averaged along with the
+gradients, so that they are an average over the sub-batches of all the replicas.
+
+Each step consumes one batch of batch_size examples in total, so an epoch has
+as many steps, and the learning rate decays on the same schedule, as with a
+single process. The one difference is batch normalization, which normalizes
+every sub-batch with its own statistics, as if training with a batch of
+batch_size / num_workers; the trained model is thus close to, but not the
+same as, that of a single process.
+
+Replica 0 runs in the calling process (it evaluates the model and writes
+checkpoints and summaries); the other ones are forked by start(), which must
+happen before any session is created.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import contextlib
+import time
+import shutil
+import tempfile
+import multiprocessing
+import numpy as np
+from six.moves import xrange  # pylint: disable=redefined-builtin
+import tensorflow as tf
+
+import batch_pipeline
+
+# How long to wait on a barrier before checking whether another replica died
+BARRIER_POLL_SECONDS = 1.0
+
+
+class SharedBarrier(object):
+  """A reusable barrier between processes (multiprocessing.Barrier is python 3 only)"""
+
+  def __init__( self, parties, abort ):
+    """
+    Args
+      parties: integer. Number of processes that wait on the barrier
+      abort: shared multiprocessing.Value, set when a process fails
+    """
+    self.parties    = parties
+    self.abort      = abort
+    self.count      = multiprocessing.RawValue( 'i', 0 )
+    self.generation = multiprocessing.RawValue( 'i', 0 )
+    self.condition  = multiprocessing.Condition()
+
+  def wait( self ):
+    with self.condition:
+      generation = self.generation.value
+      self.count.value += 1
+      if self.count.value == self.parties:
+        self.count.value = 0
+        self.generation.value += 1
+        self.condition.notify_all()
+        return
+
+      while generation == self.generation.value:
+        if self.abort.value:
+          raise RuntimeError( "Another data-parallel worker failed" )
+        self.condition.wait( BARRIER_POLL_SECONDS )
+
+
+class DataParallelTrainer(object):
+  """ Trains replicas of the linear model in num_workers processes """
+
+  def __init__( self, num_workers, build_model, encoder_inputs, decoder_outputs, batch_size,
+                dropout_keep_prob, session_config=None, seed=None ):
+    """
+    Args
+      num_workers: integer. Number of replicas, including the calling process
+      build_model: function that creates a LinearModel in the default graph,
+        called as build_model( batch_size, summaries=False ) by the forked
+        replicas, which must not write summaries
+      encoder_inputs: nx(2d dims) array with the stacked 2d training inputs
+      decoder_outputs: nx(3d dims) array with the stacked 3d training outputs
+      batch_size: integer. Number of examples in each step, over all the
+        replicas. Must be a multiple of num_workers
+      dropout_keep_prob: (0,1] dropout keep probability
+      session_config: (Optional) tf.ConfigProto of the sessions of the forked replicas
+      seed: (Optional) integer. Seed of the per-epoch shuffles
+    """
+    assert num_workers > 1
+    assert batch_size % num_workers == 0, \
+        "The batch size {0} must be a multiple of the {1} workers".format( batch_size, num_workers )
+    self.num_workers     = num_workers
+    self.build_model     = build_model
+    self.encoder_inputs  = encoder_inputs
+    self.decoder_outputs = decoder_outputs
+    self.batch_size      = batch_size
+    # Size of the sub-batch of every replica
+    self.replica_batch_size = batch_size // num_workers
+    self.dropout         = dropout_keep_prob
+    self.session_config  = session_config
+    self.seed = np.random.randint( 2**30 ) if seed is None else seed
+
+    self.rank    = 0
+    self.workers = []
+    self.step_parity = 0
+    self.last_exchange_time = 0.
+
+    # Shapes of everything exchanged at every step, from a throwaway copy of the model
+    with tf.Graph().as_default():
+      model = build_model( self.replica_batch_size, summaries=False )
+      self.shapes = [v.get_shape().as_list() for _, v in self._trainable( model )] + \
+                    [v.get_shape().as_list() for v in self._moving( model )]
+    self.sizes = [int( np.prod( shape )) for shape in self.shapes]
+    # Everything, and the loss of the replica at the end
+    self.size  = sum( self.sizes ) + 1
+
+    bounds = np.linspace( 0, self.size, num_workers + 1 ).astype( int )
+    self.chunks = list( zip( bounds[:-1], bounds[1:] ))
+
+    self._slots = multiprocessing.RawArray( 'f', 2 * num_workers * self.size )
+    self._avg   = multiprocessing.RawArray( 'f', 2 * self.size )
+    self.abort   = multiprocessing.RawValue( 'i', 0 )
+    self.barrier = SharedBarrier( num_workers, self.abort )
+
+    # Replica 0 hands its initial variables to the others through this directory
+    self.init_dir = tempfile.mkdtemp( prefix="data_parallel_" )
+
+  @staticmethod
+  def _trainable( model ):
+    return [(g, v) for g, v in model.gradients if g is not None]
+
+  @staticmethod
+  def _moving( model ):
+    return [v for v in tf.global_variables() if 'moving_mean' in v.name or 'moving_variance' in v.name]
+
+  def start( self, epochs ):
+    """
+    Fork the replicas 1..num_workers-1. They train for the given number of
+    epochs and exit
+
+    Args
+      epochs: integer. Number of epochs to train for
+    """
+    for rank in xrange( 1, self.num_workers ):
+      worker = multiprocessing.Process( target=self._run_worker, args=(rank, epochs) )
+      worker.daemon = True
+      worker.start()
+      self.workers.append( worker )
+
+  def _run_worker( self, rank, epochs ):
+    self.rank = rank
+    try:
+      with tf.Graph().as_default():
+        model = self.build_model( self.replica_batch_size, summaries=False )
+        self.attach( model )
+        with tf.Session( config=self.session_config ) as sess:
+          self.receive_variables( sess )
+          for epoch in xrange( epochs ):
+            for enc_in, dec_out in self.get_batch_iterator( epoch ):
+              self._step( sess, enc_in, dec_out )
+    except Exception:
+      self.abort.value = 1
+      raise
+
+  def attach( self, model ):
+    """
+    Build the ops that exchange gradients in the graph of the model of this
+    replica. Adds no variables, so it can be called after they are initialized
+
+    Args
+      model: LinearModel of this replica
+    """
+    self.model = model
+
+    grads_and_vars = self._trainable( model )
+    moving = self._moving( model )
+
+    # Read the moving statistics after this batch has updated them
+    with tf.control_dependencies( tf.get_collection( tf.GraphKeys.UPDATE_OPS )):
+      self.local_moving = [tf.identity( v ) for v in moving]
+    self.local_grads = [g for g, _ in grads_and_vars]
+
+    self.avg_grads  = [tf.placeholder( v.dtype.base_dtype, shape=v.get_shape() ) for _, v in grads_and_vars]
+    self.avg_moving = [tf.placeholder( v.dtype.base_dtype, shape=v.get_shape() ) for v in moving]
+
+    # The same optimizer, so that its slots are shared with model.updates and
+    # the checkpoints are the same as those of a single process
+    apply_op = model.optimizer.apply_gradients( list( zip( self.avg_grads, [v for _, v in grads_and_vars] )),
+                                                global_step=model.global_step )
+    self.updates = tf.group( apply_op, *[tf.assign( v, p ) for v, p in zip( moving, self.avg_moving )] )
+
+    self.loss_feed    = tf.placeholder( tf.float32 )
+    self.loss_summary = tf.summary.scalar( 'loss/loss', self.loss_feed, collections=[] )
+
+    self.broadcast_saver = tf.train.Saver( tf.global_variables(), max_to_keep=1 )
+
+  def _buffer( self, array, offset, count ):
+    return np.frombuffer( array, dtype=np.float32, count=count, offset=4 * offset )
+
+  def _step( self, sess, enc_in, dec_out, output_feed=None, options=None, run_metadata=None ):
+    model = self.model
+    feed  = {model.encoder_inputs: enc_in,
+             model.decoder_outputs: dec_out,
+             model.isTraining: True,
+             model.dropout_keep_prob: self.dropout}
+
+    extra = [] if output_feed is None else output_feed
+    outputs = sess.run( [model.loss, self.local_grads, self.local_moving] + extra, feed,
+                        options=options, run_metadata=run_metadata )
+    loss, grads, moving = outputs[0], outputs[1], outputs[2]
+    exchange_start = time.time()
+
+    parity, n, size = self.step_parity, self.num_workers, self.size
+    self.step_parity = 1 - parity
+
+    # 1. Write this replica's gradients, moving statistics and loss to its slot
+    slot = self._buffer( self._slots, (parity * n + self.rank) * size, size )
+    offset = 0
+    for value, count in zip( grads + moving, self.sizes ):
+      slot[offset:offset+count] = np.ravel( value )
+      offset += count
+    slot[offset] = loss
+    self.barrier.wait()
+
+    # 2. Average this replica's chunk over all the slots, always in the same order
+    start, end = self.chunks[ self.rank ]
+    avg = self._buffer( self._avg, parity * size, size )
+    slots = [self._buffer( self._slots, (parity * n + r) * size, size ) for r in xrange( n )]
+    np.copyto( avg[start:end], slots[0][start:end] )
+    for other in slots[1:]:
+      avg[start:end] += other[start:end]
+    avg[start:end] /= n
+    self.barrier.wait()
+
+    # 3. Apply the averaged gradients and statistics, identically in every replica
+    feed, offset = {}, 0
+    for placeholder, shape, count in zip( self.avg_grads + self.avg_moving, self.shapes, self.sizes ):
+      feed[ placeholder ] = avg[offset:offset+count].reshape( shape )
+      offset += count
+    # Time spent writing, waiting for and averaging the gradients of the replicas
+    self.last_exchange_time = time.time() - exchange_start
+    sess.run( self.updates, feed )
+
+    return float( avg[offset] ), outputs[3:]
+
+  def step( self, sess, enc_in, dec_out, options=None, run_metadata=None ):
+    """
+    Run a synchronous training step of replica 0, feeding it the given sub-batch
+
+    Args
+      sess: tensorflow session of replica 0
+      enc_in, dec_out: the sub-batch of replica 0
+      options: (Optional) tf.RunOptions of the forward and backward pass
+      run_metadata: (Optional) tf.RunMetadata where its trace is collected
+    Returns
+      loss: loss over the whole batch, averaged over the sub-batches of all the replicas
+      loss_summary: tf summary of the averaged loss, to log on tensorboard
+      learning_rate_summary: tf summary of the learning rate, to log on tensorboard
+    """
+    loss, (lr_summary,) = self._step( sess, enc_in, dec_out, [self.model.learning_rate_summary],
+                                      options, run_metadata )
+    loss_summary = sess.run( self.loss_summary, {self.loss_feed: loss} )
+    return loss, loss_summary, lr_summary
+
+  def get_batch_iterator( self, epoch ):
+    """
+    The sub-batches of this replica for an epoch. All the replicas shuffle the
+    data the same way and cut it into sub-batches; replica r takes the r-th
+    sub-batch of every batch, i.e. every num_workers-th sub-batch. There are as
+    many of them as there are batches of batch_size in the epoch
+
+    Args
+      epoch: integer. Epoch number, from 0
+    Returns
+      batches: iterable of (2d sub-batch, 3d sub-batch) pairs, with a len()
+    """
+    return batch_pipeline.PrefetchingBatchIterator( self.encoder_inputs, self.decoder_outputs,
+      self.replica_batch_size, shuffle=True, seed=self.seed + epoch,
+      num_shards=self.num_workers, shard_index=self.rank )
+
+  def broadcast_variables( self, sess ):
+    """Send the variables of replica 0 (fresh or restored) to the other replicas"""
+    self.broadcast_saver.save( sess, os.path.join( self.init_dir, 'init' ),
+                               latest_filename='init_checkpoint', write_meta_graph=False )
+    self.barrier.wait()
+
+  def receive_variables( self, sess ):
+    self.barrier.wait()
+    self.broadcast_saver.restore( sess, os.path.join( self.init_dir, 'init' ))
+
+  def join( self ):
+    """Wait for the forked replicas to finish"""
+    for worker in self.workers:
+      worker.join()
+    shutil.rmtree( self.init_dir, ignore_errors=True )
+    failed = [w.exitcode for w in self.workers if w.exitcode != 0]
+    self.workers = []
+    if failed:
+      raise RuntimeError( "Data-parallel workers exited with codes {0}".format( failed ))
+
+  def fail( self ):
+    """Tell the other replicas that replica 0 failed, so that they stop waiting"""
+    self.abort.value = 1
+
+  def __enter__( self ):
+    return self
+
+  def __exit__( self, exc_type, exc_value, traceback ):
+    if exc_type is not None:
+      self.fail()
+      for worker in self.workers:
+        worker.join()
+      shutil.rmtree( self.init_dir, ignore_errors=True )
+      return False
+    self.join()
+
+
+@contextlib.contextmanager
+def running( trainer ):
+  """Context in which replica 0 trains with trainer, which may be None for a single process"""
+  if trainer is None:
+    yield
+  else:
+    with trainer:
+      yield
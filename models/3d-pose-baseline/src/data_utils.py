@@ -10,15 +10,20 @@ import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
 import cameras
 import viz
+import pose_archive
 import h5py
 import glob
-import copy
-import math
+import json
+import shutil
+import hashlib
 
 # Human3.6m IDs for training and testing
 TRAIN_SUBJECTS = [1,5,6,7,8]
 TEST_SUBJECTS  = [9,11]
 
+# Bump when the contents of the cached 2d data change
+CACHE_VERSION = 2
+
 # Joints in H3.6M -- data has 32 joints, but only 17 that move; these are the indices.
 H36M_NAMES = ['']*32
 H36M_NAMES[0]  = 'Hip'
@@ -79,15 +84,23 @@ def load_data( bpath, subjects, actions, dim=3 ):
 
   data = {}
 
+  # Read from the consolidated archive if one has been built (see pose_archive.py)
+  kind = '{0}d'.format(dim)
+  archive = pose_archive.open_archive( bpath, kind )
+  to_read = {}
+
   for subj in subjects:
     for action in actions:
 
       print('Reading subject {0}, action {1}'.format(subj, action))
 
-      dpath = os.path.join( bpath, 'S{0}'.format(subj), 'MyPoses/{0}D_positions'.format(dim), '{0}*.h5'.format(action) )
-      print( dpath )
+      if archive is not None:
+        fnames = archive.glob( kind, subj, '{0}*.h5'.format(action) )
+      else:
+        dpath = os.path.join( bpath, 'S{0}'.format(subj), 'MyPoses/{0}D_positions'.format(dim), '{0}*.h5'.format(action) )
+        print( dpath )
 
-      fnames = glob.glob( dpath )
+        fnames = glob.glob( dpath )
 
       loaded_seqs = 0
       for fname in fnames:
@@ -100,20 +113,24 @@ def load_data( bpath, subjects, actions, dim=3 ):
         # This rule makes sure that WalkDog and WalkTogeter are not loaded when
         # Walking is requested.
         if seqname.startswith( action ):
-          print( fname )
           loaded_seqs = loaded_seqs + 1
 
-          with h5py.File( fname, 'r' ) as h5f:
-            poses = h5f['{0}D_positions'.format(dim)][:]
+          if archive is not None:
+            to_read[ (subj, action, seqname) ] = (subj, seqname)
+            continue
 
-          poses = poses.T
-          data[ (subj, action, seqname) ] = poses
+          print( fname )
+          data[ (subj, action, seqname) ] = pose_archive.read_sequence_file( fname, kind )
 
       if dim == 2:
         assert loaded_seqs == 8, "Expecting 8 sequences, found {0} instead".format( loaded_seqs )
       else:
         assert loaded_seqs == 2, "Expecting 2 sequences, found {0} instead".format( loaded_seqs )
 
+  if archive is not None:
+    data.update( archive.read( kind, to_read ))
+    archive.close()
+
   return data
 
 
@@ -135,17 +152,41 @@ def load_stacked_hourglass(data_dir, subjects, actions):
   SH_TO_GT_PERM = np.array([SH_NAMES.index( h ) for h in H36M_NAMES if h != '' and h in SH_NAMES])
   assert np.all( SH_TO_GT_PERM == np.array([6,2,1,0,3,4,5,7,8,9,13,14,15,12,11,10]) )
 
+  def sh_to_h36m( poses ):
+    # Permute the loaded data to make it compatible with H36M
+    poses = poses[:,SH_TO_GT_PERM,:]
+
+    # Reshape into n x (32*2) matrix
+    poses = np.reshape(poses,[poses.shape[0], -1])
+    poses_final = np.zeros([poses.shape[0], len(H36M_NAMES)*2])
+
+    dim_to_use_x    = np.where(np.array([x != '' and x != 'Neck/Nose' for x in H36M_NAMES]))[0] * 2
+    dim_to_use_y    = dim_to_use_x+1
+
+    dim_to_use = np.zeros(len(SH_NAMES)*2,dtype=np.int32)
+    dim_to_use[0::2] = dim_to_use_x
+    dim_to_use[1::2] = dim_to_use_y
+    poses_final[:,dim_to_use] = poses
+    return poses_final
+
   data = {}
 
+  # Read from the consolidated archive if one has been built (see pose_archive.py)
+  archive = pose_archive.open_archive( data_dir, 'sh' )
+  to_read = {}
+
   for subj in subjects:
     for action in actions:
 
       print('Reading subject {0}, action {1}'.format(subj, action))
 
-      dpath = os.path.join( data_dir, 'S{0}'.format(subj), 'StackedHourglass/{0}*.h5'.format(action) )
-      print( dpath )
+      if archive is not None:
+        fnames = archive.glob( 'sh', subj, '{0}*.h5'.format(action) )
+      else:
+        dpath = os.path.join( data_dir, 'S{0}'.format(subj), 'StackedHourglass/{0}*.h5'.format(action) )
+        print( dpath )
 
-      fnames = glob.glob( dpath )
+        fnames = glob.glob( dpath )
 
       loaded_seqs = 0
       for fname in fnames:
@@ -159,29 +200,16 @@ def load_stacked_hourglass(data_dir, subjects, actions):
         # This rule makes sure that WalkDog and WalkTogeter are not loaded when
         # Walking is requested.
         if seqname.startswith( action ):
-          print( fname )
           loaded_seqs = loaded_seqs + 1
+          seqname = seqname+'-sh'
 
-          # Load the poses from the .h5 file
-          with h5py.File( fname, 'r' ) as h5f:
-            poses = h5f['poses'][:]
-
-            # Permute the loaded data to make it compatible with H36M
-            poses = poses[:,SH_TO_GT_PERM,:]
-
-            # Reshape into n x (32*2) matrix
-            poses = np.reshape(poses,[poses.shape[0], -1])
-            poses_final = np.zeros([poses.shape[0], len(H36M_NAMES)*2])
-
-            dim_to_use_x    = np.where(np.array([x != '' and x != 'Neck/Nose' for x in H36M_NAMES]))[0] * 2
-            dim_to_use_y    = dim_to_use_x+1
+          if archive is not None:
+            to_read[ (subj, action, seqname) ] = (subj, os.path.basename( fname ))
+            continue
 
-            dim_to_use = np.zeros(len(SH_NAMES)*2,dtype=np.int32)
-            dim_to_use[0::2] = dim_to_use_x
-            dim_to_use[1::2] = dim_to_use_y
-            poses_final[:,dim_to_use] = poses
-            seqname = seqname+'-sh'
-            data[ (subj, action, seqname) ] = poses_final
+          # Load the poses from the .h5 file
+          print( fname )
+          data[ (subj, action, seqname) ] = sh_to_h36m( pose_archive.read_sequence_file( fname, 'sh' ))
 
       # Make sure we loaded 8 sequences
       if (subj == 11 and action == 'Directions'): # <-- this video is damaged
@@ -189,6 +217,11 @@ def load_stacked_hourglass(data_dir, subjects, actions):
       else:
         assert loaded_seqs == 8, "Expecting 8 sequences, found {0} instead. S:{1} {2}".format(loaded_seqs, subj, action )
 
+  if archive is not None:
+    for key, poses in archive.read( 'sh', to_read ).items():
+      data[ key ] = sh_to_h36m( poses )
+    archive.close()
+
   return data
 
 
@@ -197,7 +230,8 @@ def normalization_stats(complete_data, dim, predict_14=False ):
   Computes normalization statistics: mean and stdev, dimensions used and ignored
 
   Args
-    complete_data: nxd np array with poses
+    complete_data: nxd np array with poses, or a dictionary of such arrays
+      (e.g. one per sequence), in which case they are never stacked
     dim. integer={2,3} dimensionality of the data
     predict_14. boolean. Whether to use only 14 joints
   Returns
@@ -209,8 +243,11 @@ def normalization_stats(complete_data, dim, predict_14=False ):
   if not dim in [2,3]:
     raise(ValueError, 'dim must be 2 or 3')
 
-  data_mean = np.mean(complete_data, axis=0)
-  data_std  =  np.std(complete_data, axis=0)
+  if isinstance(complete_data, dict):
+    data_mean, data_std = mean_std(complete_data)
+  else:
+    data_mean = np.mean(complete_data, axis=0)
+    data_std  =  np.std(complete_data, axis=0)
 
   # Encodes which 17 (or 14) 2d-3d pairs we are predicting
   dimensions_to_ignore = []
@@ -235,113 +272,128 @@ def transform_world_to_camera(poses_set, cams, ncams=4, experimental=True ):
     Project 3d poses from world coordinate to camera coordinate system
     Args
       poses_set: dictionary with 3d poses
-      cams: dictionary with cameras
+      cams: dictionary with cameras, preferably a cameras.CameraRegistry
       ncams: number of cameras per subject
+      experimental: whether to use cameras without tilt (see cameras.no_tilt_rotation)
     Return:
       t3d_camera: dictionary with 3d poses in camera coordinate
     """
+    if not isinstance( cams, cameras.CameraRegistry ):
+      cams = cameras.CameraRegistry( cams )
+
     t3d_camera = {}
     for t3dk in sorted( poses_set.keys() ):
 
       subj, action, seqname = t3dk
       t3d_world = poses_set[ t3dk ]
 
-      for c in range( ncams ):
-        R, T, f, c, k, p, name = cams[ (subj, c+1) ]
-        if experimental:
-          # Checks if a matrix is a valid rotation matrix.
-          def isRotationMatrix(R):
-              Rt = np.transpose(R)
-              shouldBeIdentity = np.dot(Rt, R)
-              I = np.identity(3, dtype = R.dtype)
-              n = np.linalg.norm(I - shouldBeIdentity)
-              return n < 1e-6
-           
-          # Calculates rotation matrix to euler angles
-          # The result is the same as MATLAB except the order
-          # of the euler angles ( x and z are swapped ).
-          def rotationMatrixToEulerAngles(R):
-              assert(isRotationMatrix(R))
-              sy = math.sqrt(R[0,0] * R[0,0] +  R[1,0] * R[1,0])
-              singular = sy < 1e-6
-              if  not singular :
-                  x = math.atan2(R[2,1] , R[2,2])
-                  y = math.atan2(-R[2,0], sy)
-                  z = math.atan2(R[1,0], R[0,0])
-              else :
-                  x = math.atan2(-R[1,2], R[1,1])
-                  y = math.atan2(-R[2,0], sy)
-                  z = 0
-              return np.array([x, y, z])
-
-          # Calculates Rotation Matrix given euler angles.
-          def eulerAnglesToRotationMatrix(theta) :
-              R_x = np.array([[1,         0,                  0                   ],
-                              [0,         math.cos(theta[0]), -math.sin(theta[0]) ],
-                              [0,         math.sin(theta[0]), math.cos(theta[0])  ]
-                              ])
-              R_y = np.array([[math.cos(theta[1]),    0,      math.sin(theta[1])  ],
-                              [0,                     1,      0                   ],
-                              [-math.sin(theta[1]),   0,      math.cos(theta[1])  ]
-                              ])
-              R_z = np.array([[math.cos(theta[2]),    -math.sin(theta[2]),    0],
-                              [math.sin(theta[2]),    math.cos(theta[2]),     0],
-                              [0,                     0,                      1]
-                              ])
-              R = np.dot(R_z, np.dot( R_y, R_x ))
-              return R
-
-          ## x rotation
-          # R[0][0] = 1
-          # R[0][1] = 0
-          # R[0][2] = 0
-          # R[1][0] = 0
-          # R[2][0] = 0
-          ## y rotation
-          # R[0][1] = 0
-          # R[1][0] = 0
-          # R[1][1] = 1
-          # R[1][2] = 0
-          # R[2][1] = 0
-          ## z rotation
-          # R[0][2] = 0
-          # R[1][2] = 0
-          # R[2][0] = 0
-          # R[2][1] = 0
-          # R[2][2] = 1
-          ## Do the theta thing with euler angles
-          theta = rotationMatrixToEulerAngles(R)
-          theta[0] = 0
-          theta[1] = 0
-          R = eulerAnglesToRotationMatrix(theta)
-        camera_coord = cameras.world_to_camera_frame( np.reshape(t3d_world, [-1, 3]), R, T)
-        camera_coord = np.reshape( camera_coord, [-1, len(H36M_NAMES)*3] )
+      # Transform the sequence into all the cameras of the subject at once
+      camera_coord = cams.world_to_camera( np.reshape(t3d_world, [-1, 3]), subj, ncams, experimental )
+      camera_coord = np.reshape( camera_coord, [ncams, -1, len(H36M_NAMES)*3] )
 
+      for c in range( ncams ):
+        name = cams[ (subj, c+1) ][-1]
         sname = seqname[:-3]+"."+name+".h5" # e.g.: Waiting 1.58860488.h5
-        t3d_camera[ (subj, action, sname) ] = camera_coord
+        t3d_camera[ (subj, action, sname) ] = camera_coord[ c ]
 
     return t3d_camera
 
 
-def normalize_data(data, data_mean, data_std, dim_to_use ):
+NORM_STATS_FILE = 'norm_stats.npz'
+
+def save_normalization_stats(path, data_mean_2d, data_std_2d, dim_to_ignore_2d, dim_to_use_2d,
+                             data_mean_3d, data_std_3d, dim_to_ignore_3d, dim_to_use_3d):
+  """
+  Saves the 2d and 3d normalization statistics of a training run, so that new
+  2d poses can be normalized (and predictions unnormalized) without reloading
+  the training data
+
+  Args
+    path: string. File to save to, usually <train_dir>/NORM_STATS_FILE
+    data_mean_2d, data_std_2d, dim_to_ignore_2d, dim_to_use_2d: 2d statistics
+    data_mean_3d, data_std_3d, dim_to_ignore_3d, dim_to_use_3d: 3d statistics
+  """
+  np.savez(path,
+    data_mean_2d=data_mean_2d, data_std_2d=data_std_2d,
+    dim_to_ignore_2d=dim_to_ignore_2d, dim_to_use_2d=dim_to_use_2d,
+    data_mean_3d=data_mean_3d, data_std_3d=data_std_3d,
+    dim_to_ignore_3d=dim_to_ignore_3d, dim_to_use_3d=dim_to_use_3d)
+
+
+def load_normalization_stats(path):
+  """
+  Loads the statistics saved by save_normalization_stats
+
+  Returns
+    stats: dictionary with the arrays passed to save_normalization_stats
+  """
+  with np.load(path) as f:
+    return {name: f[name] for name in f.files}
+
+
+def mean_std(poses_set):
+  """
+  Mean and standard deviation of all the poses in a dictionary, computed one
+  sequence at a time (merging per-sequence statistics with Chan et al.'s
+  parallel update) instead of on a stacked copy of every sequence
+
+  Args
+    poses_set: dictionary where values are nxd np arrays with poses
+  Returns
+    data_mean: np vector with the mean of the data
+    data_std: np vector with the (population) standard deviation of the data
+  """
+  n, data_mean, m2 = 0, 0., 0.
+  for key in sorted(poses_set.keys()):
+    poses = poses_set[ key ]
+    n_b = poses.shape[0]
+    if n_b == 0:
+      continue
+    mean_b = np.mean(poses, axis=0, dtype=np.float64)
+    m2_b = np.sum((poses - mean_b)**2, axis=0)
+
+    delta = mean_b - data_mean
+    data_mean = data_mean + delta * (n_b / float(n + n_b))
+    m2 = m2 + m2_b + delta**2 * (n * n_b / float(n + n_b))
+    n = n + n_b
+
+  return data_mean, np.sqrt(m2 / n)
+
+
+def normalize_data(data, data_mean, data_std, dim_to_use, dtype=np.float64 ):
   """
-  Normalizes a dictionary of poses
+  Normalizes a dictionary of poses. All the normalized poses are written into
+  one preallocated array, and every value of data_out is a view into it
 
   Args
     data: dictionary where values are
     data_mean: np vector with the mean of the data
     data_std: np vector with the standard deviation of the data
     dim_to_use: list of dimensions to keep in the data
+    dtype: data type of the normalized poses. float64 by default, so that the
+      3d targets denormalized for evaluation are exact; the training batches
+      are cast to float32 when they are stacked (see batch_pipeline.stack_data)
   Returns
     data_out: dictionary with same keys as data, but values have been normalized
   """
   data_out = {}
 
-  for key in data.keys():
-    data[ key ] = data[ key ][ :, dim_to_use ]
-    mu = data_mean[dim_to_use]
-    stddev = data_std[dim_to_use]
-    data_out[ key ] = np.divide( (data[key] - mu), stddev )
+  mu = data_mean[dim_to_use]
+  stddev = data_std[dim_to_use]
+
+  keys = sorted( data.keys() )
+  n = sum( data[ key ].shape[0] for key in keys )
+  normalized = np.empty( (n, len(dim_to_use)), dtype=dtype )
+
+  start = 0
+  for key in keys:
+    end = start + data[ key ].shape[0]
+    out = normalized[start:end]
+    out[:] = data[ key ][ :, dim_to_use ]
+    out -= mu
+    out /= stddev
+    data_out[ key ] = out
+    start = end
 
   return data_out
 
@@ -359,22 +411,54 @@ def unNormalizeData(normalized_data, data_mean, data_std, dimensions_to_ignore):
   Returns
     orig_data: the input normalized_data, but unnormalized
   """
-  T = normalized_data.shape[0] # Batch size
-  D = data_mean.shape[0] # Dimensionality
+  return Denormalizer(data_mean, data_std, dimensions_to_ignore)(normalized_data)
 
-  orig_data = np.zeros((T, D), dtype=np.float32)
-  dimensions_to_use = np.array([dim for dim in range(D)
-                                if dim not in dimensions_to_ignore])
 
-  orig_data[:, dimensions_to_use] = normalized_data
+class Denormalizer(object):
+  """
+  Reusable version of unNormalizeData. The dimensions to use are computed once
+  from the mean, std and ignored dimensions, so repeated calls (e.g. once per
+  batch) only do the multiply-add, optionally into a preallocated buffer.
+  """
 
-  # Multiply times stdev and add the mean
-  stdMat = data_std.reshape((1, D))
-  stdMat = np.repeat(stdMat, T, axis=0)
-  meanMat = data_mean.reshape((1, D))
-  meanMat = np.repeat(meanMat, T, axis=0)
-  orig_data = np.multiply(orig_data, stdMat) + meanMat
-  return orig_data
+  def __init__(self, data_mean, data_std, dimensions_to_ignore):
+    """
+    Args
+      data_mean: np vector with the mean of the data
+      data_std: np vector with the standard deviation of the data
+      dimensions_to_ignore: list of dimensions that were removed from the original data
+    """
+    D = data_mean.shape[0] # Dimensionality
+
+    used = np.ones(D, dtype=bool)
+    used[np.asarray(dimensions_to_ignore, dtype=int)] = False
+
+    self.dimensions_to_use = np.flatnonzero(used)
+    self.data_mean = data_mean.reshape((1, D))
+    self.data_std  = data_std.reshape((1, D))
+    # Ignored dimensions unnormalize to their mean
+    self.used_mean = self.data_mean[:, self.dimensions_to_use]
+    self.used_std  = self.data_std[:, self.dimensions_to_use]
+
+  def __call__(self, normalized_data, out=None):
+    """
+    Args
+      normalized_data: nxd matrix to unnormalize
+      out: optional nxD buffer for the result, e.g. reused across batches
+    Returns
+      orig_data: the input normalized_data, but unnormalized
+    """
+    T = normalized_data.shape[0] # Batch size
+    D = self.data_mean.shape[1]
+
+    if out is None:
+      out = np.empty((T, D), dtype=np.result_type(np.float32, self.data_mean, self.data_std))
+    assert out.shape == (T, D), "Output buffer should be {}x{}".format(T, D)
+
+    # Multiply times stdev and add the mean
+    out[:] = self.data_mean
+    out[:, self.dimensions_to_use] = normalized_data * self.used_std + self.used_mean
+    return out
 
 
 def define_actions( action ):
@@ -413,19 +497,23 @@ def project_to_cameras( poses_set, cams, ncams=4 ):
   Returns
     t2d: dictionary with 2d poses
   """
+  if not isinstance( cams, cameras.CameraRegistry ):
+    cams = cameras.CameraRegistry( cams )
+
   t2d = {}
 
   for t3dk in sorted( poses_set.keys() ):
     subj, a, seqname = t3dk
     t3d = poses_set[ t3dk ]
 
-    for cam in range( ncams ):
-      R, T, f, c, k, p, name = cams[ (subj, cam+1) ]
-      pts2d, _, _, _, _ = cameras.project_point_radial( np.reshape(t3d, [-1, 3]), R, T, f, c, k, p )
+    # Project every frame of the sequence into all the cameras of the subject in one go
+    pts2d, _, _, _, _ = cameras.project_point_radial_multi( np.reshape(t3d, [-1, 3]), cams.stacked( subj, ncams ) )
+    pts2d = np.reshape( pts2d, [ncams, -1, len(H36M_NAMES)*2] )
 
-      pts2d = np.reshape( pts2d, [-1, len(H36M_NAMES)*2] )
+    for cam in range( ncams ):
+      name = cams[ (subj, cam+1) ][-1]
       sname = seqname[:-3]+"."+name+".h5" # e.g.: Waiting 1.58860488.h5
-      t2d[ (subj, a, sname) ] = pts2d
+      t2d[ (subj, a, sname) ] = pts2d[ cam ]
 
   return t2d
 
@@ -449,8 +537,7 @@ def read_2d_predictions( actions, data_dir ):
   train_set = load_stacked_hourglass( data_dir, TRAIN_SUBJECTS, actions)
   test_set  = load_stacked_hourglass( data_dir, TEST_SUBJECTS,  actions)
 
-  complete_train = copy.deepcopy( np.vstack( train_set.values() ))
-  data_mean, data_std,  dim_to_ignore, dim_to_use = normalization_stats( complete_train, dim=2 )
+  data_mean, data_std,  dim_to_ignore, dim_to_use = normalization_stats( train_set, dim=2 )
 
   train_set = normalize_data( train_set, data_mean, data_std, dim_to_use )
   test_set  = normalize_data( test_set,  data_mean, data_std, dim_to_use )
@@ -458,7 +545,7 @@ def read_2d_predictions( actions, data_dir ):
   return train_set, test_set, data_mean, data_std, dim_to_ignore, dim_to_use
 
 
-def create_2d_data( actions, data_dir, rcams ):
+def create_2d_data( actions, data_dir, rcams, cache_dir=None ):
   """
   Creates 2d poses by projecting 3d poses with the corresponding camera
   parameters. Also normalizes the 2d poses
@@ -467,6 +554,9 @@ def create_2d_data( actions, data_dir, rcams ):
     actions: list of strings. Actions to load
     data_dir: string. Directory where the data can be loaded from
     rcams: dictionary with camera parameters
+    cache_dir: string. If given, the result is cached in this directory and
+      loaded memory-mapped from it on later calls with the same data_dir,
+      source files, actions, subjects and camera parameters
   Returns
     train_set: dictionary with projected 2d poses for training
     test_set: dictionary with projected 2d poses for testing
@@ -476,6 +566,12 @@ def create_2d_data( actions, data_dir, rcams ):
     dim_to_use: list with the dimensions to predict
   """
 
+  if cache_dir:
+    cache_path = os.path.join( cache_dir, '2d_' + cache_key( actions, data_dir, rcams ) )
+    if os.path.isdir( cache_path ):
+      print( "Loading cached 2d data from {0}".format( cache_path ))
+      return load_cached_sets( cache_path )
+
   # Load 3d data
   train_set = load_data( data_dir, TRAIN_SUBJECTS, actions, dim=3 )
   test_set  = load_data( data_dir, TEST_SUBJECTS,  actions, dim=3 )
@@ -484,14 +580,122 @@ def create_2d_data( actions, data_dir, rcams ):
   test_set  = project_to_cameras( test_set, rcams )
 
   # Compute normalization statistics.
-  complete_train = copy.deepcopy( np.vstack( train_set.values() ))
-  data_mean, data_std, dim_to_ignore, dim_to_use = normalization_stats( complete_train, dim=2 )
+  data_mean, data_std, dim_to_ignore, dim_to_use = normalization_stats( train_set, dim=2 )
 
   # Divide every dimension independently
   train_set = normalize_data( train_set, data_mean, data_std, dim_to_use )
   test_set  = normalize_data( test_set,  data_mean, data_std, dim_to_use )
 
-  return train_set, test_set, data_mean, data_std, dim_to_ignore, dim_to_use
+  result = train_set, test_set, data_mean, data_std, dim_to_ignore, dim_to_use
+  if cache_dir:
+    save_cached_sets( cache_path, *result )
+    print( "Cached 2d data in {0}".format( cache_path ))
+
+  return result
+
+
+def cache_key( actions, data_dir, rcams ):
+  """
+  Key of the cached 2d data of some actions: a hash of the actions, the train
+  and test subjects, the data directory with the size and modification time of
+  every 3d source file in it, and the parameters of every camera of those
+  subjects. Rebuilding the archive or replacing a sequence file thus misses
+  the cache, without reading the files themselves.
+
+  Args
+    actions: list of strings. Actions to load
+    data_dir: string. Directory where the data is loaded from
+    rcams: dictionary with camera parameters
+  Returns
+    key: string. Hex digest identifying the cached data
+  """
+  h = hashlib.sha1()
+  h.update( json.dumps( [CACHE_VERSION, sorted(actions), TRAIN_SUBJECTS, TEST_SUBJECTS,
+                         os.path.abspath( data_dir )] ).encode('utf-8') )
+  for fname in source_files( data_dir, TRAIN_SUBJECTS + TEST_SUBJECTS ):
+    st = os.stat( fname )
+    h.update( json.dumps( [os.path.relpath( fname, data_dir ), st.st_size, st.st_mtime] ).encode('utf-8') )
+  for camkey in sorted( k for k in rcams.keys() if k[0] in TRAIN_SUBJECTS + TEST_SUBJECTS ):
+    for param in rcams[ camkey ]:
+      h.update( np.ascontiguousarray( param ).tobytes() if isinstance( param, np.ndarray ) else str( param ).encode('utf-8') )
+  return h.hexdigest()
+
+
+def source_files( data_dir, subjects ):
+  """
+  Files the 3d poses of some subjects are read from: the archive of data_dir
+  if one has been built (see pose_archive.py), and the sequence files
+
+  Args
+    data_dir: string. Directory where the data is loaded from
+    subjects: list of integers. Subjects whose data is loaded
+  Returns
+    fnames: sorted list of strings. Paths of the existing source files
+  """
+  fnames = [os.path.join( data_dir, pose_archive.ARCHIVE_NAME )]
+  for subj in subjects:
+    fnames += glob.glob( os.path.join( data_dir, 'S{0}'.format(subj), 'MyPoses/3D_positions', '*.h5' ))
+  return sorted( f for f in fnames if os.path.isfile( f ))
+
+
+def save_cached_sets( cache_path, train_set, test_set, data_mean, data_std, dim_to_ignore, dim_to_use ):
+  """
+  Saves normalized train and test sets and their statistics to cache_path.
+  Every set is stacked into a single array, with an index of the rows of each
+  sequence. The cache is written to a temporary directory first and renamed
+  into place, so an interrupted run never leaves a half written cache.
+
+  Args
+    cache_path: string. Directory to write the cache to
+    train_set, test_set: dictionaries of normalized poses
+    data_mean, data_std, dim_to_ignore, dim_to_use: normalization statistics
+  """
+  tmp_path = cache_path.rstrip('/') + '.tmp'
+  if os.path.isdir( tmp_path ):
+    shutil.rmtree( tmp_path )
+  os.makedirs( tmp_path )
+
+  index = {}
+  for name, data in [('train', train_set), ('test', test_set)]:
+    keys = sorted( data.keys() )
+    np.save( os.path.join( tmp_path, name + '.npy' ), np.vstack( [data[k] for k in keys] ))
+
+    index[ name ], start = [], 0
+    for k in keys:
+      end = start + data[k].shape[0]
+      index[ name ].append( list(k) + [start, end] )
+      start = end
+
+  with open( os.path.join( tmp_path, 'index.json' ), 'w' ) as f:
+    json.dump( index, f )
+  np.savez( os.path.join( tmp_path, 'stats.npz' ), data_mean=data_mean, data_std=data_std,
+    dim_to_ignore=dim_to_ignore, dim_to_use=dim_to_use )
+
+  os.rename( tmp_path, cache_path )
+
+
+def load_cached_sets( cache_path ):
+  """
+  Loads the data saved by save_cached_sets. The set arrays are memory-mapped,
+  and every sequence in the returned dictionaries is a view into them.
+
+  Args
+    cache_path: string. Directory to load the cache from
+  Returns
+    train_set, test_set, data_mean, data_std, dim_to_ignore, dim_to_use
+  """
+  with open( os.path.join( cache_path, 'index.json' )) as f:
+    index = json.load( f )
+
+  sets = []
+  for name in ['train', 'test']:
+    stacked = np.load( os.path.join( cache_path, name + '.npy' ), mmap_mode='r' )
+    sets.append( {(subj, str(action), str(seqname)): stacked[start:end]
+                  for subj, action, seqname, start, end in index[ name ]} )
+
+  stats = np.load( os.path.join( cache_path, 'stats.npz' ))
+  return (sets[0], sets[1], stats['data_mean'], stats['data_std'],
+    stats['dim_to_ignore'], stats['dim_to_use'])
 
 
 def read_3d_data( actions, data_dir, camera_frame, rcams, predict_14=False ):
@@ -529,8 +733,7 @@ def read_3d_data( actions, data_dir, camera_frame, rcams, predict_14=False ):
   test_set,  test_root_positions  = postprocess_3d( test_set )
 
   # Compute normalization statistics
-  complete_train = copy.deepcopy( np.vstack( train_set.values() ))
-  data_mean, data_std, dim_to_ignore, dim_to_use = normalization_stats( complete_train, dim=3, predict_14=predict_14 )
+  data_mean, data_std, dim_to_ignore, dim_to_use = normalization_stats( train_set, dim=3, predict_14=predict_14 )
 
   # Divide every dimension independently
   train_set = normalize_data( train_set, data_mean, data_std, dim_to_use )
@@ -541,22 +744,34 @@ def read_3d_data( actions, data_dir, camera_frame, rcams, predict_14=False ):
 
 def postprocess_3d( poses_set ):
   """
-  Center 3d points around root
+  Center 3d points around root, in place
 
   Args
     poses_set: dictionary with 3d data
   Returns
     poses_set: dictionary with 3d data centred around root (center hip) joint
-    root_positions: dictionary with the original 3d position of each pose
+    root_positions: dictionary with the original 3d position of each pose.
+      Values are views into a single nx3 array of the roots of all sequences
   """
+  keys = sorted( poses_set.keys() )
+  roots = np.empty( (sum( poses_set[k].shape[0] for k in keys ), 3) )
+
   root_positions = {}
-  for k in poses_set.keys():
+  start = 0
+  for k in keys:
+    # View every pose as 32 joints x 3 coordinates (copies only if the poses
+    # are not C-contiguous, e.g. straight from load_data)
+    poses = np.ascontiguousarray( poses_set[k] )
+    joints = poses.reshape( (poses.shape[0], len(H36M_NAMES), 3) )
+
     # Keep track of the global position
-    root_positions[k] = copy.deepcopy(poses_set[k][:,:3])
+    end = start + poses.shape[0]
+    root_positions[k] = roots[start:end]
+    root_positions[k][:] = joints[:,0,:]
+    start = end
 
     # Remove the root from the 3d position
-    poses = poses_set[k]
-    poses = poses - np.tile( poses[:,:3], [1, len(H36M_NAMES)] )
+    joints -= root_positions[k][:,np.newaxis,:]
     poses_set[k] = poses
 
   return poses_set, root_positions
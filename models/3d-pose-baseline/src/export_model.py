@@ -0,0 +1,169 @@
+"""Export a trained LinearModel for inference
+
+Reads the variables of a checkpoint and writes an inference-only version of
+the model, where
+  - batch normalization (with its moving statistics) is folded into the
+    weights and biases of the preceding dense layer,
+  - max-norm clipping is applied to the weights once, instead of at every
+    forward pass, and
+  - there is no dropout, optimizer, summary or isTraining switch left.
+
+Two artifacts are written to --output_dir:
+  model.npz          weights and normalization statistics, for numpy_runner.py
+  frozen_model.pb    a TensorFlow GraphDef with the weights as constants,
+                     input "enc_in" and output "poses3d"
+
+Usage:
+  python src/export_model.py --train_dir=experiments/All/... [--output_dir=...]
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import numpy as np
+import tensorflow as tf
+
+import data_utils
+import linear_model
+import numpy_runner
+
+tf.app.flags.DEFINE_string("train_dir", "", "Training directory of the model, with its checkpoints")
+tf.app.flags.DEFINE_string("checkpoint", "", "Checkpoint to export. Defaults to the latest one in train_dir")
+tf.app.flags.DEFINE_string("output_dir", "", "Where to write the exported model. Defaults to <train_dir>/export")
+
+FLAGS = tf.app.flags.FLAGS
+
+# Default epsilon of tf.layers.batch_normalization, used by LinearModel
+BATCH_NORM_EPSILON = 1e-3
+
+
+def fold_dense( reader, scope, w_name, b_name, bn_name, max_norm, batch_norm ):
+  """
+  Weights and biases of a dense layer of LinearModel, with max-norm clipping
+  and the following batch normalization folded in
+
+  Args
+    reader: checkpoint reader
+    scope: string. Variable scope of the layer
+    w_name, b_name: strings. Names of the weights and biases
+    bn_name: string. Name of the batch normalization layer after this one
+    max_norm: boolean. Whether the weights are clipped to a norm of 1
+    batch_norm: boolean. Whether batch normalization follows the layer
+  Returns
+    w, b: folded weights and biases
+  """
+  w = reader.get_tensor( scope + w_name ).astype( np.float64 )
+  b = reader.get_tensor( scope + b_name ).astype( np.float64 )
+
+  if max_norm:
+    # Same as tf.clip_by_norm(w, 1): scale the whole matrix down to norm 1
+    w = w / max( np.linalg.norm( w ), 1. )
+
+  if batch_norm:
+    bn = scope + bn_name + '/'
+    gamma = reader.get_tensor( bn + 'gamma' )
+    beta  = reader.get_tensor( bn + 'beta' )
+    mean  = reader.get_tensor( bn + 'moving_mean' )
+    var   = reader.get_tensor( bn + 'moving_variance' )
+
+    scale = gamma / np.sqrt( var + BATCH_NORM_EPSILON )
+    w = w * scale
+    b = (b - mean) * scale + beta
+
+  return w, b
+
+
+def export_linear_model( checkpoint, config ):
+  """
+  Folded weights of a LinearModel checkpoint, in the numpy_runner format
+
+  Args
+    checkpoint: string. Checkpoint to read
+    config: dictionary with the model configuration (see linear_model.save_model_config)
+  Returns
+    spec: layer description for numpy_runner.save_model
+    weights: dictionary of name -> folded weights
+  """
+  reader = tf.train.NewCheckpointReader( checkpoint )
+  max_norm, batch_norm = config['max_norm'], config['batch_norm']
+  weights = {}
+
+  def layer( name, scope, w_name, b_name, bn_name, relu ):
+    w, b = fold_dense( reader, scope, w_name, b_name, bn_name, max_norm, batch_norm and relu )
+    weights[ name + '_w' ], weights[ name + '_b' ] = w, b
+    return {'w': name + '_w', 'b': name + '_b', 'relu': relu}
+
+  spec = {'input': layer( 'input', 'linear_model/', 'w1', 'b1', 'batch_normalization', True ),
+          'blocks': []}
+
+  for idx in range( config['num_layers'] ):
+    scope = 'linear_model/two_linear_{0}/'.format( idx )
+    spec['blocks'].append( {
+      'layers': [layer( 'block{0}_1'.format( idx ), scope, 'w2_{0}'.format( idx ), 'b2_{0}'.format( idx ),
+                        'batch_normalization1{0}'.format( idx ), True ),
+                 layer( 'block{0}_2'.format( idx ), scope, 'w3_{0}'.format( idx ), 'b3_{0}'.format( idx ),
+                        'batch_normalization2{0}'.format( idx ), True )],
+      'residual': config['residual']} )
+
+  spec['output'] = layer( 'output', 'linear_model/', 'w4', 'b4', None, False )
+  return spec, weights
+
+
+def write_frozen_graph( spec, weights, path ):
+  """
+  Write the exported model as a GraphDef with the weights as constants
+
+  Args
+    spec: layer description, as returned by export_linear_model
+    weights: dictionary of name -> folded weights
+    path: string. .pb file to write
+  """
+  graph = tf.Graph()
+  with graph.as_default():
+    input_size = weights[ spec['input']['w'] ].shape[0]
+    x = tf.placeholder( tf.float32, shape=[None, input_size], name="enc_in" )
+
+    def dense( x, layer ):
+      y = tf.matmul( x, tf.constant( weights[ layer['w'] ], dtype=tf.float32 )) + \
+          tf.constant( weights[ layer['b'] ], dtype=tf.float32 )
+      return tf.nn.relu( y ) if layer['relu'] else y
+
+    y = dense( x, spec['input'] )
+    for block in spec['blocks']:
+      xin = y
+      for layer in block['layers']:
+        y = dense( y, layer )
+      y = (xin + y) if block['residual'] else y
+    tf.identity( dense( y, spec['output'] ), name="poses3d" )
+
+  tf.train.write_graph( graph.as_graph_def(), os.path.dirname( path ), os.path.basename( path ), as_text=False )
+
+
+def main(_):
+  if not FLAGS.train_dir:
+    raise ValueError( "--train_dir is required" )
+
+  checkpoint = FLAGS.checkpoint or tf.train.latest_checkpoint( FLAGS.train_dir, latest_filename="checkpoint" )
+  if not checkpoint:
+    raise ValueError( "No checkpoint found in {0}".format( FLAGS.train_dir ))
+
+  output_dir = FLAGS.output_dir or os.path.join( FLAGS.train_dir, 'export' )
+  if not os.path.isdir( output_dir ):
+    os.makedirs( output_dir )
+
+  config = linear_model.load_model_config( FLAGS.train_dir )
+  stats = data_utils.load_normalization_stats( os.path.join( FLAGS.train_dir, data_utils.NORM_STATS_FILE ))
+
+  print( "Exporting {0}".format( checkpoint ))
+  spec, weights = export_linear_model( checkpoint, config )
+
+  norm_stats = {'mean_2d': stats['data_mean_2d'], 'std_2d': stats['data_std_2d'], 'dim_to_use_2d': stats['dim_to_use_2d'],
+                'mean_3d': stats['data_mean_3d'], 'std_3d': stats['data_std_3d'], 'dim_to_use_3d': stats['dim_to_use_3d']}
+  numpy_runner.save_model( os.path.join( output_dir, 'model.npz' ), spec, weights, norm_stats )
+  write_frozen_graph( spec, weights, os.path.join( output_dir, 'frozen_model.pb' ))
+  print( "Exported to {0}".format( output_dir ))
+
+if __name__ == "__main__":
+  tf.app.run()
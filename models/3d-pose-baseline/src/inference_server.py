@@ -0,0 +1,227 @@
+"""Lift 2d poses to 3d with a trained model, without loading any dataset
+
+The model and its normalization statistics are restored once from a training
+directory (see train() in predict_3dpose.py, which saves them next to the
+checkpoints). 2d poses can then be lifted
+  - from a .npy file to a .npy file, in chunks (--mode=file),
+  - from stdin to stdout, one json list of poses per line (--mode=stdin), or
+  - through a local HTTP endpoint (--mode=http), where concurrent requests
+    are grouped into micro-batches before running the model.
+
+2d poses are nx(32*2) arrays in the H36M joint order used by data_utils, in
+pixels. Joints that the model does not use are ignored. 3d poses are returned
+as nx(32*3) arrays, centred around the root joint. Models trained with
+--camera_frame predict them in the coordinates of the camera that saw the 2d
+poses; the others in world coordinates (see InferenceEngine.frame).
+
+Usage:
+  python src/inference_server.py --train_dir=experiments/All/... --mode=file --input=poses_2d.npy --output=poses_3d.npy
+  python src/inference_server.py --train_dir=experiments/All/... --mode=http --port=8000
+  curl -d '{"poses_2d": [[...64 numbers...]]}' localhost:8000/predict
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import threading
+
+import numpy as np
+from six.moves import BaseHTTPServer
+from six.moves import socketserver
+import tensorflow as tf
+
+import data_utils
+import linear_model
+from micro_batcher import MicroBatcher, check_poses_2d
+
+tf.app.flags.DEFINE_string("train_dir", "", "Training directory of the model, with its checkpoints")
+tf.app.flags.DEFINE_string("checkpoint", "", "Checkpoint to restore. Defaults to the latest one in train_dir")
+tf.app.flags.DEFINE_string("mode", "file", "Where to read 2d poses from: file, stdin or http")
+tf.app.flags.DEFINE_string("input", "", "File mode: .npy file with nx64 2d poses")
+tf.app.flags.DEFINE_string("output", "", "File mode: .npy file to write the nx96 3d poses to")
+tf.app.flags.DEFINE_string("host", "127.0.0.1", "HTTP mode: address to listen on")
+tf.app.flags.DEFINE_integer("port", 8000, "HTTP mode: port to listen on")
+tf.app.flags.DEFINE_integer("batch_size", 4096, "Largest batch the model is run on")
+tf.app.flags.DEFINE_float("max_wait_ms", 5, "HTTP mode: how long to wait for more requests to fill a batch")
+tf.app.flags.DEFINE_boolean("use_cpu", False, "Whether to use the CPU")
+
+FLAGS = tf.app.flags.FLAGS
+
+
+class InferenceEngine(object):
+  """ A trained LinearModel with its normalization statistics """
+
+  def __init__(self, train_dir, checkpoint=None, batch_size=4096, use_cpu=False):
+    """Restores the model and statistics saved in train_dir
+
+    Args
+      train_dir: string. Training directory of the model
+      checkpoint: string. Checkpoint to restore. Defaults to the latest one
+      batch_size: integer. Largest batch the model is run on
+      use_cpu: boolean. Whether to use the CPU
+    """
+    self.config = linear_model.load_model_config( train_dir )
+    stats = data_utils.load_normalization_stats( os.path.join( train_dir, data_utils.NORM_STATS_FILE ))
+
+    # Coordinates of the predicted 3d poses, which depend on how the model was trained
+    self.frame = 'camera' if self.config['camera_frame'] else 'world'
+
+    self.dim_to_use_2d = stats['dim_to_use_2d']
+    self.mean_2d = stats['data_mean_2d'][ self.dim_to_use_2d ]
+    self.std_2d  = stats['data_std_2d'][ self.dim_to_use_2d ]
+    self.unnormalize_3d = data_utils.Denormalizer( stats['data_mean_3d'], stats['data_std_3d'], stats['dim_to_ignore_3d'] )
+    self.batch_size = batch_size
+
+    checkpoint = checkpoint or tf.train.latest_checkpoint( train_dir, latest_filename="checkpoint" )
+    if not checkpoint:
+      raise ValueError( "No checkpoint found in {0}".format( train_dir ))
+
+    self.graph = tf.Graph()
+    with self.graph.as_default():
+      self.model = linear_model.LinearModel(
+        self.config['linear_size'],
+        self.config['num_layers'],
+        self.config['residual'],
+        self.config['batch_norm'],
+        self.config['max_norm'],
+        batch_size,
+        0.,
+        None,
+        self.config['predict_14'],
+        dtype=tf.float16 if self.config['use_fp16'] else tf.float32)
+
+      device_count = {"GPU": 0} if use_cpu else {"GPU": 1}
+      self.sess = tf.Session( graph=self.graph, config=tf.ConfigProto( device_count=device_count ))
+      print( "Loading model {0}, predicting 3d poses in {1} coordinates".format( checkpoint, self.frame ))
+      self.model.saver.restore( self.sess, checkpoint )
+
+    self.lock = threading.Lock()
+
+  def close(self):
+    self.sess.close()
+
+  def predict(self, poses_2d):
+    """Lift 2d poses to 3d
+
+    Args
+      poses_2d: nx(32*2) array of 2d poses, in pixels
+    Returns
+      poses_3d: nx(32*3) array of 3d poses, centred around the root, in the
+        coordinates given by self.frame
+    """
+    poses_2d = check_poses_2d( poses_2d )
+
+    n = poses_2d.shape[0]
+    poses_3d = np.empty( (n, len(data_utils.H36M_NAMES)*3) )
+    for start in range( 0, n, self.batch_size ):
+      end = min( start + self.batch_size, n )
+      enc_in = ((poses_2d[start:end, self.dim_to_use_2d] - self.mean_2d) / self.std_2d).astype( np.float32 )
+      with self.lock:
+        dec_out = self.model.predict( self.sess, enc_in )
+      self.unnormalize_3d( dec_out, out=poses_3d[start:end] )
+
+    return poses_3d
+
+
+def run_file(engine, input_path, output_path, chunk_size=65536):
+  """Lift all the 2d poses of a .npy file, one chunk at a time"""
+  poses_2d = np.load( input_path, mmap_mode='r' )
+  poses_3d = np.lib.format.open_memmap( output_path, mode='w+', dtype=np.float32,
+    shape=(poses_2d.shape[0], len(data_utils.H36M_NAMES)*3) )
+
+  start_time = time.time()
+  for start in range( 0, poses_2d.shape[0], chunk_size ):
+    end = min( start + chunk_size, poses_2d.shape[0] )
+    poses_3d[start:end] = engine.predict( poses_2d[start:end] )
+    print( "Lifted {0} / {1} poses".format( end, poses_2d.shape[0] ))
+
+  poses_3d.flush()
+  print( "done in {0:.2f} s".format( time.time() - start_time ))
+
+
+def run_stdin(engine, fin=sys.stdin, fout=sys.stdout):
+  """Lift the json list of 2d poses of every line of fin, writing one line to fout each"""
+  for line in fin:
+    line = line.strip()
+    if not line:
+      continue
+    try:
+      poses_3d = engine.predict( np.array( json.loads( line ), dtype=np.float64 ))
+      fout.write( json.dumps( poses_3d.tolist() ) + "\n" )
+    except Exception as e: # pylint: disable=broad-except
+      fout.write( json.dumps( {"error": str(e)} ) + "\n" )
+    fout.flush()
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+
+def make_http_server(batcher, host="127.0.0.1", port=8000):
+  """
+  HTTP server answering POST /predict with body {"poses_2d": [[...], ...]}
+  with {"poses_3d": [[...], ...], "frame": "camera" or "world"}. Every request is handled in its own thread
+  and goes through batcher
+  """
+
+  class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_POST(self):
+      if self.path != '/predict':
+        self._reply( 404, {"error": "unknown path {0}".format( self.path )} )
+        return
+      try:
+        body = json.loads( self.rfile.read( int( self.headers['Content-Length'] )).decode('utf-8') )
+        poses_3d = batcher.predict( body['poses_2d'] )
+      except Exception as e: # pylint: disable=broad-except
+        self._reply( 400, {"error": str(e)} )
+        return
+      self._reply( 200, {"poses_3d": poses_3d.tolist(), "frame": batcher.engine.frame} )
+
+    def _reply(self, code, obj):
+      data = json.dumps( obj ).encode('utf-8')
+      self.send_response( code )
+      self.send_header( "Content-Type", "application/json" )
+      self.send_header( "Content-Length", str( len( data )))
+      self.end_headers()
+      self.wfile.write( data )
+
+    def log_message(self, *args):
+      pass
+
+  return _ThreadingHTTPServer( (host, port), Handler )
+
+
+def main(_):
+  if not FLAGS.train_dir:
+    raise ValueError( "--train_dir is required" )
+
+  engine = InferenceEngine( FLAGS.train_dir, FLAGS.checkpoint or None, FLAGS.batch_size, FLAGS.use_cpu )
+  try:
+    if FLAGS.mode == "file":
+      run_file( engine, FLAGS.input, FLAGS.output )
+    elif FLAGS.mode == "stdin":
+      run_stdin( engine )
+    elif FLAGS.mode == "http":
+      batcher = MicroBatcher( engine, FLAGS.batch_size, FLAGS.max_wait_ms / 1000. )
+      server = make_http_server( batcher, FLAGS.host, FLAGS.port )
+      print( "Listening on http://{0}:{1}/predict".format( FLAGS.host, FLAGS.port ))
+      try:
+        server.serve_forever()
+      except KeyboardInterrupt:
+        pass
+      finally:
+        server.server_close()
+        batcher.close()
+    else:
+      raise ValueError( "Unknown mode {0}".format( FLAGS.mode ))
+  finally:
+    engine.close()
+
+if __name__ == "__main__":
+  tf.app.run()
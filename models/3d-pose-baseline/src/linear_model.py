@@ -8,11 +8,27 @@ from __future__ import print_function
 from tensorflow.python.ops import variable_scope as vs
 
 import os
+import json
 import numpy as np
 from six.moves import xrange  # pylint: disable=redefined-builtin
 import tensorflow as tf
 import data_utils
 import cameras as cam
+import batch_pipeline
+
+# Written next to the checkpoints, so that a trained model can be rebuilt
+# without the flags it was trained with (see inference_server.py)
+MODEL_CONFIG_FILE = 'model_config.json'
+
+def save_model_config(train_dir, **config):
+  """Save the configuration of a model (e.g. the LinearModel arguments) in train_dir"""
+  with open(os.path.join(train_dir, MODEL_CONFIG_FILE), 'w') as f:
+    json.dump(config, f, indent=2, sort_keys=True)
+
+def load_model_config(train_dir):
+  """Load the configuration saved by save_model_config"""
+  with open(os.path.join(train_dir, MODEL_CONFIG_FILE)) as f:
+    return json.load(f)
 
 def kaiming(shape, dtype, partition_info=None):
   """Kaiming initialization as described in https://arxiv.org/pdf/1502.01852.pdf
@@ -52,7 +68,7 @@ class LinearModel(object):
       max_norm: boolean. Whether to clip weights to a norm of 1
       batch_size: integer. The size of the batches used during training
       learning_rate: float. Learning rate to start with
-      summaries_dir: String. Directory where to log progress
+      summaries_dir: String. Directory where to log progress. None to not log
       predict_14: boolean. Whether to predict 14 instead of 17 joints
       dtype: the data type to use to store internal variables
     """
@@ -78,8 +94,10 @@ class LinearModel(object):
     self.dropout_keep_prob = tf.placeholder(tf.float32, name="dropout_keep_prob")
 
     # Summary writers for train and test runs
-    self.train_writer = tf.summary.FileWriter( os.path.join(summaries_dir, 'train' ))
-    self.test_writer  = tf.summary.FileWriter( os.path.join(summaries_dir, 'test' ))
+    self.train_writer, self.test_writer = None, None
+    if summaries_dir is not None:
+      self.train_writer = tf.summary.FileWriter( os.path.join(summaries_dir, 'train' ))
+      self.test_writer  = tf.summary.FileWriter( os.path.join(summaries_dir, 'test' ))
 
     self.linear_size   = linear_size
     self.batch_size    = batch_size
@@ -135,6 +153,7 @@ class LinearModel(object):
 
     # Gradients and update operation for training the model.
     opt = tf.train.AdamOptimizer( self.learning_rate )
+    self.optimizer = opt
     update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
 
     with tf.control_dependencies(update_ops):
@@ -200,7 +219,8 @@ class LinearModel(object):
 
     return y
 
-  def step(self, session, encoder_inputs, decoder_outputs, dropout_keep_prob, isTraining=True):
+  def step(self, session, encoder_inputs, decoder_outputs, dropout_keep_prob, isTraining=True,
+           options=None, run_metadata=None):
     """Run a step of the model feeding the given inputs.
 
     Args
@@ -209,6 +229,8 @@ class LinearModel(object):
       decoder_outputs: list of numpy vectors that are the expected decoder outputs
       dropout_keep_prob: (0,1] dropout keep probability
       isTraining: whether to do the backward step or only forward
+      options: (Optional) tf.RunOptions of the step, e.g. to trace it
+      run_metadata: (Optional) tf.RunMetadata where the trace is collected
 
     Returns
       if isTraining is True, a 4-tuple
@@ -233,7 +255,7 @@ class LinearModel(object):
                      self.learning_rate_summary,
                      self.outputs]
 
-      outputs = session.run( output_feed, input_feed )
+      outputs = session.run( output_feed, input_feed, options=options, run_metadata=run_metadata )
       return outputs[1], outputs[2], outputs[3], outputs[4]
 
     else:
@@ -241,9 +263,25 @@ class LinearModel(object):
                      self.loss_summary,
                      self.outputs]
 
-      outputs = session.run(output_feed, input_feed)
+      outputs = session.run(output_feed, input_feed, options=options, run_metadata=run_metadata)
       return outputs[0], outputs[1], outputs[2]  # No gradient norm
 
+  def predict(self, session, encoder_inputs):
+    """Run the model forward only, e.g. for inference on new 2d poses.
+
+    Args
+      session: tensorflow session to use
+      encoder_inputs: nx(2d dims) normalized 2d inputs
+
+    Returns
+      outputs: nx(3d dims) predicted normalized 3d poses
+    """
+    input_feed = {self.encoder_inputs: encoder_inputs,
+                  self.isTraining: False,
+                  self.dropout_keep_prob: 1.0}
+
+    return session.run(self.outputs, input_feed)
+
   def get_all_batches( self, data_x, data_y, camera_frame, training=True ):
     """
     Obtain a list of all the batches, randomly permutted
@@ -298,3 +336,19 @@ class LinearModel(object):
     decoder_outputs = np.split( decoder_outputs, n_batches )
 
     return encoder_inputs, decoder_outputs
+
+  def get_batch_iterator( self, encoder_inputs, decoder_outputs, training=True ):
+    """
+    Obtain an iterator over the batches of one epoch. Unlike get_all_batches,
+    the data is stacked only once (see batch_pipeline.stack_data) and batches
+    are gathered on a background thread while the model trains.
+    Args
+      encoder_inputs: nx(2d dims) array with the stacked 2d inputs
+      decoder_outputs: nx(3d dims) array with the stacked 3d outputs
+      training: True if this is a training batch. False otherwise.
+
+    Returns
+      batches: iterable of (2d batch, 3d batch) pairs, with a len()
+    """
+    return batch_pipeline.PrefetchingBatchIterator( encoder_inputs, decoder_outputs,
+      self.batch_size, shuffle=training )
@@ -0,0 +1,130 @@
+"""Micro-batching of concurrent prediction requests (see inference_server.py)
+
+Kept apart from inference_server.py so that it does not need TensorFlow: the
+engine it batches for only needs a predict( poses_2d ) method.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import time
+import threading
+
+import numpy as np
+from six.moves import queue
+
+import data_utils
+
+# Number of 2d dimensions of a pose
+POSE_2D_SIZE = len(data_utils.H36M_NAMES)*2
+
+# How long a request waits for its prediction before giving up, in seconds
+RESULT_TIMEOUT = 60.
+
+
+def check_poses_2d(poses_2d):
+  """Convert poses_2d to an nx(32*2) float array, raising ValueError if it does not have that shape"""
+  poses_2d = np.asarray( poses_2d, dtype=np.float64 )
+  if poses_2d.ndim != 2 or poses_2d.shape[1] != POSE_2D_SIZE:
+    raise ValueError( "Expected nx{0} 2d poses, got an array of shape {1}".format( POSE_2D_SIZE, poses_2d.shape ))
+  return poses_2d
+
+
+class _Request(object):
+  """ 2d poses waiting for their 3d poses """
+
+  def __init__(self, poses_2d):
+    self.poses_2d = poses_2d
+    self.poses_3d = None
+    self.error = None
+    self.done = threading.Event()
+
+  def result(self, timeout=RESULT_TIMEOUT):
+    if not self.done.wait( timeout ):
+      raise RuntimeError( "Timed out waiting for the prediction" )
+    if self.error is not None:
+      raise self.error
+    return self.poses_3d
+
+
+class MicroBatcher(object):
+  """
+  Groups the 2d poses of concurrent requests into batches of up to
+  max_batch_size poses, waiting at most max_wait seconds after the first
+  request of a batch for others to arrive, and runs the model once per batch
+  """
+
+  def __init__(self, engine, max_batch_size=4096, max_wait=0.005):
+    self.engine = engine
+    self.max_batch_size = max_batch_size
+    self.max_wait = max_wait
+    self.requests = queue.Queue()
+    self.thread = threading.Thread( target=self._run )
+    self.thread.daemon = True
+    self.thread.start()
+
+  def submit(self, poses_2d):
+    """
+    Queue some 2d poses. Returns a request whose result() are the 3d poses.
+    Raises ValueError if poses_2d is not an nx(32*2) array
+    """
+    request = _Request( check_poses_2d( poses_2d ))
+    self.requests.put( request )
+    return request
+
+  def predict(self, poses_2d):
+    return self.submit( poses_2d ).result()
+
+  def close(self):
+    self.requests.put( None )
+    self.thread.join()
+
+  def _run(self):
+    stop = False
+    while not stop:
+      request = self.requests.get()
+      if request is None:
+        return
+
+      # Collect more requests until the batch is full or max_wait has passed
+      batch, n = [request], request.poses_2d.shape[0]
+      deadline = time.time() + self.max_wait
+      while n < self.max_batch_size:
+        timeout = deadline - time.time()
+        if timeout <= 0:
+          break
+        try:
+          request = self.requests.get( timeout=timeout )
+        except queue.Empty:
+          break
+        if request is None:
+          stop = True
+          break
+        batch.append( request )
+        n += request.poses_2d.shape[0]
+
+      try:
+        self._predict( batch )
+      except Exception: # pylint: disable=broad-except
+        # Only requests that fail on their own get the error, not their neighbours
+        for r in batch:
+          if r.poses_3d is None:
+            self._predict_alone( r )
+      finally:
+        for r in batch:
+          r.done.set()
+
+  def _predict(self, batch):
+    poses_3d = self.engine.predict( np.vstack( [r.poses_2d for r in batch] ))
+    start = 0
+    for r in batch:
+      end = start + r.poses_2d.shape[0]
+      r.poses_3d = poses_3d[start:end]
+      start = end
+
+  def _predict_alone(self, request):
+    try:
+      request.poses_3d = self.engine.predict( request.poses_2d )
+    except Exception as e: # pylint: disable=broad-except
+      request.error = e
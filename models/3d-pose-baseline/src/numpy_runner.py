@@ -0,0 +1,157 @@
+"""Forward passes of exported pose lifting models, with NumPy only
+
+Models are exported (see export_model.py for LinearModel checkpoints and
+../../mhrl_export.py for mhrl ones) to a single .npz file holding the
+weights of every dense layer, with batch normalization and max-norm clipping
+already folded into them, and a json description of how the layers connect:
+
+  input:  the first dense layer
+  blocks: blocks of dense layers, each optionally wrapped by a residual
+          connection from the input of the block to its output
+  output: the last dense layer
+
+Every dense layer is {"w": name, "b": name, "relu": bool}, where the names
+are arrays in the .npz file. The file may also hold the normalization
+statistics of the model, so that pixel-space 2d poses can be lifted directly.
+
+Nothing here imports TensorFlow or Keras, so the runner can be used where they
+are not installed, and starts in a fraction of the time it takes to import them.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import numpy as np
+
+EXPORT_VERSION = 1
+
+# Statistics that, if present, let NumpyModel.lift work on unnormalized poses:
+# the mean and std of every 2d and 3d dimension, and the dimensions the model
+# takes and predicts
+NORM_STATS_KEYS = ['mean_2d', 'std_2d', 'dim_to_use_2d', 'mean_3d', 'std_3d', 'dim_to_use_3d']
+
+
+def save_model( path, spec, weights, norm_stats=None ):
+  """
+  Save an exported model
+
+  Args
+    path: string. .npz file to write
+    spec: dictionary with the input, blocks and output layers, as described above
+    weights: dictionary of name -> array of every weight named in spec
+    norm_stats: optional dictionary with the NORM_STATS_KEYS arrays
+  """
+  arrays = {name: np.asarray( w, dtype=np.float32 ) for name, w in weights.items()}
+  if norm_stats is not None:
+    for key in NORM_STATS_KEYS:
+      arrays[ 'norm_' + key ] = np.asarray( norm_stats[ key ] )
+  spec = dict( spec, version=EXPORT_VERSION )
+  np.savez( path, spec=np.array( json.dumps( spec )), **arrays )
+
+
+class NumpyModel(object):
+  """ A model exported with save_model """
+
+  def __init__( self, path, batch_size=1024 ):
+    """
+    Args
+      path: string. .npz file written by save_model
+      batch_size: integer. Largest number of rows run through the model at
+        once. The activations of every layer are preallocated for this many
+        rows and reused across batches
+    """
+    with np.load( path ) as f:
+      arrays = {name: f[name] for name in f.files}
+
+    self.spec = json.loads( str( arrays.pop( 'spec' )))
+    assert self.spec['version'] == EXPORT_VERSION, \
+      "{0} was exported with version {1}, expected {2}".format( path, self.spec['version'], EXPORT_VERSION )
+
+    self.norm_stats = None
+    if 'norm_mean_2d' in arrays:
+      self.norm_stats = {key: arrays.pop( 'norm_' + key ) for key in NORM_STATS_KEYS}
+
+    def layer( l ):
+      return (np.ascontiguousarray( arrays[ l['w'] ], dtype=np.float32 ),
+              np.ascontiguousarray( arrays[ l['b'] ], dtype=np.float32 ), l['relu'])
+
+    self.input_layer  = layer( self.spec['input'] )
+    self.blocks       = [([layer( l ) for l in b['layers']], b['residual']) for b in self.spec['blocks']]
+    self.output_layer = layer( self.spec['output'] )
+
+    self.input_size  = self.input_layer[0].shape[0]
+    self.output_size = self.output_layer[0].shape[1]
+
+    # One activation buffer per hidden layer, so that residual inputs are never
+    # overwritten. The output layer writes straight into the returned array
+    self.batch_size = batch_size
+    self.input_buffer = np.empty( (batch_size, self.input_size), dtype=np.float32 )
+    self.buffers = [np.empty( (batch_size, self.input_layer[0].shape[1]), dtype=np.float32 )]
+    for layers, _ in self.blocks:
+      for w, _, _ in layers:
+        self.buffers.append( np.empty( (batch_size, w.shape[1]), dtype=np.float32 ))
+
+  def forward( self, x ):
+    """
+    Run the model on a batch of normalized inputs
+
+    Args
+      x: nx(input size) array of normalized inputs
+    Returns
+      y: nx(output size) float32 array of normalized outputs
+    """
+    def dense( x, layer, out ):
+      w, b, relu = layer
+      np.dot( x, w, out=out )
+      out += b
+      if relu:
+        np.maximum( out, 0, out=out )
+      return out
+
+    x = np.asarray( x )
+    y = np.empty( (x.shape[0], self.output_size), dtype=np.float32 )
+
+    for start in range( 0, x.shape[0], self.batch_size ):
+      stop = min( start + self.batch_size, x.shape[0] )
+      n = stop - start
+
+      # Row slices of the C-ordered buffers are contiguous, as np.dot(out=) needs
+      h = self.input_buffer[:n]
+      h[:] = x[start:stop]
+      buffers = iter( self.buffers )
+
+      h = dense( h, self.input_layer, next( buffers )[:n] )
+      for layers, residual in self.blocks:
+        xin = h
+        for layer in layers:
+          h = dense( h, layer, next( buffers )[:n] )
+        if residual:
+          h += xin
+
+      dense( h, self.output_layer, y[start:stop] )
+
+    return y
+
+  def lift( self, poses_2d ):
+    """
+    Lift unnormalized 2d poses with the exported normalization statistics
+
+    Args
+      poses_2d: nxd array of 2d poses, in the layout the model was trained on
+    Returns
+      poses_3d: nxD array of 3d poses. Dimensions the model does not predict
+        are set to their mean
+    """
+    assert self.norm_stats is not None, "The model was exported without normalization statistics"
+    s = self.norm_stats
+
+    d2, d3 = s['dim_to_use_2d'], s['dim_to_use_3d']
+    x = (np.asarray( poses_2d )[:, d2] - s['mean_2d'][d2]) / s['std_2d'][d2]
+    y = self.forward( x )
+
+    poses_3d = np.empty( (y.shape[0], s['mean_3d'].shape[0]), dtype=np.float32 )
+    poses_3d[:] = s['mean_3d']
+    poses_3d[:, d3] += y * s['std_3d'][d3]
+    return poses_3d
@@ -0,0 +1,182 @@
+"""Single-file archive of the per-sequence h5 files of human3.6m
+
+The data directory holds hundreds of small h5 files, one per sequence, which
+are slow to glob and open one by one (especially on network filesystems).
+This packs all of them into one h5 file with one contiguous dataset per kind
+of data and an index of the rows of every sequence. Reads of many sequences
+then go through a single open file, in parallel threads.
+
+Usage:
+  python pose_archive.py [data_dir]
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import glob
+import json
+import fnmatch
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import h5py
+
+ARCHIVE_NAME = 'h36m_poses.h5'
+ARCHIVE_VERSION = 1
+
+# Kind of data -> (directory of the files inside S<subject>/, dataset in each file)
+KINDS = {
+  '2d': ('MyPoses/2D_positions', '2D_positions'),
+  '3d': ('MyPoses/3D_positions', '3D_positions'),
+  'sh': ('StackedHourglass', 'poses'),
+}
+
+SUBJECT_IDS = [1,5,6,7,8,9,11]
+
+def read_sequence_file( fname, kind ):
+  """
+  Read the poses of one sequence file
+
+  Args
+    fname: string. Path of the h5 file
+    kind: string. Kind of data in the file, one of KINDS
+  Returns
+    poses: array with one row (or leading entry) per frame. The MyPoses files
+      store frames along the columns, so they are transposed here
+  """
+  with h5py.File( fname, 'r' ) as h5f:
+    poses = h5f[ KINDS[kind][1] ][:]
+  return poses.T if kind in ['2d', '3d'] else poses
+
+def build_archive( data_dir, archive_path=None, subjects=SUBJECT_IDS ):
+  """
+  Pack the sequence files of every subject into one archive. The archive is
+  written to a temporary file first and renamed into place.
+
+  Args
+    data_dir: string. Directory with the S<subject> directories
+    archive_path: string. Where to write the archive. Defaults to
+      <data_dir>/ARCHIVE_NAME, which is where load_data looks for it
+    subjects: list of integers. Subjects to pack
+  """
+  archive_path = archive_path or os.path.join( data_dir, ARCHIVE_NAME )
+  tmp_path = archive_path + '.tmp'
+
+  with h5py.File( tmp_path, 'w' ) as out:
+    out.attrs['version'] = ARCHIVE_VERSION
+
+    for kind in sorted( KINDS.keys() ):
+      subdir = KINDS[kind][0]
+      files = [(subj, fname) for subj in subjects
+               for fname in sorted( glob.glob( os.path.join( data_dir, 'S{0}'.format(subj), subdir, '*.h5' )))]
+      if len( files ) == 0:
+        print( "No {0} files found, skipping".format( subdir ))
+        continue
+
+      # First pass over the headers only, to lay out the rows of every sequence
+      index, start, frame_shape = [], 0, None
+      for subj, fname in files:
+        with h5py.File( fname, 'r' ) as h5f:
+          shape = h5f[ KINDS[kind][1] ].shape
+        shape = shape[::-1] if kind in ['2d', '3d'] else shape
+        assert frame_shape is None or shape[1:] == frame_shape, "Inconsistent shape in {0}".format( fname )
+        frame_shape = shape[1:]
+        index.append( [subj, os.path.basename( fname ), start, start + shape[0]] )
+        start = start + shape[0]
+
+      # Contiguous and uncompressed, so that readers can memory-map it
+      dset = out.create_dataset( kind, shape=(start,) + frame_shape, dtype=np.float64 )
+      dset.attrs['index'] = json.dumps( index )
+
+      for (subj, fname), (_, _, start, end) in zip( files, index ):
+        dset[start:end] = read_sequence_file( fname, kind )
+
+      print( "Packed {0} {1} sequences, {2} frames".format( len( files ), kind, dset.shape[0] ))
+
+  os.rename( tmp_path, archive_path )
+
+
+class PoseArchive(object):
+  """
+  Read access to an archive written by build_archive. Datasets are
+  memory-mapped when possible, and read through h5py otherwise.
+  """
+
+  def __init__( self, archive_path ):
+    self.archive_path = archive_path
+    self.h5f = h5py.File( archive_path, 'r' )
+    assert self.h5f.attrs['version'] == ARCHIVE_VERSION, \
+      "Archive {0} has version {1}, expected {2}. Rebuild it".format(
+        archive_path, self.h5f.attrs['version'], ARCHIVE_VERSION )
+
+    self.index = {}
+    self.arrays = {}
+    for kind in self.h5f.keys():
+      dset = self.h5f[ kind ]
+      self.index[ kind ] = {(subj, name): (start, end) for subj, name, start, end in json.loads( dset.attrs['index'] )}
+      self.arrays[ kind ] = self._memmap( dset )
+
+  def _memmap( self, dset ):
+    offset = dset.id.get_offset()
+    if offset is None or dset.chunks is not None or dset.compression is not None:
+      return dset
+    return np.memmap( self.archive_path, mode='r', dtype=dset.dtype, shape=dset.shape, offset=offset )
+
+  def close( self ):
+    self.arrays = {}
+    self.h5f.close()
+
+  def glob( self, kind, subj, pattern ):
+    """Names of the sequence files of a subject that match a glob pattern"""
+    return [name for (s, name) in self.index[ kind ].keys()
+            if s == subj and fnmatch.fnmatchcase( name, pattern )]
+
+  def read( self, kind, requests, num_threads=8 ):
+    """
+    Read many sequences in parallel
+
+    Args
+      kind: string. Kind of data, one of KINDS
+      requests: dictionary of key -> (subject, sequence file name)
+      num_threads: integer. Number of reader threads
+    Returns
+      data: dictionary of key -> poses of that sequence
+    """
+    keys = list( requests.keys() )
+    arr = self.arrays[ kind ]
+
+    def read_one( key ):
+      start, end = self.index[ kind ][ requests[key] ]
+      return np.array( arr[start:end] )
+
+    if isinstance( arr, np.memmap ) and num_threads > 1 and len( keys ) > 1:
+      pool = ThreadPool( min( num_threads, len( keys )))
+      try:
+        poses = pool.map( read_one, keys )
+      finally:
+        pool.close()
+    else:
+      # h5py serializes reads anyway
+      poses = [read_one( key ) for key in keys]
+
+    return dict( zip( keys, poses ))
+
+
+def open_archive( data_dir, kind ):
+  """The archive of data_dir, or None if it has not been built or lacks kind"""
+  archive_path = os.path.join( data_dir, ARCHIVE_NAME )
+  if not os.path.isfile( archive_path ):
+    return None
+
+  archive = PoseArchive( archive_path )
+  if kind not in archive.index:
+    archive.close()
+    return None
+  return archive
+
+
+if __name__ == "__main__":
+  build_archive( sys.argv[1] if len( sys.argv ) > 1 else 'data/h36m/' )
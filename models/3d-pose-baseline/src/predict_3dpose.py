@@ -12,6 +12,7 @@ import sys
 import time
 import h5py
 import copy
+import multiprocessing
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -23,6 +24,9 @@ import viz
 import cameras
 import data_utils
 import linear_model
+import batch_pipeline
+import data_parallel
+import profiling
 
 tf.app.flags.DEFINE_float("learning_rate", 1e-3, "Learning rate")
 tf.app.flags.DEFINE_float("dropout", 1, "Dropout keep probability. 1 means no dropout")
@@ -50,15 +54,25 @@ tf.app.flags.DEFINE_boolean("evaluateActionWise",False, "The dataset to use eith
 tf.app.flags.DEFINE_string("cameras_path","data/h36m/cameras.h5","Directory to load camera parameters")
 tf.app.flags.DEFINE_string("data_dir",   "data/h36m/", "Data directory")
 tf.app.flags.DEFINE_string("train_dir", "experiments", "Training directory.")
+tf.app.flags.DEFINE_string("cache_dir", None, "Directory to cache preprocessed data in. Defaults to <data_dir>/cache. Empty to disable caching")
 
 # Train or load
 tf.app.flags.DEFINE_boolean("sample", False, "Set to True for sampling.")
 tf.app.flags.DEFINE_boolean("use_cpu", False, "Whether to use the CPU")
 tf.app.flags.DEFINE_integer("load", 0, "Try to load a previous checkpoint.")
+tf.app.flags.DEFINE_integer("num_workers", 1, "Number of processes to train on the CPU with, synchronously averaging their gradients. "
+  "Each one trains on batch_size / num_workers examples of every batch (batch_size must be a multiple of it), "
+  "so steps and learning rate decay match a single process, but batch normalization uses the statistics of "
+  "these smaller sub-batches")
 
 # Misc
 tf.app.flags.DEFINE_boolean("use_fp16", False, "Train using fp16 instead of fp32.")
 
+# Profiling
+tf.app.flags.DEFINE_integer("profile_start", -1, "First training step to run cProfile on. Negative not to profile")
+tf.app.flags.DEFINE_integer("profile_steps", 100, "Number of training steps to profile")
+tf.app.flags.DEFINE_boolean("trace", False, "Also save tensorflow traces of the profiled steps")
+
 FLAGS = tf.app.flags.FLAGS
 
 train_dir = os.path.join( FLAGS.train_dir,
@@ -82,22 +96,24 @@ summaries_dir = os.path.join( train_dir, "log" ) # Directory for TB summaries
 # To avoid race conditions: https://github.com/tensorflow/tensorflow/issues/7448
 os.system('mkdir -p {}'.format(summaries_dir))
 
-def create_model( session, actions, batch_size ):
+def get_cache_dir():
+  """The cache directory of --cache_dir, by default in the directory of the data it caches"""
+  if FLAGS.cache_dir is None:
+    return os.path.join( FLAGS.data_dir, "cache" )
+  return FLAGS.cache_dir
+
+
+def build_model( batch_size, summaries=True ):
   """
-  Create model and initialize it or load its parameters in a session
+  Create the model in the default graph, without initializing it
 
   Args
-    session: tensorflow session
-    actions: list of string. Actions to train/test on
     batch_size: integer. Number of examples in each batch
+    summaries: boolean. Whether the model writes summaries to summaries_dir
   Returns
-    model: The created (or loaded) model
-  Raises
-    ValueError if asked to load a model, but the checkpoint specified by
-    FLAGS.load cannot be found.
+    model: The created model
   """
-
-  model = linear_model.LinearModel(
+  return linear_model.LinearModel(
       FLAGS.linear_size,
       FLAGS.num_layers,
       FLAGS.residual,
@@ -105,10 +121,27 @@ def create_model( session, actions, batch_size ):
       FLAGS.max_norm,
       batch_size,
       FLAGS.learning_rate,
-      summaries_dir,
+      summaries_dir if summaries else None,
       FLAGS.predict_14,
       dtype=tf.float16 if FLAGS.use_fp16 else tf.float32)
 
+def create_model( session, actions, batch_size ):
+  """
+  Create model and initialize it or load its parameters in a session
+
+  Args
+    session: tensorflow session
+    actions: list of string. Actions to train/test on
+    batch_size: integer. Number of examples in each batch
+  Returns
+    model: The created (or loaded) model
+  Raises
+    ValueError if asked to load a model, but the checkpoint specified by
+    FLAGS.load cannot be found.
+  """
+
+  model = build_model( batch_size )
+
   if FLAGS.load <= 0:
     # Create a new model from scratch
     print("Creating model with fresh parameters.")
@@ -157,19 +190,52 @@ def train():
   if FLAGS.use_sh:
     train_set_2d, test_set_2d, data_mean_2d, data_std_2d, dim_to_ignore_2d, dim_to_use_2d = data_utils.read_2d_predictions(actions, FLAGS.data_dir)
   else:
-    train_set_2d, test_set_2d, data_mean_2d, data_std_2d, dim_to_ignore_2d, dim_to_use_2d = data_utils.create_2d_data( actions, FLAGS.data_dir, rcams )
+    train_set_2d, test_set_2d, data_mean_2d, data_std_2d, dim_to_ignore_2d, dim_to_use_2d = data_utils.create_2d_data( actions, FLAGS.data_dir, rcams, get_cache_dir() )
   print( "done reading and normalizing data." )
 
+  # Keep what is needed to run the trained model on new data (see inference_server.py)
+  data_utils.save_normalization_stats( os.path.join( train_dir, data_utils.NORM_STATS_FILE ),
+    data_mean_2d, data_std_2d, dim_to_ignore_2d, dim_to_use_2d,
+    data_mean_3d, data_std_3d, dim_to_ignore_3d, dim_to_use_3d )
+  linear_model.save_model_config( train_dir,
+    linear_size=FLAGS.linear_size,
+    num_layers=FLAGS.num_layers,
+    residual=FLAGS.residual,
+    batch_norm=FLAGS.batch_norm,
+    max_norm=FLAGS.max_norm,
+    predict_14=FLAGS.predict_14,
+    use_fp16=FLAGS.use_fp16,
+    camera_frame=FLAGS.camera_frame,
+    use_sh=FLAGS.use_sh )
+
+  # Stack the training data once; every epoch only reshuffles an index
+  train_inputs, train_outputs = batch_pipeline.stack_data( train_set_2d, train_set_3d, FLAGS.camera_frame )
+
   # Avoid using the GPU if requested
   device_count = {"GPU": 0} if FLAGS.use_cpu else {"GPU": 1}
-  with tf.Session(config=tf.ConfigProto(
-    device_count=device_count,
-    allow_soft_placement=True )) as sess:
+  session_config = tf.ConfigProto( device_count=device_count, allow_soft_placement=True )
+
+  trainer = None
+  if FLAGS.num_workers > 1:
+    # Data-parallel training on the CPU, with the cores split between the
+    # workers. They must be forked before any session exists
+    session_config = tf.ConfigProto( device_count={"GPU": 0}, allow_soft_placement=True,
+      intra_op_parallelism_threads=max( 1, multiprocessing.cpu_count() // FLAGS.num_workers ),
+      inter_op_parallelism_threads=1 )
+    trainer = data_parallel.DataParallelTrainer( FLAGS.num_workers, build_model,
+      train_inputs, train_outputs, FLAGS.batch_size, FLAGS.dropout, session_config )
+    trainer.start( FLAGS.epochs )
+    print("Training with {0} data-parallel workers".format( FLAGS.num_workers ))
+
+  with tf.Session(config=session_config) as sess, data_parallel.running( trainer ):
 
     # === Create the model ===
     print("Creating %d bi-layers of %d units." % (FLAGS.num_layers, FLAGS.linear_size))
     model = create_model( sess, actions, FLAGS.batch_size )
     model.train_writer.add_graph( sess.graph )
+    if trainer is not None:
+      trainer.attach( model )
+      trainer.broadcast_variables( sess )
     print("Model created")
 
     #=== This is the training loop ===
@@ -181,34 +247,63 @@ def train():
     current_epoch = 0
     log_every_n_batches = 100
 
+    # Per-phase timings, in <summaries_dir>/timings.jsonl and tensorboard
+    profiler = profiling.TrainingProfiler( os.path.join( summaries_dir, 'timings.jsonl' ),
+      model.train_writer, log_every_n_batches, FLAGS.profile_start, FLAGS.profile_steps,
+      trace=FLAGS.trace )
+    samples_per_step = FLAGS.batch_size
+
     for _ in xrange( FLAGS.epochs ):
       current_epoch = current_epoch + 1
 
       # === Load training batches for one epoch ===
-      encoder_inputs, decoder_outputs = model.get_all_batches( train_set_2d, train_set_3d, FLAGS.camera_frame, training=True )
-      nbatches = len( encoder_inputs )
+      if trainer is None:
+        batches = model.get_batch_iterator( train_inputs, train_outputs, training=True )
+      else:
+        # This worker's sub-batch of every batch of the epoch
+        batches = trainer.get_batch_iterator( current_epoch - 1 )
+      nbatches = len( batches )
       print("There are {0} train batches".format( nbatches ))
       start_time, loss = time.time(), 0.
 
       # === Loop through all the training batches ===
-      for i in range( nbatches ):
+      batch_iterator = iter( batches )
+      for i in xrange( nbatches ):
+        profiler.begin_step( current_step )
+
+        # Time spent waiting for the input pipeline
+        with profiler.phase( 'batch' ):
+          enc_in, dec_out = next( batch_iterator )
 
         if (i+1) % log_every_n_batches == 0:
           # Print progress every log_every_n_batches batches
           print("Working on epoch {0}, batch {1} / {2}... ".format( current_epoch, i+1, nbatches), end="" )
 
-        enc_in, dec_out = encoder_inputs[i], decoder_outputs[i]
-        step_loss, loss_summary, lr_summary, _ =  model.step( sess, enc_in, dec_out, FLAGS.dropout, isTraining=True )
+        # Feeding the batch happens inside session.run, so it is part of the
+        # step; its share can be read from the traces of --trace
+        options, run_metadata = profiler.run_options( current_step )
+        with profiler.phase( 'step' ):
+          if trainer is None:
+            step_loss, loss_summary, lr_summary, _ =  model.step( sess, enc_in, dec_out, FLAGS.dropout, isTraining=True,
+              options=options, run_metadata=run_metadata )
+          else:
+            step_loss, loss_summary, lr_summary = trainer.step( sess, enc_in, dec_out, options, run_metadata )
+        if trainer is not None:
+          # Part of the step spent exchanging gradients with the other workers
+          profiler.add( 'exchange', trainer.last_exchange_time )
 
         if (i+1) % log_every_n_batches == 0:
           # Log and print progress every log_every_n_batches batches
-          model.train_writer.add_summary( loss_summary, current_step )
-          model.train_writer.add_summary( lr_summary, current_step )
+          with profiler.phase( 'summary' ):
+            model.train_writer.add_summary( loss_summary, current_step )
+            model.train_writer.add_summary( lr_summary, current_step )
           step_time = (time.time() - start_time)
           start_time = time.time()
           print("done in {0:.2f} ms".format( 1000*step_time / log_every_n_batches ) )
 
         loss += step_loss
+        profiler.end_step( current_step, samples_per_step )
+        profiler.save_trace( current_step, run_metadata )
         current_step += 1
         # === end looping through training batches ===
 
@@ -223,6 +318,7 @@ def train():
 
       # === Testing after this epoch ===
       isTraining = False
+      evaluation_start = time.time()
 
       if FLAGS.evaluateActionWise:
 
@@ -275,17 +371,24 @@ def train():
         summaries = sess.run( model.err_mm_summary, {model.err_mm: total_err} )
         model.test_writer.add_summary( summaries, current_step )
 
+      profiler.add( 'evaluation', time.time() - evaluation_start, per_step=False )
+
       # Save the model
       print( "Saving the model... ", end="" )
       start_time = time.time()
       model.saver.save(sess, os.path.join(train_dir, 'checkpoint'), global_step=current_step )
+      profiler.add( 'checkpoint', time.time() - start_time, per_step=False )
       print( "done in {0:.2f} ms".format(1000*(time.time() - start_time)) )
 
+      profiler.end_epoch( current_epoch, current_step )
+
       # Reset global time and loss
       step_time, loss = 0, 0
 
       sys.stdout.flush()
 
+    profiler.close()
+
 
 def get_action_subset( poses_set, action ):
   """
@@ -336,8 +439,8 @@ def evaluate_batches( sess, model,
   n_joints = 17 if not(FLAGS.predict_14) else 14
   nbatches = len( encoder_inputs )
 
-  # Loop through test examples
-  all_dists, start_time, loss = [], time.time(), 0.
+  # Run the model over all the batches, keeping its normalized outputs
+  all_poses3d, start_time, loss = [], time.time(), 0.
   log_every_n_batches = 100
   for i in range(nbatches):
 
@@ -348,47 +451,28 @@ def evaluate_batches( sess, model,
     dp = 1.0 # dropout keep probability is always 1 at test time
     step_loss, loss_summary, poses3d = model.step( sess, enc_in, dec_out, dp, isTraining=False )
     loss += step_loss
+    all_poses3d.append( poses3d )
 
-    # denormalize
-    enc_in  = data_utils.unNormalizeData( enc_in,  data_mean_2d, data_std_2d, dim_to_ignore_2d )
-    dec_out = data_utils.unNormalizeData( dec_out, data_mean_3d, data_std_3d, dim_to_ignore_3d )
-    poses3d = data_utils.unNormalizeData( poses3d, data_mean_3d, data_std_3d, dim_to_ignore_3d )
-
-    # Keep only the relevant dimensions
-    dtu3d = np.hstack( (np.arange(3), dim_to_use_3d) ) if not(FLAGS.predict_14) else  dim_to_use_3d
-
-    dec_out = dec_out[:, dtu3d]
-    poses3d = poses3d[:, dtu3d]
-
-    assert dec_out.shape[0] == FLAGS.batch_size
-    assert poses3d.shape[0] == FLAGS.batch_size
-
-    if FLAGS.procrustes:
-      # Apply per-frame procrustes alignment if asked to do so
-      for j in range(FLAGS.batch_size):
-        gt  = np.reshape(dec_out[j,:],[-1,3])
-        out = np.reshape(poses3d[j,:],[-1,3])
-        _, Z, T, b, c = procrustes.compute_similarity_transform(gt,out,compute_optimal_scale=True)
-        out = (b*out.dot(T))+c
+  step_time = (time.time() - start_time) / nbatches
+  loss      = loss / nbatches
 
-        poses3d[j,:] = np.reshape(out,[-1,17*3] ) if not(FLAGS.predict_14) else np.reshape(out,[-1,14*3] )
+  # Denormalize the whole test set at once
+  unnormalize_3d = data_utils.Denormalizer( data_mean_3d, data_std_3d, dim_to_ignore_3d )
+  dec_out = unnormalize_3d( np.vstack( decoder_outputs ) )
+  poses3d = unnormalize_3d( np.vstack( all_poses3d ) )
 
-    # Compute Euclidean distance error per joint
-    sqerr = (poses3d - dec_out)**2 # Squared error between prediction and expected output
-    dists = np.zeros( (sqerr.shape[0], n_joints) ) # Array with L2 error per joint in mm
-    dist_idx = 0
-    for k in np.arange(0, n_joints*3, 3):
-      # Sum across X,Y, and Z dimenstions to obtain L2 distance
-      dists[:,dist_idx] = np.sqrt( np.sum( sqerr[:, k:k+3], axis=1 ))
-      dist_idx = dist_idx + 1
+  # Keep only the relevant dimensions
+  dtu3d = np.hstack( (np.arange(3), dim_to_use_3d) ) if not(FLAGS.predict_14) else  dim_to_use_3d
 
-    all_dists.append(dists)
-    assert sqerr.shape[0] == FLAGS.batch_size
+  dec_out = np.reshape( dec_out[:, dtu3d], [-1, n_joints, 3] )
+  poses3d = np.reshape( poses3d[:, dtu3d], [-1, n_joints, 3] )
 
-  step_time = (time.time() - start_time) / nbatches
-  loss      = loss / nbatches
+  if FLAGS.procrustes:
+    # Apply per-frame procrustes alignment if asked to do so
+    _, poses3d, _, _, _ = procrustes.compute_similarity_transform_batch(dec_out,poses3d,compute_optimal_scale=True)
 
-  all_dists = np.vstack( all_dists )
+  # Euclidean distance error per joint, in mm
+  all_dists = np.sqrt( np.sum( (poses3d - dec_out)**2, axis=2 ) )
 
   # Error per joint and total for all passed batches
   joint_err = np.mean( all_dists, axis=0 )
@@ -413,7 +497,7 @@ def sample():
   if FLAGS.use_sh:
     train_set_2d, test_set_2d, data_mean_2d, data_std_2d, dim_to_ignore_2d, dim_to_use_2d = data_utils.read_2d_predictions(actions, FLAGS.data_dir)
   else:
-    train_set_2d, test_set_2d, data_mean_2d, data_std_2d, dim_to_ignore_2d, dim_to_use_2d = data_utils.create_2d_data( actions, FLAGS.data_dir, rcams )
+    train_set_2d, test_set_2d, data_mean_2d, data_std_2d, dim_to_ignore_2d, dim_to_use_2d = data_utils.create_2d_data( actions, FLAGS.data_dir, rcams, get_cache_dir() )
   print( "done reading and normalizing data." )
 
   device_count = {"GPU": 0} if FLAGS.use_cpu else {"GPU": 1}
@@ -424,6 +508,9 @@ def sample():
     model = create_model(sess, actions, batch_size)
     print("Model loaded")
 
+    unnormalize_2d = data_utils.Denormalizer( data_mean_2d, data_std_2d, dim_to_ignore_2d )
+    unnormalize_3d = data_utils.Denormalizer( data_mean_3d, data_std_3d, dim_to_ignore_3d )
+
     for key2d in test_set_2d.keys():
 
       (subj, b, fname) = key2d
@@ -451,9 +538,9 @@ def sample():
         _, _, poses3d = model.step(sess, enc_in[bidx], dec_out[bidx], dp, isTraining=False)
 
         # denormalize
-        enc_in[bidx]  = data_utils.unNormalizeData(  enc_in[bidx], data_mean_2d, data_std_2d, dim_to_ignore_2d )
-        dec_out[bidx] = data_utils.unNormalizeData( dec_out[bidx], data_mean_3d, data_std_3d, dim_to_ignore_3d )
-        poses3d = data_utils.unNormalizeData( poses3d, data_mean_3d, data_std_3d, dim_to_ignore_3d )
+        enc_in[bidx]  = unnormalize_2d( enc_in[bidx] )
+        dec_out[bidx] = unnormalize_3d( dec_out[bidx] )
+        poses3d = unnormalize_3d( poses3d )
         all_poses_3d.append( poses3d )
 
       # Put all the poses together
@@ -465,7 +552,8 @@ def sample():
         N_JOINTS_H36M = 32
 
         # Add global position back
-        dec_out = dec_out + np.tile( test_root_positions[ key3d ], [1,N_JOINTS_H36M] )
+        dec_out = dec_out.reshape( (-1, N_JOINTS_H36M, 3) ) + test_root_positions[ key3d ][:,np.newaxis,:]
+        dec_out = dec_out.reshape( (-1, N_JOINTS_H36M*3) )
 
         # Load the appropriate camera
         subj, _, sname = key3d
@@ -478,10 +566,12 @@ def sample():
         assert name == cname
 
         def cam2world_centered(data_3d_camframe):
-          data_3d_worldframe = cameras.camera_to_world_frame(data_3d_camframe.reshape((-1, 3)), R, T)
-          data_3d_worldframe = data_3d_worldframe.reshape((-1, N_JOINTS_H36M*3))
+          # read_3d_data transformed the poses with the no-tilt cameras
+          data_3d_worldframe = rcams.camera_to_world(data_3d_camframe.reshape((-1, 3)), (subj, scam_idx+1), experimental=True)
+          data_3d_worldframe = data_3d_worldframe.reshape((-1, N_JOINTS_H36M, 3))
           # subtract root translation
-          return data_3d_worldframe - np.tile( data_3d_worldframe[:,:3], (1,N_JOINTS_H36M) )
+          data_3d_worldframe -= data_3d_worldframe[:,:1,:].copy()
+          return data_3d_worldframe.reshape((-1, N_JOINTS_H36M*3))
 
         # Apply inverse rotation and translation
         dec_out = cam2world_centered(dec_out)
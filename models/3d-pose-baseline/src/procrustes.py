@@ -61,3 +61,69 @@ def compute_similarity_transform(X, Y, compute_optimal_scale=False):
   c = muX - b*np.dot(muY, T)
 
   return d, Z, T, b, c
+
+
+def compute_similarity_transform_batch(X, Y, compute_optimal_scale=False):
+  """
+  Batched compute_similarity_transform. Aligns every pose in Y to the pose at
+  the same index in X, with a single stacked SVD for the whole batch.
+
+  Args
+    X: array BxNxM of targets, with B number of poses, N number of points and
+      M point dimensionality
+    Y: array BxNxM of inputs
+    compute_optimal_scale: whether we compute optimal scale or force it to be 1
+
+  Returns:
+    d: array B of squared errors after transformation
+    Z: array BxNxM of transformed Y
+    T: array BxMxM of computed rotations
+    b: array B of scalings
+    c: array BxM of translations
+  """
+  import numpy as np
+
+  muX = X.mean(1, keepdims=True)
+  muY = Y.mean(1, keepdims=True)
+
+  X0 = X - muX
+  Y0 = Y - muY
+
+  ssX = (X0**2.).sum(axis=(1,2))
+  ssY = (Y0**2.).sum(axis=(1,2))
+
+  # centred Frobenius norm
+  normX = np.sqrt(ssX)
+  normY = np.sqrt(ssY)
+
+  # scale to equal (unit) norm
+  X0 = X0 / normX[:,None,None]
+  Y0 = Y0 / normY[:,None,None]
+
+  # optimum rotation matrix of Y
+  A = np.matmul(np.transpose(X0, (0,2,1)), Y0)
+  U,s,Vt = np.linalg.svd(A,full_matrices=False)
+  V = np.transpose(Vt, (0,2,1))
+  Ut = np.transpose(U, (0,2,1))
+  T = np.matmul(V, Ut)
+
+  # Make sure we have a rotation
+  signT = np.sign( np.linalg.det(T) )
+  V[:,:,-1] *= signT[:,None]
+  s[:,-1]   *= signT
+  T = np.matmul(V, Ut)
+
+  traceTA = s.sum(1)
+
+  if compute_optimal_scale:  # Compute optimum scaling of Y.
+    b = traceTA * normX / normY
+    d = 1 - traceTA**2
+    Z = (normX*traceTA)[:,None,None]*np.matmul(Y0, T) + muX
+  else:  # If no scaling allowed
+    b = np.ones_like(normX)
+    d = 1 + ssY/ssX - 2 * traceTA * normY / normX
+    Z = normY[:,None,None]*np.matmul(Y0, T) + muX
+
+  c = muX[:,0] - b[:,None]*np.matmul(muY, T)[:,0]
+
+  return d, Z, T, b, c
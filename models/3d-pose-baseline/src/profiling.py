@@ -0,0 +1,191 @@
+"""Per-phase timings and throughput of a training loop
+
+The training loop wraps each of its phases (assembling a batch, running the
+step, writing summaries, ...) in TrainingProfiler.phase. Every
+log_every steps the profiler writes one json line with the mean time of each
+phase per step and the examples per second to its log, and at the end of every
+epoch one with the total time of each phase, including those that happen once
+per epoch (evaluation, saving checkpoints). The same values go to tensorboard,
+under timing/, timing_epoch/ and throughput/.
+
+For a window of steps the profiler can also run cProfile, and tell the loop
+to collect a full tensorflow trace of those steps, which is saved in the
+chrome://tracing format.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import json
+import time
+import cProfile
+import contextlib
+from collections import OrderedDict
+
+import tensorflow as tf
+
+
+class TrainingProfiler(object):
+  """ Records where the time of a training loop goes """
+
+  def __init__( self, log_path, summary_writer=None, log_every=100,
+                profile_start=-1, profile_steps=0, profile_dir=None, trace=False ):
+    """
+    Args
+      log_path: string. File where the json lines are appended
+      summary_writer: (Optional) tf.summary.FileWriter for the tensorboard summaries
+      log_every: integer. Number of steps in each logged window
+      profile_start: integer. First step to profile. Negative not to profile
+      profile_steps: integer. Number of steps to profile
+      profile_dir: string. Where the profiles are saved. Defaults to the
+        directory of log_path
+      trace: boolean. Whether to also collect tensorflow traces of the profiled steps
+    """
+    self.log_path       = log_path
+    self.summary_writer = summary_writer
+    self.log_every      = log_every
+
+    self.profile_start = profile_start
+    self.profile_end   = profile_start + profile_steps
+    self.profile_dir   = profile_dir or os.path.dirname( log_path )
+    self.trace         = trace
+    self._profile      = None
+    # First step of the window actually profiled, e.g. later than
+    # profile_start when training resumes past it
+    self._profile_first = None
+
+    if not os.path.isdir( os.path.dirname( log_path )):
+      os.makedirs( os.path.dirname( log_path ))
+    self._log = open( log_path, 'a' )
+
+    self._window = self._new_window()
+    self._epoch  = self._new_window()
+    self._step_start = None
+
+  @staticmethod
+  def _new_window():
+    return {'phases': OrderedDict(), 'steps': 0, 'samples': 0, 'start': time.time()}
+
+  @contextlib.contextmanager
+  def phase( self, name, per_step=True ):
+    """Time the enclosed block as (part of) the phase called name (see add)"""
+    start = time.time()
+    try:
+      yield
+    finally:
+      self.add( name, time.time() - start, per_step )
+
+  def add( self, name, seconds, per_step=True ):
+    """
+    Account seconds to the phase called name
+
+    Args
+      name: string. Name of the phase
+      seconds: float. Time spent in the phase
+      per_step: boolean. False for phases outside of the steps (e.g. evaluation),
+        which are only logged with the epoch and left out of the step throughput
+    """
+    if per_step:
+      self._window['phases'][ name ] = self._window['phases'].get( name, 0. ) + seconds
+    else:
+      self._window['start'] += seconds
+    self._epoch['phases'][ name ] = self._epoch['phases'].get( name, 0. ) + seconds
+
+  def profiling( self, step ):
+    return self.profile_start <= step < self.profile_end
+
+  def begin_step( self, step ):
+    """Mark the start of a step, and start cProfile if the step is in the profiled window"""
+    if self.profiling( step ) and self._profile is None:
+      self._profile = cProfile.Profile()
+      self._profile.enable()
+      self._profile_first = step
+    self._step_start = time.time()
+
+  def end_step( self, step, num_samples ):
+    """
+    Mark the end of a step, and log the window if it is complete
+
+    Args
+      step: integer. The global step that just ended
+      num_samples: integer. Number of examples trained on in this step
+    """
+    if self._step_start is not None:
+      self.add( 'total', time.time() - self._step_start )
+      self._step_start = None
+
+    for window in (self._window, self._epoch):
+      window['steps']   += 1
+      window['samples'] += num_samples
+
+    if self._profile is not None and step + 1 >= self.profile_end:
+      self._profile.disable()
+      path = os.path.join( self.profile_dir, 'cprofile_{0}-{1}.prof'.format( self._profile_first, step ))
+      self._profile.dump_stats( path )
+      self._profile = None
+      print( "Saved profile of steps {0}-{1} to {2}".format( self._profile_first, step, path ))
+
+    if self._window['steps'] >= self.log_every:
+      self._write( 'steps', step, self._window )
+      self._window = self._new_window()
+
+  def run_options( self, step ):
+    """
+    Options and metadata to pass to session.run, to trace the step if asked to
+
+    Returns
+      options, run_metadata: both None if the step is not traced
+    """
+    if not (self.trace and self.profiling( step )):
+      return None, None
+    return tf.RunOptions( trace_level=tf.RunOptions.FULL_TRACE ), tf.RunMetadata()
+
+  def save_trace( self, step, run_metadata ):
+    """Save the tensorflow trace of a step, to be opened in chrome://tracing"""
+    if run_metadata is None:
+      return
+    from tensorflow.python.client import timeline
+    path = os.path.join( self.profile_dir, 'timeline_{0}.json'.format( step ))
+    with open( path, 'w' ) as f:
+      f.write( timeline.Timeline( run_metadata.step_stats ).generate_chrome_trace_format() )
+
+  def end_epoch( self, epoch, step ):
+    """Log the phases of the whole epoch, including those outside of the steps"""
+    self._write( 'epoch', step, self._epoch, epoch=epoch )
+    self._epoch = self._new_window()
+
+  def _write( self, kind, step, window, **extra ):
+    elapsed = time.time() - window['start']
+
+    record = OrderedDict( [('kind', kind), ('step', step)] )
+    record.update( extra )
+    record['steps'] = window['steps']
+    record['seconds'] = elapsed
+    record['samples_per_sec'] = window['samples'] / elapsed if elapsed > 0 else 0.
+
+    if kind == 'epoch':
+      # Total time of every phase in the epoch, e.g. of the evaluation
+      tag, phases = 'timing_epoch/{0}_ms', [(name, 1000 * seconds) for name, seconds in window['phases'].items()]
+      record['ms'] = OrderedDict( phases )
+    else:
+      # Mean time of every phase per step of the window
+      steps = max( window['steps'], 1 )
+      tag, phases = 'timing/{0}_ms', [(name, 1000 * seconds / steps) for name, seconds in window['phases'].items()]
+      record['ms_per_step'] = OrderedDict( phases )
+
+    self._log.write( json.dumps( record ) + '\n' )
+    self._log.flush()
+
+    if self.summary_writer is not None:
+      throughput_tag = 'throughput/epoch_samples_per_sec' if kind == 'epoch' else 'throughput/samples_per_sec'
+      values = [tf.Summary.Value( tag=throughput_tag, simple_value=record['samples_per_sec'] )]
+      values += [tf.Summary.Value( tag=tag.format( name ), simple_value=ms ) for name, ms in phases]
+      self.summary_writer.add_summary( tf.Summary( value=values ), step )
+
+  def close( self ):
+    if self._profile is not None:
+      self._profile.disable()
+      self._profile = None
+    self._log.close()
@@ -0,0 +1,33 @@
+import numpy as np
+
+from batch_pipeline import PrefetchingBatchIterator
+
+
+def data(n):
+  enc = np.arange( n * 2, dtype=np.float32 ).reshape( n, 2 )
+  dec = np.arange( n * 3, dtype=np.float32 ).reshape( n, 3 )
+  return enc, dec
+
+
+def test_shards_split_every_batch():
+  # The sub-batches of the data-parallel replicas make up the batches of a
+  # single process, in the same number of steps
+  enc, dec = data( 103 )
+  batch_size, num_workers = 12, 4
+  whole = PrefetchingBatchIterator( enc, dec, batch_size, seed=7 )
+  shards = [PrefetchingBatchIterator( enc, dec, batch_size // num_workers, seed=7,
+                                      num_shards=num_workers, shard_index=r ) for r in range( num_workers )]
+
+  assert all( len( shard ) == len( whole ) for shard in shards )
+  for batch, sub_batches in zip( whole, zip( *shards )):
+    np.testing.assert_array_equal( batch[0], np.concatenate( [s[0] for s in sub_batches] ))
+    np.testing.assert_array_equal( batch[1], np.concatenate( [s[1] for s in sub_batches] ))
+
+
+def test_batches_without_prefetching_match():
+  enc, dec = data( 50 )
+  prefetched = list( PrefetchingBatchIterator( enc, dec, 8, seed=3 ))
+  direct     = list( PrefetchingBatchIterator( enc, dec, 8, seed=3, prefetch=0 ))
+  assert len( prefetched ) == len( direct ) == 50 // 8
+  for a, b in zip( prefetched, direct ):
+    np.testing.assert_array_equal( a[0], b[0] )
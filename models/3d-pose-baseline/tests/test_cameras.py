@@ -0,0 +1,66 @@
+import numpy as np
+
+from cameras import project_point_radial, project_point_radial_multi, stack_cameras
+
+
+def reference_project_point_radial( P, R, T, f, c, k, p ):
+  """project_point_radial as it was before project_point_radial_multi"""
+  N = P.shape[0]
+  X = R.dot( P.T - T ) # rotate and translate
+  XX = X[:2,:] / X[2,:]
+  r2 = XX[0,:]**2 + XX[1,:]**2
+
+  radial = 1 + np.einsum( 'ij,ij->j', np.tile(k,(1, N)), np.array([r2, r2**2, r2**3]) );
+  tan = p[0]*XX[1,:] + p[1]*XX[0,:]
+
+  XXX = XX * np.tile(radial+tan,(2,1)) + np.outer(np.array([p[1], p[0]]).reshape(-1), r2 )
+
+  Proj = (f * XXX) + c
+  Proj = Proj.T
+
+  D = X[2,]
+
+  return Proj, D, radial, tan, r2
+
+
+def random_camera(rng):
+  R, _ = np.linalg.qr( rng.randn( 3, 3 ))
+  # In front of the camera: points near the origin, camera 5m away along its axis
+  T = -R.T.dot( np.array( [[0.], [0.], [5000.]] )) + rng.randn( 3, 1 ) * 100
+  f = 1100 + rng.rand( 2, 1 ) * 50
+  c = 500 + rng.rand( 2, 1 ) * 20
+  k = rng.randn( 3, 1 ) * 0.1
+  p = rng.randn( 2, 1 ) * 0.01
+  return R, T, f, c, k, p
+
+
+def test_multi_matches_original():
+  rng = np.random.RandomState( 0 )
+  P = rng.randn( 64, 3 ) * 500
+  cams = [random_camera( rng ) for _ in range( 4 )]
+
+  multi = project_point_radial_multi( P, stack_cameras( cams ))
+  for i, cam in enumerate( cams ):
+    expected = reference_project_point_radial( P, *cam )
+    for m, e in zip( multi, expected ):
+      np.testing.assert_allclose( m[i], e, rtol=1e-10, atol=1e-8 )
+
+
+def test_single_camera_matches_original():
+  rng = np.random.RandomState( 1 )
+  P = rng.randn( 32, 3 ) * 500
+  cam = random_camera( rng )
+
+  for a, e in zip( project_point_radial( P, *cam ), reference_project_point_radial( P, *cam )):
+    np.testing.assert_allclose( a, e, rtol=1e-10, atol=1e-8 )
+
+
+def test_multi_writes_into_out():
+  rng = np.random.RandomState( 2 )
+  P = rng.randn( 10, 3 ) * 500
+  cams = stack_cameras( [random_camera( rng ) for _ in range( 2 )] )
+
+  out = np.empty( (2, 10, 2) )
+  proj, _, _, _, _ = project_point_radial_multi( P, cams, out=out )
+  assert proj is out
+  np.testing.assert_allclose( out, project_point_radial_multi( P, cams )[0] )
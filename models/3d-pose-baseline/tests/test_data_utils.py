@@ -0,0 +1,40 @@
+import numpy as np
+
+import data_utils
+
+
+def poses_set(rng):
+  # Sequences of different lengths (one empty), far from zero mean, as in mm
+  lengths = [0, 1, 7, 250, 1000]
+  return {(1, 'Walking', 'seq{0}'.format( i )): rng.randn( n, 96 ) * 200 + 3000
+          for i, n in enumerate( lengths )}
+
+
+def test_mean_std_matches_stacked():
+  data = poses_set( np.random.RandomState( 0 ))
+  stacked = np.vstack( [data[k] for k in sorted( data.keys() )] )
+
+  data_mean, data_std = data_utils.mean_std( data )
+  np.testing.assert_allclose( data_mean, np.mean( stacked, axis=0 ), rtol=1e-12 )
+  np.testing.assert_allclose( data_std, np.std( stacked, axis=0 ), rtol=1e-10 )
+
+
+def test_normalization_stats_of_dict_and_array_match():
+  data = poses_set( np.random.RandomState( 1 ))
+  stacked = np.vstack( [data[k] for k in sorted( data.keys() )] )
+
+  from_dict  = data_utils.normalization_stats( data, dim=3 )
+  from_array = data_utils.normalization_stats( stacked, dim=3 )
+  for a, b in zip( from_dict, from_array ):
+    np.testing.assert_allclose( a, b, rtol=1e-10 )
+
+
+def test_normalize_data_defaults_to_float64():
+  data = poses_set( np.random.RandomState( 2 ))
+  data_mean, data_std, _, dim_to_use = data_utils.normalization_stats( data, dim=3 )
+
+  normalized = data_utils.normalize_data( data, data_mean, data_std, dim_to_use )
+  for key in data:
+    assert normalized[ key ].dtype == np.float64
+    expected = (data[ key ][:, dim_to_use] - data_mean[dim_to_use]) / data_std[dim_to_use]
+    np.testing.assert_allclose( normalized[ key ], expected, rtol=1e-12 )
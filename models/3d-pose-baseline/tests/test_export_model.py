@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip( "tensorflow" )
+
+import linear_model
+import numpy_runner
+import export_model
+
+
+def train_like_variables(sess, rng):
+  """Batch normalization statistics and parameters away from their initial values"""
+  for v in tf.global_variables():
+    shape = v.get_shape().as_list()
+    if 'moving_variance' in v.name or 'gamma' in v.name:
+      v.load( rng.rand( *shape ) + 0.5, sess )
+    elif 'moving_mean' in v.name or 'beta' in v.name:
+      v.load( rng.randn( *shape ) * 0.1, sess )
+
+
+@pytest.mark.parametrize( "batch_norm,max_norm,residual", [(True, True, True), (True, False, True),
+                                                           (False, True, False), (False, False, True)] )
+def test_folded_model_matches_graph(tmpdir, batch_norm, max_norm, residual):
+  config = {'linear_size': 32, 'num_layers': 2, 'residual': residual,
+            'batch_norm': batch_norm, 'max_norm': max_norm, 'predict_14': False}
+  rng = np.random.RandomState( 0 )
+
+  with tf.Graph().as_default():
+    model = linear_model.LinearModel( config['linear_size'], config['num_layers'], residual,
+      batch_norm, max_norm, batch_size=8, learning_rate=1e-3, summaries_dir=None )
+    with tf.Session() as sess:
+      sess.run( tf.global_variables_initializer() )
+      train_like_variables( sess, rng )
+      x = rng.randn( 50, model.input_size ).astype( np.float32 )
+      expected = model.predict( sess, x )
+      checkpoint = model.saver.save( sess, str( tmpdir.join( 'checkpoint' )))
+
+  spec, weights = export_model.export_linear_model( checkpoint, config )
+
+  # The NumPy runner, in chunks smaller than the input
+  path = str( tmpdir.join( 'model.npz' ))
+  numpy_runner.save_model( path, spec, weights )
+  np.testing.assert_allclose( numpy_runner.NumpyModel( path, batch_size=16 ).forward( x ),
+                              expected, rtol=1e-4, atol=1e-4 )
+
+  # The frozen graph
+  path = str( tmpdir.join( 'frozen_model.pb' ))
+  export_model.write_frozen_graph( spec, weights, path )
+  graph_def = tf.GraphDef()
+  with open( path, 'rb' ) as f:
+    graph_def.ParseFromString( f.read() )
+  with tf.Graph().as_default():
+    tf.import_graph_def( graph_def, name='' )
+    with tf.Session() as sess:
+      y = sess.run( 'poses3d:0', {'enc_in:0': x} )
+  np.testing.assert_allclose( y, expected, rtol=1e-4, atol=1e-4 )
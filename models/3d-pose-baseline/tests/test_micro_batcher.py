@@ -0,0 +1,70 @@
+import threading
+
+import numpy as np
+import pytest
+
+from micro_batcher import MicroBatcher, POSE_2D_SIZE
+
+
+class StubEngine(object):
+  """Returns the first three columns of every pose, and counts its calls"""
+
+  def __init__(self, fail_on=None):
+    self.calls = 0
+    self.fail_on = fail_on
+
+  def predict(self, poses_2d):
+    self.calls += 1
+    if self.fail_on is not None and np.any( poses_2d[:, 0] == self.fail_on ):
+      raise RuntimeError( "bad pose" )
+    return poses_2d[:, :3].copy()
+
+
+def poses(first, n):
+  p = np.zeros( (n, POSE_2D_SIZE) )
+  p[:, 0] = first + np.arange( n )
+  return p
+
+
+def submit_concurrently(batcher, inputs):
+  requests = [None] * len( inputs )
+  def submit(i):
+    requests[i] = batcher.submit( inputs[i] )
+  threads = [threading.Thread( target=submit, args=(i,) ) for i in range( len( inputs ))]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  return requests
+
+
+def test_concurrent_requests_get_their_own_rows():
+  engine = StubEngine()
+  batcher = MicroBatcher( engine, max_batch_size=1000, max_wait=0.2 )
+  inputs = [poses( 100 * i, i + 1 ) for i in range( 5 )]
+  requests = submit_concurrently( batcher, inputs )
+  for p, r in zip( inputs, requests ):
+    np.testing.assert_array_equal( r.result(), p[:, :3] )
+  assert engine.calls < len( inputs )
+  batcher.close()
+
+
+@pytest.mark.parametrize( "bad", [5, [1.] * POSE_2D_SIZE, [[1., 2.]]] )
+def test_malformed_poses_are_rejected_on_submit(bad):
+  batcher = MicroBatcher( StubEngine() )
+  with pytest.raises( ValueError ):
+    batcher.submit( bad )
+  # The batcher still serves valid requests
+  np.testing.assert_array_equal( batcher.predict( poses( 0, 2 )), poses( 0, 2 )[:, :3] )
+  batcher.close()
+
+
+def test_failing_request_does_not_fail_its_neighbours():
+  batcher = MicroBatcher( StubEngine( fail_on=-1 ), max_batch_size=1000, max_wait=0.2 )
+  inputs = [poses( 0, 2 ), poses( -1, 1 ), poses( 10, 3 )]
+  good, bad, other = submit_concurrently( batcher, inputs )
+  np.testing.assert_array_equal( good.result(), inputs[0][:, :3] )
+  np.testing.assert_array_equal( other.result(), inputs[2][:, :3] )
+  with pytest.raises( RuntimeError ):
+    bad.result()
+  batcher.close()
@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+from procrustes import compute_similarity_transform, compute_similarity_transform_batch
+
+
+def random_orthogonal(rng, n, proper=False):
+  q, _ = np.linalg.qr( rng.randn( n, 3, 3 ))
+  if proper:
+    # Flip the reflections into rotations
+    q[:, :, 0] *= np.sign( np.linalg.det( q ))[:, None]
+  return q
+
+
+@pytest.mark.parametrize( "compute_optimal_scale", [False, True] )
+def test_batch_matches_per_pose(compute_optimal_scale):
+  rng = np.random.RandomState( 0 )
+  X = rng.randn( 20, 17, 3 ) * 100
+  # Noisy, rotated, scaled and shifted copies, some of them reflected
+  Y = np.matmul( X, random_orthogonal( rng, 20 )) * 1.3 + rng.randn( 20, 1, 3 ) * 50 + rng.randn( 20, 17, 3 )
+
+  batch = compute_similarity_transform_batch( X, Y, compute_optimal_scale )
+  for i in range( len( X )):
+    single = compute_similarity_transform( X[i], Y[i], compute_optimal_scale )
+    for b, s in zip( batch, single ):
+      np.testing.assert_allclose( b[i], s, rtol=1e-7, atol=1e-7 )
+
+
+def test_recovers_rigid_transform():
+  rng = np.random.RandomState( 1 )
+  X = rng.randn( 5, 17, 3 )
+  Y = np.matmul( X, random_orthogonal( rng, 5, proper=True )) + rng.randn( 5, 1, 3 )
+
+  _, Z, _, _, _ = compute_similarity_transform_batch( X, Y )
+  np.testing.assert_allclose( Z, X, atol=1e-8 )
@@ -0,0 +1,33 @@
+import os
+
+import pytest
+
+pytest.importorskip( "tensorflow" )
+
+import profiling
+
+
+def run_steps(profiler, steps):
+  for step in steps:
+    profiler.begin_step( step )
+    profiler.end_step( step, 8 )
+  profiler.close()
+
+
+def test_profiles_the_window(tmpdir):
+  profiler = profiling.TrainingProfiler( str( tmpdir.join( 'timings.jsonl' )), profile_start=2, profile_steps=3 )
+  run_steps( profiler, range( 10 ))
+  assert os.path.isfile( str( tmpdir.join( 'cprofile_2-4.prof' )))
+
+
+def test_resuming_inside_the_window_profiles_the_rest(tmpdir):
+  # As when training resumes with --load past profile_start
+  profiler = profiling.TrainingProfiler( str( tmpdir.join( 'timings.jsonl' )), profile_start=2, profile_steps=5 )
+  run_steps( profiler, range( 4, 10 ))
+  assert os.path.isfile( str( tmpdir.join( 'cprofile_4-6.prof' )))
+
+
+def test_resuming_after_the_window_profiles_nothing(tmpdir):
+  profiler = profiling.TrainingProfiler( str( tmpdir.join( 'timings.jsonl' )), profile_start=2, profile_steps=3 )
+  run_steps( profiler, range( 5, 10 ))
+  assert not [f for f in os.listdir( str( tmpdir )) if f.endswith( '.prof' )]
@@ -18,17 +18,22 @@
 import os
 import sys
 import json
+import time
 import numpy as np
 
 # from keras.models import Sequential
 from keras.layers import Dense, BatchNormalization, Activation, Dropout, Add, Input
 from keras.models import Model
-from keras.callbacks import ModelCheckpoint
+from keras.callbacks import ModelCheckpoint, Callback
+import tensorflow as tf
 
 import matplotlib.pyplot as plt
 
 sys.path.insert(0, '/Users/Robert/Documents/Caltech/CS81_Depth_Research/scripts/')
-from postprocess_original_utils import correct_lean
+from postprocess_original_utils import correct_lean_store, correct_lean_rows
+from human36m_store import load_store, split_rows
+sys.path.insert(0, '/Users/Robert/Documents/Caltech/CS81_Depth_Research/models/3d-pose-baseline/src/')
+from profiling import TrainingProfiler
 
 
 ################################################################################
@@ -39,8 +44,24 @@ HUMAN_ANNOTATION_DIR  = '/Users/Robert/Documents/Caltech/CS81_Depth_Research/' \
                         'datasets/human36m_annotations'
 HUMAN_ANNOTATION_FILE = 'human36m_train.json'
 HUMAN_ANNOTATION_PATH = os.path.join(HUMAN_ANNOTATION_DIR, HUMAN_ANNOTATION_FILE)
+HUMAN_SHARDS_DIR      = os.path.join(HUMAN_ANNOTATION_DIR, 'human36m_train_shards')
+HUMAN_STORE_DIR       = os.path.join(HUMAN_ANNOTATION_DIR, 'human36m_train_store')
 
 CHECKPOINTS_DIR = '../checkpoints'
+CHECKPOINT_PATH = os.path.join(CHECKPOINTS_DIR, 'mhrl-{epoch:03d}-{val_loss:.2f}.hdf5')
+# Every checkpoint has the normalization statistics it was trained with saved
+# next to it, as norm-stats-<checkpoint name>.npz (see norm_stats_path). They
+# are not prefixed with mhrl- so that find_latest_epoch skips them.
+NORM_STATS_PREFIX = 'norm-stats-'
+NORM_CHUNK_SIZE = 65536
+# Per-phase timings of training, as json lines and tensorboard summaries
+TIMINGS_LOG_DIR = os.path.join(CHECKPOINTS_DIR, 'log')
+TIMINGS_PATH    = os.path.join(TIMINGS_LOG_DIR, 'timings.jsonl')
+# First step to run cProfile on, and for how many steps. Negative to not profile
+PROFILE_START = -1
+PROFILE_STEPS = 100
+
+BATCH_SIZE = 64
 
 # Human3.6m IDs for training and testing
 TRAIN_SUBJECTS = [1, 5, 6, 7, 8]
@@ -57,54 +78,99 @@ LIMIT = None
 ################################################################################
 
 
-def get_human_data(limit=None):
-    with open(HUMAN_ANNOTATION_PATH) as f:
-        _human_dataset = json.load(f)
-        correct_lean(_human_dataset)
-    if limit is not None:
-        train = [h['kpts_2d'] for h in _human_dataset['annotations'] if h['s_id'] in TRAIN_SUBJECTS][:LIMIT]
-        test  = [h['kpts_2d'] for h in _human_dataset['annotations'] if h['s_id'] in TEST_SUBJECTS][:LIMIT]
-        trainlabels = [h['kpts_3d'] for h in _human_dataset['annotations'] if h['s_id'] in TRAIN_SUBJECTS][:LIMIT]
-        testlabels  = [h['kpts_3d'] for h in _human_dataset['annotations'] if h['s_id'] in TEST_SUBJECTS][:LIMIT]
-    else:
-        train = [h['kpts_2d'] for h in _human_dataset['annotations'] if h['s_id'] in TRAIN_SUBJECTS]
-        test  = [h['kpts_2d'] for h in _human_dataset['annotations'] if h['s_id'] in TEST_SUBJECTS]
-        trainlabels = [h['kpts_3d'] for h in _human_dataset['annotations'] if h['s_id'] in TRAIN_SUBJECTS]
-        testlabels  = [h['kpts_3d'] for h in _human_dataset['annotations'] if h['s_id'] in TEST_SUBJECTS]
-
-    keypoints = _human_dataset['pose'][0]['keypoints']
+def load_corrected_split(_human_store, subjects, actions=None, limit=None):
+    '''2d keypoints and lean corrected 3d keypoints of the rows of a split.'''
+    rows = split_rows(_human_store, subjects, actions, limit)
+    kpts_2d = np.asarray(_human_store['kpts_2d'][rows])
+    kpts_3d = correct_lean_rows(_human_store, rows)
+    return kpts_2d, kpts_3d
+
+def get_human_data(limit=None, actions=None):
+    _human_store = load_store(HUMAN_STORE_DIR, json_path=HUMAN_ANNOTATION_PATH,
+                              shard_dir=HUMAN_SHARDS_DIR)
+    if limit is None:
+        # Every row is used, so correct (or load the cached correction of) all
+        # of them at once. With a limit only the selected rows are corrected.
+        correct_lean_store(_human_store)
+
+    # Only the rows of the requested split (and at most limit of them) are read
+    train, trainlabels = load_corrected_split(_human_store, TRAIN_SUBJECTS, actions, limit)
+    test, testlabels   = load_corrected_split(_human_store, TEST_SUBJECTS, actions, limit)
+
+    keypoints = _human_store['pose'][0]['keypoints']
     assert len(train) == len(trainlabels)
     assert len(test) == len(testlabels)
     return train, test, trainlabels, testlabels, keypoints
 
 
-def normalize_data(train, test, trainlabels, testlabels):
-    train_mean = np.mean(train, axis=0)
-    train_std  = np.std(train, axis=0)
-    trainlabels_mean = np.mean(trainlabels, axis=0)
-    trainlabels_std  = np.std(trainlabels, axis=0)
+def compute_mean_std(x, chunk_size=NORM_CHUNK_SIZE):
+    '''
+    Mean and std of the rows of x in a single streaming pass. x is read
+    chunk_size rows at a time (it can be a memmap) and the per chunk statistics
+    are merged with Welford's parallel update.
+    '''
+    n, mean, m2 = 0, 0., 0.
+    for start in range(0, len(x), chunk_size):
+        chunk = np.asarray(x[start:start + chunk_size], dtype=np.float64)
+        chunk_n = len(chunk)
+        chunk_mean = chunk.mean(axis=0)
+        chunk_m2 = ((chunk - chunk_mean) ** 2).sum(axis=0)
+
+        delta = chunk_mean - mean
+        total = n + chunk_n
+        mean = mean + delta * chunk_n / total
+        m2 = m2 + chunk_m2 + delta ** 2 * n * chunk_n / total
+        n = total
+    return mean, np.sqrt(m2 / n)
+
+def compute_normalization_stats(train, trainlabels):
+    train_mean, train_std = compute_mean_std(train)
+    trainlabels_mean, trainlabels_std = compute_mean_std(trainlabels)
+    return {'train_mean': train_mean, 'train_std': train_std,
+            'trainlabels_mean': trainlabels_mean, 'trainlabels_std': trainlabels_std}
+
+def norm_stats_path(checkpoint_filepath):
+    '''Where the normalization statistics of a checkpoint are saved'''
+    checkpoint_dir, checkpoint_file = os.path.split(checkpoint_filepath)
+    return os.path.join(checkpoint_dir, NORM_STATS_PREFIX + os.path.splitext(checkpoint_file)[0] + '.npz')
+
+def save_normalization_stats(norm_stats, path):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    np.savez(path, **norm_stats)
+
+def load_normalization_stats(path):
+    with np.load(path) as f:
+        return {k: f[k] for k in f.files}
+
+def get_normalization_stats(train, trainlabels, use_latest_checkpoint=False):
+    '''
+    When resuming from a checkpoint, reuses the statistics saved alongside it so
+    that the data is normalized exactly as it was for training. Otherwise
+    computes them from the training set; NormStatsCallback saves them next to
+    every checkpoint of the run.
+    '''
+    if use_latest_checkpoint:
+        _, checkpoint_filepath = find_latest_epoch()
+        if checkpoint_filepath is not None:
+            path = norm_stats_path(os.path.join(CHECKPOINTS_DIR, checkpoint_filepath))
+            if os.path.isfile(path):
+                print "Using normalization statistics {}".format(path)
+                return load_normalization_stats(path)
+            print "No normalization statistics saved with {}, computing them".format(checkpoint_filepath)
 
-    train_normed = (train - train_mean) / train_std
-    test_normed  = (test - train_mean) / train_std
+    return compute_normalization_stats(train, trainlabels)
 
-    trainlabels_normed = (trainlabels - trainlabels_mean) / trainlabels_std
-    testlabels_normed  = (testlabels - trainlabels_mean) / trainlabels_std
+def normalize_data(train, test, trainlabels, testlabels, norm_stats):
+    train_normed = (train - norm_stats['train_mean']) / norm_stats['train_std']
+    test_normed  = (test - norm_stats['train_mean']) / norm_stats['train_std']
 
-    assert (train[0][0] - train_mean[0]) / train_std[0] == train_normed[0][0]
-    assert (train[1][1] - train_mean[1]) / train_std[1] == train_normed[1][1]
-    assert (test[0][0] - train_mean[0]) / train_std[0] == test_normed[0][0]
-    assert (test[1][1] - train_mean[1]) / train_std[1] == test_normed[1][1]
-    assert (trainlabels[0][0] - trainlabels_mean[0]) / trainlabels_std[0] == trainlabels_normed[0][0]
-    assert (trainlabels[1][1] - trainlabels_mean[1]) / trainlabels_std[1] == trainlabels_normed[1][1]
-    assert (testlabels[0][0] - trainlabels_mean[0]) / trainlabels_std[0] == testlabels_normed[0][0]
-    assert (testlabels[1][1] - trainlabels_mean[1]) / trainlabels_std[1] == testlabels_normed[1][1]
+    trainlabels_normed = (trainlabels - norm_stats['trainlabels_mean']) / norm_stats['trainlabels_std']
+    testlabels_normed  = (testlabels - norm_stats['trainlabels_mean']) / norm_stats['trainlabels_std']
 
     return train_normed, test_normed, trainlabels_normed, testlabels_normed
 
 
-
-
-
 ################################################################################
 # Models and Training
 ################################################################################
@@ -164,10 +230,76 @@ def create_mhrl_model(num_kpts):
                   metrics=['mse'])
     return model
 
-def train_model(train, test, trainlabels, testlabels, model, num_epochs, use_latest_checkpoint=False):
-    filepath="../checkpoints/mhrl-{epoch:03d}-{val_loss:.2f}.hdf5"
-    checkpoint = ModelCheckpoint(filepath, monitor='val_loss', verbose=1, period=10, mode='min')
-    callbacks_list = [checkpoint]
+class ProfilingCallback(Callback):
+    '''
+    Times the phases of model.fit with a TrainingProfiler: the time between
+    batches (slicing the next batch out of the arrays), the forward and
+    backward pass of every batch, the evaluation on the validation data at the
+    end of every epoch and saving the checkpoint, which is done by wrapping
+    the checkpoint callback so that it runs after the evaluation is timed.
+    '''
+
+    def __init__(self, profiler, checkpoint, initial_step=0):
+        super(ProfilingCallback, self).__init__()
+        self.profiler = profiler
+        self.checkpoint = checkpoint
+        self.step = initial_step
+        self.last_batch_end = None
+
+    def set_params(self, params):
+        super(ProfilingCallback, self).set_params(params)
+        self.checkpoint.set_params(params)
+
+    def set_model(self, model):
+        super(ProfilingCallback, self).set_model(model)
+        self.checkpoint.set_model(model)
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.last_batch_end = time.time()
+
+    def on_batch_begin(self, batch, logs=None):
+        self.profiler.begin_step(self.step)
+        self.batch_start = time.time()
+        self.profiler.add('batch', self.batch_start - self.last_batch_end)
+
+    def on_batch_end(self, batch, logs=None):
+        self.last_batch_end = time.time()
+        self.profiler.add('step', self.last_batch_end - self.batch_start)
+        self.profiler.end_step(self.step, (logs or {}).get('size', BATCH_SIZE))
+        self.step += 1
+
+    def on_epoch_end(self, epoch, logs=None):
+        # Keras evaluates on the validation data between the last batch and here
+        self.profiler.add('evaluation', time.time() - self.last_batch_end, per_step=False)
+        with self.profiler.phase('checkpoint', per_step=False):
+            self.checkpoint.on_epoch_end(epoch, logs)
+        self.profiler.end_epoch(epoch + 1, self.step)
+
+    def on_train_end(self, logs=None):
+        self.profiler.close()
+
+class NormStatsCallback(Callback):
+    '''
+    Saves the normalization statistics of the run next to every checkpoint
+    written by ModelCheckpoint, so that resuming from or exporting any of them
+    uses the statistics it was trained with. Must come after the checkpoint
+    callback in the callbacks list.
+    '''
+
+    def __init__(self, norm_stats, filepath):
+        super(NormStatsCallback, self).__init__()
+        self.norm_stats = norm_stats
+        self.filepath = filepath
+
+    def on_epoch_end(self, epoch, logs=None):
+        # Same name as ModelCheckpoint gives the checkpoint of this epoch
+        checkpoint_filepath = self.filepath.format(epoch=epoch + 1, **(logs or {}))
+        if os.path.isfile(checkpoint_filepath):
+            save_normalization_stats(self.norm_stats, norm_stats_path(checkpoint_filepath))
+
+def train_model(train, test, trainlabels, testlabels, model, num_epochs, norm_stats,
+                use_latest_checkpoint=False):
+    checkpoint = ModelCheckpoint(CHECKPOINT_PATH, monitor='val_loss', verbose=1, period=10, mode='min')
 
     # If using a checkpoint, load the checkpoint and epoch
     initial_epoch = 0
@@ -178,9 +310,15 @@ def train_model(train, test, trainlabels, testlabels, model, num_epochs, use_lat
             initial_epoch = latest_epoch
             print "Using checkpoint {} at epoch {}".format(checkpoint_filepath, latest_epoch)
 
+    profiler = TrainingProfiler(TIMINGS_PATH, tf.summary.FileWriter(TIMINGS_LOG_DIR),
+                                profile_start=PROFILE_START, profile_steps=PROFILE_STEPS)
+    steps_per_epoch = (len(train) + BATCH_SIZE - 1) // BATCH_SIZE
+    callbacks_list = [ProfilingCallback(profiler, checkpoint, initial_epoch * steps_per_epoch),
+                      NormStatsCallback(norm_stats, CHECKPOINT_PATH)]
+
     history = model.fit(train, trainlabels,
                         epochs=num_epochs,
-                        batch_size=64,
+                        batch_size=BATCH_SIZE,
                         validation_data=[test, testlabels],
                         callbacks=callbacks_list,
                         initial_epoch=initial_epoch)
@@ -221,11 +359,12 @@ def plot_training(history):
 
 # train, test, trainlabels, testlabels, keypoints = get_human_data()
 train, test, trainlabels, testlabels, keypoints = get_human_data(limit=LIMIT)
-train, test, trainlabels, testlabels = normalize_data(train, test, trainlabels, testlabels)
+norm_stats = get_normalization_stats(train, trainlabels, use_latest_checkpoint=True)
+train, test, trainlabels, testlabels = normalize_data(train, test, trainlabels, testlabels, norm_stats)
 # TODO: Normalize based on camera view?
 
 model = create_mhrl_model(len(keypoints))
-history = train_model(train, test, trainlabels, testlabels, model, NUM_EPOCHS,
+history = train_model(train, test, trainlabels, testlabels, model, NUM_EPOCHS, norm_stats,
                       use_latest_checkpoint=True)
 
 plot_training(history)
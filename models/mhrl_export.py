@@ -0,0 +1,134 @@
+'''
+mhrl_export.py
+
+Exports an mhrl checkpoint to the numpy_runner format (see
+3d-pose-baseline/src/numpy_runner.py), so that batch lifting jobs can run the
+model with NumPy alone instead of importing Keras and TensorFlow.
+
+The Keras .hdf5 checkpoint is read directly with h5py. Batch normalization
+(with its moving statistics) is folded into the preceding dense layer and
+dropout is dropped, as at test time. The normalization statistics saved with
+each checkpoint (norm-stats-<checkpoint name>.npz) are exported too, so
+NumpyModel.lift takes raw 2d keypoints.
+
+mhrl.py trains at import time, so its paths are repeated here rather than
+imported.
+
+Usage:
+    python mhrl_export.py [checkpoint.hdf5] [output.npz]
+'''
+
+import os
+import sys
+import h5py
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '3d-pose-baseline', 'src'))
+import numpy_runner
+
+CHECKPOINTS_DIR = '../checkpoints'
+NORM_STATS_PREFIX = 'norm-stats-'
+
+# Default epsilon of keras.layers.BatchNormalization
+BATCH_NORM_EPSILON = 1e-3
+
+
+def _decode(name):
+    return name.decode('utf8') if isinstance(name, bytes) else name
+
+
+def read_layer_weights(checkpoint_path):
+    '''
+    Weights of every layer of a Keras checkpoint, in model order, as a list of
+    (layer name, {weight name: array}). Works with both model.save and
+    model.save_weights files.
+    '''
+    layers = []
+    with h5py.File(checkpoint_path, 'r') as f:
+        g = f['model_weights'] if 'model_weights' in f else f
+        for layer_name in g.attrs['layer_names']:
+            layer_name = _decode(layer_name)
+            weight_names = [_decode(n) for n in g[layer_name].attrs['weight_names']]
+            if not weight_names:
+                continue
+            # e.g. 'dense_1/kernel:0' -> 'kernel'
+            weights = {n.split('/')[-1].split(':')[0]: g[layer_name][n][()] for n in weight_names}
+            layers.append((layer_name, weights))
+    return layers
+
+
+def fold_batch_norm(w, b, bn):
+    scale = bn['gamma'] / np.sqrt(bn['moving_variance'] + BATCH_NORM_EPSILON)
+    return w * scale, (b - bn['moving_mean']) * scale + bn['beta']
+
+
+def export_mhrl_model(checkpoint_path):
+    '''
+    Folded weights of an mhrl checkpoint, in the numpy_runner format.
+
+    create_mhrl_model is Dense -> residual blocks -> Dense, where every
+    residual block is two Dense -> BatchNormalization -> relu -> Dropout
+    layers with the input of the block added to its output.
+    '''
+    layers = read_layer_weights(checkpoint_path)
+    dense = [weights for name, weights in layers if 'kernel' in weights]
+    bns   = [weights for name, weights in layers if 'moving_mean' in weights]
+
+    num_blocks = len(bns) // 2
+    assert len(bns) == 2 * num_blocks and len(dense) == 2 * num_blocks + 2, \
+        'Unexpected layers in {}: {} dense, {} batch norm'.format(checkpoint_path, len(dense), len(bns))
+
+    weights = {}
+    def layer(name, w, b, relu):
+        weights[name + '_w'], weights[name + '_b'] = w, b
+        return {'w': name + '_w', 'b': name + '_b', 'relu': relu}
+
+    spec = {'input': layer('input', dense[0]['kernel'], dense[0]['bias'], False),
+            'blocks': []}
+    for idx in range(num_blocks):
+        block_layers = []
+        for j in range(2):
+            d, bn = dense[1 + 2 * idx + j], bns[2 * idx + j]
+            w, b = fold_batch_norm(d['kernel'].astype(np.float64), d['bias'].astype(np.float64), bn)
+            block_layers.append(layer('block{}_{}'.format(idx, j + 1), w, b, True))
+        spec['blocks'].append({'layers': block_layers, 'residual': True})
+    spec['output'] = layer('output', dense[-1]['kernel'], dense[-1]['bias'], False)
+    return spec, weights
+
+
+def export_norm_stats(norm_stats):
+    '''mhrl normalizes every dimension, so all of them are used'''
+    return {'mean_2d': norm_stats['train_mean'], 'std_2d': norm_stats['train_std'],
+            'dim_to_use_2d': np.arange(len(norm_stats['train_mean'])),
+            'mean_3d': norm_stats['trainlabels_mean'], 'std_3d': norm_stats['trainlabels_std'],
+            'dim_to_use_3d': np.arange(len(norm_stats['trainlabels_mean']))}
+
+
+def norm_stats_path(checkpoint_path):
+    checkpoint_dir, checkpoint_file = os.path.split(checkpoint_path)
+    return os.path.join(checkpoint_dir, NORM_STATS_PREFIX + os.path.splitext(checkpoint_file)[0] + '.npz')
+
+
+def find_latest_checkpoint():
+    checkpoints = [f for f in os.listdir(CHECKPOINTS_DIR) if f.startswith('mhrl-')]
+    if not checkpoints:
+        return None
+    latest = max(checkpoints, key=lambda f: int(f.split('-')[1]))
+    return os.path.join(CHECKPOINTS_DIR, latest)
+
+
+if __name__ == "__main__":
+    checkpoint_path = sys.argv[1] if len(sys.argv) > 1 else find_latest_checkpoint()
+    output_path     = sys.argv[2] if len(sys.argv) > 2 else os.path.join(CHECKPOINTS_DIR, 'export-mhrl.npz')
+    assert checkpoint_path is not None, 'No mhrl checkpoint in {}'.format(CHECKPOINTS_DIR)
+
+    norm_stats = None
+    if os.path.isfile(norm_stats_path(checkpoint_path)):
+        with np.load(norm_stats_path(checkpoint_path)) as f:
+            norm_stats = export_norm_stats({k: f[k] for k in f.files})
+    else:
+        print('No normalization statistics saved with {}, exporting the model alone'.format(checkpoint_path))
+
+    spec, weights = export_mhrl_model(checkpoint_path)
+    numpy_runner.save_model(output_path, spec, weights, norm_stats)
+    print('Exported {} to {}'.format(checkpoint_path, output_path))
@@ -0,0 +1,107 @@
+'''
+annotation_shards.py
+
+Sharded, appendable storage for the Human3.6M annotations.
+
+preprocess_human36m_data.py writes the annotations of every processed video to
+its own shard file as soon as the video is done, instead of holding the whole
+dataset in memory for a single json.dump at the end. A manifest lists the
+completed shards, so a crashed run can resume from the last completed shard,
+and readers can iterate the shards lazily.
+
+Layout of a shard directory:
+
+    manifest.json      pose, actions and the ordered list of completed shards
+    <shard name>.json  {'annotations': [...], 'images': [...]} of one shard
+'''
+
+import os
+import json
+
+MANIFEST_FILE = 'manifest.json'
+
+
+def _write_json_atomic(path, obj):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f)
+    os.rename(tmp_path, path)
+
+
+def has_manifest(shard_dir):
+    return os.path.isfile(os.path.join(shard_dir, MANIFEST_FILE))
+
+
+def load_manifest(shard_dir):
+    with open(os.path.join(shard_dir, MANIFEST_FILE)) as f:
+        return json.load(f)
+
+
+class ShardWriter(object):
+    '''
+    Appends shards to a shard directory, resuming from its manifest if one
+    exists. pose and actions must match those of the existing manifest, since
+    annotations in the existing shards refer to them.
+    '''
+
+    def __init__(self, shard_dir, pose, actions):
+        self.shard_dir = shard_dir
+        if not os.path.isdir(shard_dir):
+            os.makedirs(shard_dir)
+
+        if has_manifest(shard_dir):
+            self.manifest = load_manifest(shard_dir)
+            assert self.manifest['pose'] == pose and self.manifest['actions'] == actions, \
+                "Shards in {} were written with different pose or actions. " \
+                "Delete the directory to start over.".format(shard_dir)
+        else:
+            self.manifest = {'pose': pose, 'actions': actions, 'shards': []}
+            _write_json_atomic(os.path.join(shard_dir, MANIFEST_FILE), self.manifest)
+
+        self.completed = set(s['name'] for s in self.manifest['shards'])
+
+    def is_complete(self, name):
+        return name in self.completed
+
+    def write_shard(self, name, annotations, images, **info):
+        '''
+        Writes one shard and then records it in the manifest, along with any
+        extra info given as keyword arguments. A shard that was written but not
+        recorded, e.g. after a crash, is simply rewritten.
+        '''
+        assert len(annotations) == len(images)
+        assert not self.is_complete(name), "Shard {} already written".format(name)
+        filename = name + '.json'
+        _write_json_atomic(os.path.join(self.shard_dir, filename),
+                           {'annotations': annotations, 'images': images})
+
+        entry = {'name': name,
+                 'file': filename,
+                 'num_annotations': len(annotations)}
+        entry.update(info)
+        self.manifest['shards'].append(entry)
+        _write_json_atomic(os.path.join(self.shard_dir, MANIFEST_FILE), self.manifest)
+        self.completed.add(name)
+
+
+def iter_shards(shard_dir):
+    '''
+    Lazily yields the (annotations, images) lists of every completed shard, in
+    the order they were written. Only one shard is in memory at a time.
+    '''
+    manifest = load_manifest(shard_dir)
+    for shard in manifest['shards']:
+        with open(os.path.join(shard_dir, shard['file'])) as f:
+            records = json.load(f)
+        yield records['annotations'], records['images']
+
+
+def iter_annotations(shard_dir):
+    '''Lazily yields every (annotation, image) pair of the completed shards.'''
+    for annotations, images in iter_shards(shard_dir):
+        for annotation, image in zip(annotations, images):
+            yield annotation, image
+
+
+def num_annotations(shard_dir):
+    return sum(s['num_annotations'] for s in load_manifest(shard_dir)['shards'])
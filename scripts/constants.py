@@ -21,6 +21,12 @@ HUMAN_ANNOTATION_FILE = 'human36m_train.json'
 COCO_ANNOTATION_FILE = 'person_keypoints_train2014.json'
 
 HUMAN_ANNOTATION_PATH = os.path.join(HUMAN_ANNOTATION_DIR, HUMAN_ANNOTATION_FILE)
+# Annotation shards written by preprocess_human36m_data.py. See annotation_shards.py
+HUMAN_SHARDS_DIR = os.path.join(HUMAN_ANNOTATION_DIR, 'human36m_train_shards')
+# Columnar, memory-mappable version of HUMAN_ANNOTATION_FILE. See human36m_store.py
+HUMAN_STORE_DIR = os.path.join(HUMAN_ANNOTATION_DIR, 'human36m_train_store')
+# Lean corrected kpts_3d, keyed by a hash of their inputs. See correct_lean_store
+LEAN_CACHE_DIR = os.path.join(HUMAN_ANNOTATION_DIR, 'lean_cache')
 COCO_ANNOTATION_PATH = os.path.join(COCO_ANNOTATION_DIR, COCO_ANNOTATION_FILE)
 HUMAN_RAW_RESULT_PATH = os.path.join(RESULT_DIR, HUMAN_RAW_RESULT_FILE)
 COCO_RAW_RESULT_PATH = os.path.join(RESULT_DIR, COCO_RAW_RESULT_FILE)
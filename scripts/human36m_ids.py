@@ -0,0 +1,105 @@
+'''
+human36m_ids.py
+
+Deterministic annotation and image ids for the Human3.6M annotations.
+
+An id is derived from the (subject, action, camera, frame) it was extracted
+from, so workers processing different videos can compute ids independently
+without ever colliding, and an id can be decoded back to its source without
+any lookup table. The fields are packed as decimal digits, which keeps ids
+readable and below 2**31:
+
+    id = SSAACFFFFF  (subject, action id, camera index, frame)
+
+e.g. subject 9, action 3, camera 58860488, frame 120 -> 903200120.
+
+The action id comes from a fixed table of the Human3.6M action names (see
+ACTION_NAMES and action_id), not from the actions present in a run, so the
+same video gets the same ids whichever subjects and actions are processed.
+The table is versioned by ACTION_TABLE_VERSION, which is saved with the
+actions of the annotations; entries may only be appended to ACTION_NAMES,
+and any other change to the table must bump the version.
+
+NOTE: annotation files created before these ids were introduced use random
+ids, which do not decode to anything meaningful.
+'''
+
+import numpy as np
+
+# Cameras of Human3.6M, in the order used by the camera index field.
+CAMERA_IDS = [54138969, 55011271, 58860488, 60457274]
+
+FRAME_BASE  = 100000
+CAMERA_BASE = 10
+ACTION_BASE = 100
+
+# Action names of the Human3.6M videos. Some subjects use different names for
+# the same action (Photo / TakingPhoto, WalkDog / WalkingDog), which are kept
+# apart as they appear in the file names.
+ACTION_TABLE_VERSION = 1
+ACTION_NAMES = ['Directions', 'Discussion', 'Eating', 'Greeting', 'Phoning',
+                'Photo', 'Posing', 'Purchases', 'Sitting', 'SittingDown',
+                'Smoking', 'TakingPhoto', 'Waiting', 'Walking', 'WalkDog',
+                'WalkingDog', 'WalkTogether']
+# Versions of an action, e.g. 'Directions 1' (version 0 has no number)
+ACTION_VERSIONS = 5
+
+
+def action_id(action_name, action_version):
+    '''Returns the fixed action id of an action name and version.'''
+    assert action_name in ACTION_NAMES, "unknown action {}".format(action_name)
+    assert 0 <= action_version < ACTION_VERSIONS, "action version {} out of range".format(action_version)
+    return ACTION_NAMES.index(action_name) * ACTION_VERSIONS + action_version
+
+
+def action_source(action_id):
+    '''Returns the (action name, action version) of a fixed action id.'''
+    name_index, action_version = divmod(int(action_id), ACTION_VERSIONS)
+    return ACTION_NAMES[name_index], action_version
+
+
+def encode_id(subject_id, action_id, camera_id, frame):
+    '''Returns the id of a frame of a video.'''
+    assert 0 <= frame < FRAME_BASE, "frame {} out of range".format(frame)
+    assert 0 <= action_id < ACTION_BASE, "action id {} out of range".format(action_id)
+    camera_index = CAMERA_IDS.index(camera_id)
+    return ((subject_id * ACTION_BASE + action_id) * CAMERA_BASE + camera_index) * FRAME_BASE + frame
+
+
+def decode_id(id):
+    '''Returns the (subject_id, action_id, camera_id, frame) an id was made from.'''
+    id, frame = divmod(int(id), FRAME_BASE)
+    id, camera_index = divmod(id, CAMERA_BASE)
+    subject_id, action_id = divmod(id, ACTION_BASE)
+    return subject_id, action_id, CAMERA_IDS[camera_index], frame
+
+
+def decode_ids(ids):
+    '''
+    Vectorized decode_id for an array of ids, e.g. the i_id column of the
+    annotation store. Returns the subject_id, action_id, camera_id and frame
+    arrays.
+    '''
+    ids = np.asarray(ids, dtype=np.int64)
+    frame = ids % FRAME_BASE
+    ids = ids // FRAME_BASE
+    camera_index = ids % CAMERA_BASE
+    ids = ids // CAMERA_BASE
+    action_id = ids % ACTION_BASE
+    subject_id = ids // ACTION_BASE
+    return subject_id, action_id, np.array(CAMERA_IDS)[camera_index], frame
+
+
+def id_source(id):
+    '''
+    Reverse lookup of an id to its source, with the action resolved through the
+    fixed action table. Returns a dict with subject_id, action name and
+    version, camera_id and frame.
+    '''
+    subject_id, a_id, camera_id, frame = decode_id(id)
+    action_name, action_version = action_source(a_id)
+    return {'subject_id': subject_id,
+            'action': action_name,
+            'version': action_version,
+            'camera_id': camera_id,
+            'frame': frame}
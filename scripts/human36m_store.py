@@ -0,0 +1,375 @@
+'''
+human36m_store.py
+
+Columnar on-disk store for the Human3.6M annotations.
+
+The annotations produced by preprocess_human36m_data.py are a single large
+json file of nested dicts. Parsing it dominates startup time and peak memory of
+every script that only needs the keypoint arrays. This module converts that
+file once into a directory of fixed-dtype .npy columns (plus a small json file
+with the pose and action tables) which can be memory-mapped and loaded in
+milliseconds.
+
+Store layout (one row per annotation, aligned with the image of the same row):
+
+    kpts_2d.npy   float32 (N, 2 * num_kpts)
+    kpts_3d.npy   float32 (N, 3 * num_kpts)
+    id.npy        int32   annotation id
+    s_id.npy      int32   subject id
+    a_id.npy      int32   action id
+    i_id.npy      int32   image id
+    c_id.npy      int32   camera id
+    frame.npy     int32   frame number in the source video
+    filename.npy  |S      image shard reference of the crop (see image_shard_ref)
+    video.npy     |S      source video string table
+    meta.json     pose, actions, image width and height, and a fingerprint
+                  of the annotations the store was converted from
+
+Usage:
+    python human36m_store.py [annotation_json or shard_dir] [store_dir]
+'''
+
+import os
+import sys
+import json
+import shutil
+import hashlib
+import numpy as np
+
+from constants import (HUMAN_ANNOTATION_PATH, HUMAN_SHARDS_DIR, HUMAN_STORE_DIR,
+    HUMAN_IMAGES_DIR)
+from annotation_shards import has_manifest, iter_shards, load_manifest, MANIFEST_FILE
+
+STORE_VERSION = 1
+
+INT_COLUMNS = ['id', 's_id', 'a_id', 'i_id', 'c_id', 'frame']
+STRING_COLUMNS = ['filename', 'video']
+KPTS_COLUMNS = ['kpts_2d', 'kpts_3d']
+COLUMNS = KPTS_COLUMNS + INT_COLUMNS + STRING_COLUMNS
+
+META_FILE = 'meta.json'
+
+
+################################################################################
+# CONVERSION
+################################################################################
+
+def columns_from_records(annotations, images):
+    '''Builds the store columns of aligned lists of annotation and image dicts.'''
+    assert len(annotations) == len(images), \
+        "Annotations and images must be aligned row by row"
+
+    columns = {}
+    columns['kpts_2d'] = np.array([a['kpts_2d'] for a in annotations], dtype=np.float32)
+    columns['kpts_3d'] = np.array([a['kpts_3d'] for a in annotations], dtype=np.float32)
+    columns['id']    = np.array([a['id'] for a in annotations], dtype=np.int32)
+    columns['s_id']  = np.array([a['s_id'] for a in annotations], dtype=np.int32)
+    columns['a_id']  = np.array([a['a_id'] for a in annotations], dtype=np.int32)
+    columns['i_id']  = np.array([a['i_id'] for a in annotations], dtype=np.int32)
+    columns['c_id']  = np.array([h['c_id'] for h in images], dtype=np.int32)
+    columns['frame'] = np.array([h['frame'] for h in images], dtype=np.int32)
+    columns['filename'] = np.array([h['filename'].encode('ascii') for h in images])
+    columns['video']    = np.array([h['video'].encode('ascii') for h in images])
+
+    image_ids = np.array([h['id'] for h in images], dtype=np.int32)
+    assert np.all(image_ids == columns['i_id']), \
+        "Annotation i_id does not match the image id of the same row"
+    return columns
+
+
+def source_fingerprint(json_path=None, shard_dir=None):
+    '''
+    Cheap fingerprint of the annotations a store is converted from: the shard
+    manifest (contents and mtime) if shard_dir has one, otherwise the size
+    and mtime of json_path. None if neither exists.
+    '''
+    if shard_dir is not None and has_manifest(shard_dir):
+        manifest_path = os.path.join(shard_dir, MANIFEST_FILE)
+        with open(manifest_path, 'rb') as f:
+            manifest_sha1 = hashlib.sha1(f.read()).hexdigest()
+        return {'shard_dir': os.path.abspath(shard_dir),
+                'manifest_sha1': manifest_sha1,
+                'manifest_mtime': os.stat(manifest_path).st_mtime}
+    if json_path is not None and os.path.isfile(json_path):
+        st = os.stat(json_path)
+        return {'json_path': os.path.abspath(json_path),
+                'size': st.st_size,
+                'mtime': st.st_mtime}
+    return None
+
+
+def convert_json_to_store(json_path=HUMAN_ANNOTATION_PATH,
+                          store_dir=HUMAN_STORE_DIR):
+    '''
+    One-time conversion of the json annotation file into a columnar store.
+
+    The store is written to a temporary directory first and renamed into place
+    so that an interrupted conversion never leaves a half written store behind.
+    '''
+    with open(json_path) as f:
+        _human_dataset = json.load(f)
+
+    annotations = _human_dataset['annotations']
+    images = _human_dataset['images']
+    columns = columns_from_records(annotations, images)
+
+    meta = {'version': STORE_VERSION,
+            'num_rows': len(annotations),
+            'pose': _human_dataset['pose'],
+            'actions': _human_dataset['actions'],
+            'width': images[0]['width'] if images else 0,
+            'height': images[0]['height'] if images else 0,
+            'source': source_fingerprint(json_path=json_path)}
+
+    write_store(columns, meta, store_dir)
+    print("Converted {} annotations from {} to {}".format(
+        len(annotations), json_path, store_dir))
+
+
+def convert_shards_to_store(shard_dir=HUMAN_SHARDS_DIR,
+                            store_dir=HUMAN_STORE_DIR):
+    '''
+    Conversion of the annotation shards written by preprocess_human36m_data.py
+    into a columnar store. Shards are read one at a time, so only the columns
+    and a single shard are ever in memory.
+    '''
+    manifest = load_manifest(shard_dir)
+    shard_columns = []
+    width, height = 0, 0
+    for annotations, images in iter_shards(shard_dir):
+        if len(annotations) == 0:
+            continue
+        shard_columns.append(columns_from_records(annotations, images))
+        width, height = images[0]['width'], images[0]['height']
+    assert len(shard_columns) > 0, "No annotations in {}".format(shard_dir)
+
+    columns = {}
+    for name in COLUMNS:
+        columns[name] = np.concatenate([c[name] for c in shard_columns])
+
+    meta = {'version': STORE_VERSION,
+            'num_rows': columns['i_id'].shape[0],
+            'pose': manifest['pose'],
+            'actions': manifest['actions'],
+            'width': width,
+            'height': height,
+            'source': source_fingerprint(shard_dir=shard_dir)}
+
+    write_store(columns, meta, store_dir)
+    print("Converted {} annotations from {} to {}".format(
+        meta['num_rows'], shard_dir, store_dir))
+
+
+def write_store(columns, meta, store_dir):
+    '''Writes the given columns and metadata atomically into store_dir.'''
+    tmp_dir = store_dir.rstrip('/') + '.tmp'
+    if os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    for name in COLUMNS:
+        np.save(os.path.join(tmp_dir, name + '.npy'), columns[name])
+    with open(os.path.join(tmp_dir, META_FILE), 'w') as f:
+        json.dump(meta, f)
+
+    if os.path.isdir(store_dir):
+        shutil.rmtree(store_dir)
+    os.rename(tmp_dir, store_dir)
+
+
+################################################################################
+# LOADING
+################################################################################
+
+def load_store(store_dir=HUMAN_STORE_DIR, mmap_mode='r',
+               json_path=HUMAN_ANNOTATION_PATH, shard_dir=HUMAN_SHARDS_DIR):
+    '''
+    Loads the columnar store as a dict of arrays. Columns are memory-mapped
+    read-only by default, so only the rows that are touched get read from disk.
+    The store is created the first time it is requested, from the annotation
+    shards in shard_dir if there are any and from json_path otherwise. It is
+    recreated when those annotations have changed since (eg. after the data
+    was preprocessed again), according to the fingerprint in its meta.json.
+
+    Returns a dict with every column in COLUMNS plus 'pose', 'actions',
+    'width' and 'height' from the metadata and the 'store_dir' it was loaded
+    from.
+    '''
+    meta = read_meta(store_dir)
+    if meta is not None and meta.get('version') == STORE_VERSION:
+        source = source_fingerprint(json_path, shard_dir)
+        # Without its source (eg. a copied store) the store is used as is
+        if source is not None and meta.get('source') != source:
+            print("Annotations changed since {} was converted, reconverting".format(store_dir))
+            meta = None
+
+    if meta is None:
+        if shard_dir is not None and has_manifest(shard_dir):
+            convert_shards_to_store(shard_dir, store_dir)
+        else:
+            convert_json_to_store(json_path, store_dir)
+        meta = read_meta(store_dir)
+
+    assert meta['version'] == STORE_VERSION, \
+        "Store {} has version {}, expected {}. Delete it to reconvert.".format(
+            store_dir, meta['version'], STORE_VERSION)
+
+    store = {'store_dir': store_dir}
+    for name in COLUMNS:
+        store[name] = np.load(os.path.join(store_dir, name + '.npy'),
+                              mmap_mode=mmap_mode)
+    store['pose'] = meta['pose']
+    store['actions'] = meta['actions']
+    store['width'] = meta['width']
+    store['height'] = meta['height']
+    return store
+
+
+def read_meta(store_dir):
+    '''The metadata of the store in store_dir, or None if there is no store.'''
+    meta_path = os.path.join(store_dir, META_FILE)
+    if not os.path.isfile(meta_path):
+        return None
+    with open(meta_path) as f:
+        return json.load(f)
+
+
+def num_rows(store):
+    return store['i_id'].shape[0]
+
+
+def row_annotation(store, i):
+    '''Rebuilds the json annotation dict of row i.'''
+    return {'id': int(store['id'][i]),
+            's_id': int(store['s_id'][i]),
+            'a_id': int(store['a_id'][i]),
+            'i_id': int(store['i_id'][i]),
+            'kpts_2d': store['kpts_2d'][i].tolist(),
+            'kpts_3d': store['kpts_3d'][i].tolist()}
+
+
+def row_image(store, i):
+    '''Rebuilds the json image dict of row i.'''
+    return {'id': int(store['i_id'][i]),
+            'c_id': int(store['c_id'][i]),
+            's_id': int(store['s_id'][i]),
+            'filename': store['filename'][i].decode('ascii'),
+            'width': store['width'],
+            'height': store['height'],
+            'video': store['video'][i].decode('ascii'),
+            'frame': int(store['frame'][i])}
+
+
+################################################################################
+# SPLITS
+################################################################################
+
+def subject_action_index(store):
+    '''
+    Returns a dict mapping (s_id, a_id) to the ascending rows of that subject
+    and action. The index is built once per loaded store and kept in it.
+    '''
+    if '_subject_action_index' not in store:
+        s_id = np.asarray(store['s_id'], dtype=np.int64)
+        a_id = np.asarray(store['a_id'], dtype=np.int64)
+        codes = s_id * 1000 + a_id
+        order = np.argsort(codes, kind='mergesort') # stable, rows stay ascending
+        sorted_codes = codes[order]
+        starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+        ends = np.r_[starts[1:], len(order)]
+
+        index = {}
+        for start, end in zip(starts, ends):
+            code = int(sorted_codes[start])
+            index[(code // 1000, code % 1000)] = order[start:end]
+        store['_subject_action_index'] = index
+    return store['_subject_action_index']
+
+
+def action_ids(store, action_names):
+    '''Ids of every version of the given action names.'''
+    return [a['id'] for a in store['actions'] if a['name'] in action_names]
+
+
+def split_rows(store, subjects, actions=None, limit=None):
+    '''
+    Rows of the given subjects and (optionally) action names, in ascending
+    (file) order. With a limit, only the first limit of them are returned, the
+    same rows a scan of the json annotations would have kept. Only the
+    subject/action index is read to find them, no other column.
+    '''
+    index = subject_action_index(store)
+    wanted_actions = None if actions is None else set(action_ids(store, actions))
+
+    rows = []
+    for (s_id, a_id), group in index.items():
+        if s_id not in subjects:
+            continue
+        if wanted_actions is not None and a_id not in wanted_actions:
+            continue
+        rows.append(group)
+
+    if len(rows) == 0:
+        return np.zeros(0, dtype=np.int64)
+    rows = np.sort(np.concatenate(rows))
+    return rows if limit is None else rows[:limit]
+
+
+def load_split(store, subjects, actions=None, limit=None,
+               columns=('kpts_2d', 'kpts_3d')):
+    '''
+    Gathers the given columns for the rows of a split as in-memory arrays, eg.
+    train, trainlabels = load_split(store, TRAIN_SUBJECTS, limit=1000)
+    '''
+    rows = split_rows(store, subjects, actions, limit)
+    return [np.asarray(store[name][rows]) for name in columns]
+
+
+################################################################################
+# IMAGE SHARDS
+################################################################################
+
+def image_shard_name(s_id, video):
+    '''
+    Name of the batched image shard holding the crops of one video, as written
+    by preprocess_human36m_data.py. The shard is a (n, height, width, 3) uint8
+    array saved as <name>.npy next to the <name>.frames.npy frame numbers.
+    '''
+    return 'S%d_%s' % (s_id, os.path.splitext(video)[0].replace(' ', '_'))
+
+
+def image_shard_ref(s_id, video, frame):
+    '''
+    Reference to the crop of one frame, <shard name>/<frame>, kept as the
+    filename of its image since the crops are not written as image files.
+    load_image_ref reads the crop back.
+    '''
+    return '%s/%d' % (image_shard_name(s_id, video), frame)
+
+
+def load_shard_image(s_id, video, frame, images_dir=HUMAN_IMAGES_DIR):
+    '''Reads the crop of a single frame from its memory-mapped image shard.'''
+    return _read_shard_frame(os.path.join(images_dir, image_shard_name(s_id, video)), frame)
+
+
+def load_image_ref(ref, images_dir=HUMAN_IMAGES_DIR):
+    '''Reads the crop of an image_shard_ref, e.g. the filename of an image.'''
+    name, frame = ref.rsplit('/', 1)
+    return _read_shard_frame(os.path.join(images_dir, name), int(frame))
+
+
+def _read_shard_frame(shard, frame):
+    frames = np.load(shard + '.frames.npy')
+    j = np.searchsorted(frames, frame)
+    assert j < len(frames) and frames[j] == frame, \
+        "Frame {} is not in shard {}".format(frame, shard)
+    return np.array(np.load(shard + '.npy', mmap_mode='r')[j])
+
+
+if __name__ == "__main__":
+    source    = sys.argv[1] if len(sys.argv) > 1 else HUMAN_ANNOTATION_PATH
+    store_dir = sys.argv[2] if len(sys.argv) > 2 else HUMAN_STORE_DIR
+    if os.path.isdir(source):
+        convert_shards_to_store(source, store_dir)
+    else:
+        convert_json_to_store(source, store_dir)
@@ -13,6 +13,7 @@ import copy
 import math
 import difflib
 import random
+import hashlib
 from collections import Counter, defaultdict
 import numpy as np
 import scipy.io as sio
@@ -22,7 +23,8 @@ import matplotlib.pyplot as plt
 from constants import (HUMAN_ANNOTATION_PATH, COCO_ANNOTATION_PATH,
     HUMAN_RAW_RESULT_PATH, COCO_RAW_RESULT_PATH, KEYPTS_RELATIVE_DEPTH_PATH,
     KEYCMPS_RESULT_PATH, HUMAN_OUTPUT_PATH, ROTATION_MATRICES_PATH,
-    CAMERA_NAMES_PATH)
+    CAMERA_NAMES_PATH, LEAN_CACHE_DIR)
+from human36m_store import load_store, num_rows, row_annotation, row_image
 
 ################################################################################
 # PROCESS FUNCTIONS
@@ -74,27 +76,32 @@ def load_data(load_from_file=True):
     # truth data
     img_ids = [h['trials'][0]['img_id'] for h in data]
 
-    # Get the ground truth annotations from human dataset
-    with open(HUMAN_ANNOTATION_PATH) as f:
-        _human_dataset = json.load(f)
-        correct_lean(_human_dataset)
-    # >>> _human_dataset.keys()
-    # [u'images', u'pose', u'annotations', u'actions']
-    # >>> _human_dataset['images'][0].keys()
-    # [u'c_id', u's_id', u'frame', u'height', u'width', u'video', u'filename', u'id']
-    # >>> _human_dataset['annotations'][0].keys()
-    # [u'i_id', u's_id', u'a_id', u'kpts_2d', u'id', u'kpts_3d']
-
-    # Match the ground truth annotations with the turker data annotations
-    for i in range(len(_human_dataset['images'])):
-        if _human_dataset['images'][i]['id'] in img_ids:
-            img_id_idxes = [img_id_idx for img_id_idx, img_id in enumerate(img_ids)
-                            if img_id == _human_dataset['images'][i]['id']]
-            for img_id_idx in img_id_idxes:
-                data[img_id_idx]['images_truth'] = _human_dataset['images'][i]
-                data[img_id_idx]['annotations_truth'] = copy.deepcopy(_human_dataset['annotations'][i])
-
-    print "{} images in human3.6 dataset".format(len(_human_dataset['images']))
+    # Get the ground truth annotations from the columnar human dataset store
+    _human_store = load_store()
+    correct_lean_store(_human_store)
+    camera_rotations = load_camera_rotations()
+    # Each row of the store holds one image and its annotation. See
+    # human36m_store.py for the available columns.
+
+    # Match the ground truth annotations with the turker data annotations.
+    # Index the dataset rows by image id so every hit is joined in O(1). Each
+    # hit gets its own annotation dict since it is modified below, the image
+    # dict is shared between the hits of the same image.
+    row_by_img_id = {i_id: i for i, i_id in enumerate(_human_store['i_id'].tolist())}
+    images_truth_by_row = {}
+    for d, img_id in zip(data, img_ids):
+        i = row_by_img_id.get(img_id)
+        if i is None:
+            continue
+        if i not in images_truth_by_row:
+            images_truth = row_image(_human_store, i)
+            images_truth["R"] = camera_rotations[(images_truth['c_id'],
+                                                  images_truth['s_id'])].tolist()
+            images_truth_by_row[i] = images_truth
+        d['images_truth'] = images_truth_by_row[i]
+        d['annotations_truth'] = row_annotation(_human_store, i)
+
+    print "{} images in human3.6 dataset".format(num_rows(_human_store))
     print "{} annotations matched with ground truth".format(len(data))
 
     # Remove the neck keypoint. Arrange the depth data in a useful way.
@@ -258,13 +265,10 @@ def lookup_hits_from_file_names(data, file_names):
 
 
 def lookup_file_names_from_img_ids(img_ids):
-    with open(HUMAN_ANNOTATION_PATH) as f:
-        _human_dataset = json.load(f)
+    _human_store = load_store()
 
-    filenames = []
-    for h in _human_dataset['images']:
-        if h['id'] in img_ids:
-            filenames.append(h['filename'])
+    rows = np.where(np.in1d(_human_store['i_id'], img_ids))[0]
+    filenames = [_human_store['filename'][i].decode('ascii') for i in rows]
     return filenames
 
 
@@ -365,6 +369,12 @@ def get_action_data_from_human(_human_dataset, subj_ids, action, version=0):
     return action_data_annotations, action_data_images
 
 
+# Lean correction parameters. Bump LEAN_CORRECTION_VERSION whenever the
+# correction math changes so that cached corrections get recomputed.
+LEAN_CORRECTION_VERSION = 1
+LEAN_SUBJECT_IDS   = [1,5,6,7,8,9,11] # MUST MATCH MATLAB MATRIX
+LEAN_ZEROED_ANGLES = [0, 1] # euler angles about x and y, ie the tilt
+
 def load_rotation_matrices():
     cam_info = sio.loadmat(ROTATION_MATRICES_PATH)['cam_info']
     # cameras = [1, 2, 3, 4]
@@ -379,40 +389,173 @@ def load_camera_names():
     cameras = [1, 2, 3, 4]
     return cam_names
 
-def correct_lean(_human_dataset):
+def load_camera_rotations():
+    '''
+    Returns a dict mapping (camera id, subject id) to the 3x3 rotation matrix
+    of that camera for that subject.
+    '''
     rotation_matrices = load_rotation_matrices()
     camera_names = load_camera_names()
     camera_names = [int(n) for n in camera_names]
-    SUBJECT_IDS   = [1,5,6,7,8,9,11] # MUST MATCH MATLAB MATRIX
+
+    camera_rotations = {}
+    for cam_ind, c_id in enumerate(camera_names):
+        for subj_ind, s_id in enumerate(LEAN_SUBJECT_IDS):
+            camera_rotations[(c_id, s_id)] = rotation_matrices[cam_ind][subj_ind].T
+    return camera_rotations
+
+def load_lean_corrections():
+    '''
+    Returns a dict mapping (camera id, subject id) to the 3x3 matrix that
+    corrects the lean of row-vector keypoints seen by that camera. The matrix
+    unapplies the camera rotation and applies the no-tilt rotation, which
+    keeps only the rotation about the z axis (rotates person so they're facing
+    the camera, but eliminates tilt).
+    '''
+    lean_corrections = {}
+    for key, R in load_camera_rotations().items():
+        theta = rotationMatrixToEulerAngles(R)
+        theta[LEAN_ZEROED_ANGLES] = 0
+        lean_corrections[key] = np.dot(R.T, eulerAnglesToRotationMatrix(theta))
+    return lean_corrections
+
+def correct_lean_kpts(kpts_3d, c_ids, s_ids):
+    '''
+    Removes the camera tilt from 3d keypoints.
+
+    The 28 (camera, subject) correction matrices are computed once, every row
+    is assigned to its (camera, subject) group and the correction is applied
+    as a single stacked matmul over the (N, num_kpts, 3) keypoints.
+
+    Args:
+        kpts_3d: (N, 3 * num_kpts) array-like of 3d keypoints in camera space.
+        c_ids:   length N camera ids of each row.
+        s_ids:   length N subject ids of each row.
+    Returns:
+        (N, 3 * num_kpts) float64 array of corrected keypoints. The input is
+        left untouched.
+    '''
+    lean_corrections = load_lean_corrections()
+    kpts_3d = np.asarray(kpts_3d, dtype=np.float64)
+    n = kpts_3d.shape[0]
+
+    # Group the rows by (camera, subject). Subject ids are < 100.
+    codes = np.asarray(c_ids, dtype=np.int64) * 100 + np.asarray(s_ids, dtype=np.int64)
+    group_codes, groups = np.unique(codes, return_inverse=True)
+    group_corrections = np.array([lean_corrections[(int(c) // 100, int(c) % 100)]
+                                  for c in group_codes]).reshape(-1, 3, 3)
+
+    corrected = np.matmul(np.reshape(kpts_3d, (n, -1, 3)), group_corrections[groups])
+    return np.reshape(corrected, (n, -1))
+
+def correct_lean(_human_dataset):
+    '''Corrects the lean of a json loaded human dataset in place.'''
+    camera_rotations = load_camera_rotations()
 
     # Associate the rotation matrix with each image
-    # TODO: Refactor this loop out of this function
-    for i in range(len(_human_dataset['images'])):
-        cam_ind = camera_names.index(_human_dataset['images'][i]['c_id'])
-        subj_ind = SUBJECT_IDS.index(_human_dataset['images'][i]['s_id'])
-        _human_dataset['images'][i]["R"] = rotation_matrices[cam_ind][subj_ind].T.tolist()
-
-    # Correct the lean
-    for i in range(len(_human_dataset['images'])):
-        kpts_3d = _human_dataset['annotations'][i]['kpts_3d']
-        kpts_3d = np.reshape(kpts_3d, (len(kpts_3d) / 3, 3))
-
-        # Unapply the rotation matrix
-        kpts_3d = np.dot(kpts_3d, np.array(_human_dataset['images'][i]["R"]).T)
-        
-        # Convert the rotatioin matrix to euler angles and cancel all rotations
-        # except those about the z axis (rotates person so they're facing the
-        # camera, but eliminates tilt).
-        theta = rotationMatrixToEulerAngles(np.array(_human_dataset['images'][i]["R"]))
-        theta[0] = 0
-        theta[1] = 0
-        R = eulerAnglesToRotationMatrix(theta)
-        
-        # Apply the no-tilt rotation matrix
-        kpts_3d = np.dot(kpts_3d, R)
+    for h in _human_dataset['images']:
+        h["R"] = camera_rotations[(h['c_id'], h['s_id'])].tolist()
 
-        kpts_3d = list(kpts_3d.flatten())
-        _human_dataset['annotations'][i]['kpts_3d'] = kpts_3d
+    kpts_3d = correct_lean_kpts(
+        [a['kpts_3d'] for a in _human_dataset['annotations']],
+        [h['c_id'] for h in _human_dataset['images']],
+        [h['s_id'] for h in _human_dataset['images']])
+    for a, kpts in zip(_human_dataset['annotations'], kpts_3d):
+        a['kpts_3d'] = kpts.tolist()
+
+def correct_lean_store(_human_store, cache_dir=LEAN_CACHE_DIR):
+    '''
+    Corrects the lean of a columnar human dataset store. The memory-mapped
+    kpts_3d column is replaced by the corrected keypoints.
+
+    The corrected keypoints are cached in cache_dir under a key of the store
+    they are computed from, the camera .mat files and the correction
+    parameters (see lean_cache_key), so they are only recomputed when one of
+    those changes. Pass cache_dir=None to always recompute.
+
+    The store is only flagged as corrected once kpts_3d has been replaced, so
+    if the correction or the cache fails the next call tries again.
+    '''
+    if _human_store.get('lean_corrected'):
+        return
+
+    if cache_dir is None:
+        _human_store['kpts_3d'] = correct_lean_kpts(
+            _human_store['kpts_3d'], _human_store['c_id'], _human_store['s_id'])
+        _human_store['lean_corrected'] = True
+        return
+
+    cache_path = lean_cache_path(_human_store['store_dir'], cache_dir)
+    if os.path.isfile(cache_path):
+        _human_store['kpts_3d'] = np.load(cache_path, mmap_mode='r')
+        _human_store['lean_corrected'] = True
+        return
+
+    kpts_3d = correct_lean_kpts(
+        _human_store['kpts_3d'], _human_store['c_id'], _human_store['s_id'])
+
+    # Entries of this store with any other key are stale, their inputs have
+    # changed. Entries of other stores are left alone.
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    store_prefix = lean_cache_prefix(_human_store['store_dir'])
+    for f in os.listdir(cache_dir):
+        if f.startswith(store_prefix):
+            os.remove(os.path.join(cache_dir, f))
+    tmp_path = cache_path + '.tmp.npy'
+    np.save(tmp_path, kpts_3d)
+    os.rename(tmp_path, cache_path)
+    print "Cached lean corrected keypoints to {}".format(cache_path)
+
+    _human_store['kpts_3d'] = kpts_3d
+    _human_store['lean_corrected'] = True
+
+def correct_lean_rows(_human_store, rows, cache_dir=LEAN_CACHE_DIR):
+    '''
+    Lean corrected kpts_3d of the given rows of a columnar store, for when only
+    some rows are needed (eg. a limited debug split). If the whole store has
+    been corrected and cached before, the rows are read from the cache.
+    Otherwise only these rows are corrected, and no other row is touched.
+    '''
+    if _human_store.get('lean_corrected'):
+        return np.asarray(_human_store['kpts_3d'][rows])
+    if cache_dir is not None:
+        cache_path = lean_cache_path(_human_store['store_dir'], cache_dir)
+        if os.path.isfile(cache_path):
+            return np.asarray(np.load(cache_path, mmap_mode='r')[rows])
+    return correct_lean_kpts(_human_store['kpts_3d'][rows],
+                             _human_store['c_id'][rows], _human_store['s_id'][rows])
+
+def lean_cache_prefix(store_dir):
+    '''Prefix of the cache entries of one store, so that stores sharing a cache_dir keep their own.'''
+    store_hash = hashlib.sha1(os.path.abspath(store_dir).encode('utf8')).hexdigest()[:12]
+    return 'kpts_3d_{}_'.format(store_hash)
+
+def lean_cache_path(store_dir, cache_dir=LEAN_CACHE_DIR):
+    return os.path.join(cache_dir, lean_cache_prefix(store_dir) + lean_cache_key(store_dir) + '.npy')
+
+def lean_cache_key(store_dir):
+    '''
+    Key of everything the lean corrected keypoints depend on. It is cheap to
+    compute, so that a cache hit costs no more than a few stat calls: the
+    store's meta.json (which records the annotations it was converted from),
+    the size and mtime of the store columns the correction reads and of the
+    camera .mat files, and the correction parameters.
+    '''
+    sha = hashlib.sha1()
+    with open(os.path.join(store_dir, 'meta.json'), 'rb') as f:
+        sha.update(f.read())
+    input_paths = [os.path.join(store_dir, name + '.npy')
+                   for name in ['kpts_3d', 'c_id', 's_id']]
+    input_paths += [ROTATION_MATRICES_PATH, CAMERA_NAMES_PATH]
+    for path in input_paths:
+        st = os.stat(path)
+        sha.update('{}:{}:{}'.format(os.path.basename(path), st.st_size, st.st_mtime).encode('ascii'))
+    params = {'version': LEAN_CORRECTION_VERSION,
+              'subject_ids': LEAN_SUBJECT_IDS,
+              'zeroed_angles': LEAN_ZEROED_ANGLES}
+    sha.update(json.dumps(params, sort_keys=True).encode('ascii'))
+    return sha.hexdigest()
 
 # Checks if a matrix is a valid rotation matrix.
 def isRotationMatrix(R):
@@ -1,12 +1,14 @@
 ## imports
-from os import listdir
+from os import listdir, rename
 import json, sys
 import numpy as np
-import random
-random.seed(17)
 #import skvideo.io
 import imageio
 from  scipy.misc import imresize
+from multiprocessing import Pool
+from human36m_store import image_shard_name, image_shard_ref
+from human36m_ids import encode_id, action_id, ACTION_TABLE_VERSION
+from annotation_shards import ShardWriter, load_manifest
 
 from spacepy import pycdf
 # import cdflib
@@ -19,6 +21,7 @@ import matplotlib.patches as patches
 DATASET_DIR      = '../datasets/human36m_original'
 ANNOTATIONS_DIR  = '../datasets/human36m_annotations'
 IMAGES_DIR       = '../datasets/human36m_images'
+SHARDS_DIR       = ANNOTATIONS_DIR + '/human36m_train_shards'
 
 ## dataset constants
 FEATURE_TYPES = ['D2_Positions','D3_Positions_mono', 'D3_Positions_mono_universal']
@@ -31,6 +34,9 @@ SKIP_ACTIONS  = ['_ALL', 'WalkTogether','Posing','Photo','SittingDown','Directio
 #CAMERA_IDS    = [54138969, 55011271, 58860488, 60457274]
 SUBJECT_IDS   = [1,5,6,7,8,9,11]
 SUBJECT_IDS   = [1]
+## pipeline settings
+NUM_WORKERS   = 4      # processes decoding (subject, video) work units
+SAVE_IMAGES   = False  # write the cropped frames to image shards in IMAGES_DIR
 HUMAN_36M_KEYPOINTS = \
   ['mid_hip',
    'right_hip', 'right_knee', 'right_ankle', 'right_foot_base', 'right_foot_tip',
@@ -84,6 +90,7 @@ actions = {}
 actions['id']       = -1
 actions['name']     = ''
 actions['version']  = ''
+actions['table']    = -1
 
 pose = {}
 pose['keypoints']      = INTEREST_KEYPOINTS
@@ -91,194 +98,236 @@ pose['skeleton']       = [map(INTEREST_KEYPOINTS.index,t) for t in SKELETON]
 pose['original_index'] = [HUMAN_36M_KEYPOINTS.index(k) for k in INTEREST_KEYPOINTS]
 human36m['pose'] = [pose]
 
-PADDED   = []
-USED_IDS = set()
 
-for subject_id in SUBJECT_IDS:
-    VIDEOS_DIR   = '%s/S%d/MyVideos'%(DATASET_DIR, subject_id)
+################################################################################
+## ingestion pipeline
+# Every (subject, video) pair is an independent work unit. Work units are
+# listed and sorted up front, fanned out over a process pool and their results
+# are merged back in work unit order, so the output does not depend on which
+# worker finishes first. Ids are computed by the workers from the source of
+# each frame, see human36m_ids.py. Every work unit is written to its own
+# annotation shard as soon as it is merged, see annotation_shards.py, so memory
+# stays flat and an interrupted run resumes from the last completed shard.
+
+def parse_video_filename(video_filename):
+    video_info  = video_filename.split('.')
+    action_info = video_info[0].split(' ')
+
+    camera_id   = int(video_info[1])
+    action_name = action_info[0]
+    action_version = int(action_info[1]) if len(action_info) > 1 else 0
+    return video_info, camera_id, action_name, action_version
+
+def list_work_units():
+    """returns the sorted (subject_id, video_filename) pairs to process"""
+    work_units = []
+    for subject_id in SUBJECT_IDS:
+        VIDEOS_DIR = '%s/S%d/MyVideos'%(DATASET_DIR, subject_id)
+        for video_filename in sorted(listdir(VIDEOS_DIR)):
+            _, _, action_name, _ = parse_video_filename(video_filename)
+            if action_name in SKIP_ACTIONS: continue
+            work_units.append((subject_id, video_filename))
+    return work_units
+
+def build_actions(work_units):
+    """action list of every (name, version) in the work units, with its fixed
+    id from the action table of human36m_ids.py"""
+    actions = []
+    seen = set()
+    for _, video_filename in work_units:
+        _, _, action_name, action_version = parse_video_filename(video_filename)
+        if (action_name, action_version) in seen: continue
+        seen.add((action_name, action_version))
+        action = {}
+        action['id']       = action_id(action_name, action_version)
+        action['name']     = action_name
+        action['version']  = action_version
+        action['table']    = ACTION_TABLE_VERSION
+        actions.append(action)
+    return actions
+
+def read_features(subject_id, video_info):
+    """reads the pose of every feature type, opening each cdf file once"""
     FEATURES_DIR = '%s/S%d/MyPoseFeatures'%(DATASET_DIR, subject_id)
-
-    VIDEOS = listdir(VIDEOS_DIR)
-    for video_filename in VIDEOS:
-        video_info  = video_filename.split('.')
-        action_info = video_info[0].split(' ')
-
-        camera_id   = int(video_info[1])
-        action_name = action_info[0]
-        action_version = int(action_info[1]) if len(action_info) > 1 else 0
-
-        if action_name in SKIP_ACTIONS: continue
-        print("S%d"%subject_id, action_name, action_version, camera_id)
-
-        # insert the action in the actions list if it has never been encountered
-        new_action = [a for a in human36m['actions'] if \
-                        a['name'] == action_name and \
-                        a['version'] == action_version]
-        if len(new_action)==0:
-            action_id = len(human36m['actions'])
-            action = {}
-            action['id']       = action_id
-            action['name']     = action_name
-            action['version']  = action_version
-            human36m['actions'].append(action)
-        else:
-            action_id = new_action[0]['id']
-
-        # extract the image frames
-        frames = imageio.get_reader(VIDEOS_DIR + '/' + video_filename,  'ffmpeg')
-        print("Frames %d"%(len(frames)))
-
-        features = []
-        shapes   = []
-        # extract the features
-        for feature_type in FEATURE_TYPES:
-            print(FEATURES_DIR + '/' + feature_type + '/' + '.'.join(video_info[:-1]) + '.cdf')
-            # cdf = cdflib.CDF(FEATURES_DIR + '/' + feature_type + '/' + '.'.join(video_info[:-1]) + '.cdf')
-            cdf = pycdf.CDF(FEATURES_DIR + '/' + feature_type + '/' + '.'.join(video_info[:-1]) + '.cdf')
-            # posedata = cdf.varget('Pose')[0,:,:][...]
-            # features.append(np.reshape(posedata.T, posedata.shape))
-            # features.append(cdf.varget('Pose')[0,:,:][...])
-            features.append(cdf['Pose'][0,:,:][...])
-
-            # shape   = cdf.varget('Pose')[0,:,:][...].shape
-            shape   = cdf['Pose'][0,:,:][...].shape
-            shapes.append(shape[0])
-            print(feature_type, shape)
-
-        assert(shapes.count(shapes[0]) == len(shapes))
-        print("=================================")
-
-#         frame_num = 0
-#         # access features and image one frame at the time
-#         # NOTE: number of frames and number of features might be different!
-#         # assumption is that they are alligned at beginning and the final
-#         # frames get discarded.
-#         while frame_num < shapes[0]:
-#             frame   = frames.get_data(frame_num)
-
-#             # 2d pose associated with that frame
-#             pose_2d = features[FEATURE_TYPES.index('D2_Positions')][frame_num,:]
-#             pose_2d_x = pose_2d[0::2]
-#             pose_2d_y = pose_2d[1::2]
-
-#             w  = max(pose_2d_x) - min(pose_2d_x)
-#             h  = max(pose_2d_y) - min(pose_2d_y)
-#             cx = int(min(pose_2d_x) + w/2.)
-#             cy = int(min(pose_2d_y) + h/2.)
-
-#             bbox = [cx - (w*1.2)/2., cy - (h*1.2)/2., w*1.2, h*1.2] # 20% enlarged
-#             slack = int(bbox[2]/2.) if w > h else int(bbox[3]/2.)
-#             x_start = cx - slack
-#             x_end   = cx + slack
-#             y_start = cy - slack
-#             y_end   = cy + slack
-
-#             print(pose_2d_x)
-#             print(pose_2d_y)
-#             print(cx, cy, w, h)
-#             print(bbox)
-#             print(slack)
-#             print(x_start, x_end)
-#             print(y_start, y_end)
-
-#             pad_left   = abs(x_start) if x_start < 0 else 0
-#             #pad_right  = x_end - 2 * slack if x_end > 2 * slack else 0
-#             pad_top    = abs(y_start) if y_start < 0 else 0
-#             # pad_bottom = y_end - 2 * slack if y_end > 2 * slack else 0
-#             padded_frame = np.pad(frame,((0,0),(pad_left,0),(0,0)),'edge')
-#             # try:
-#             crop = imresize(padded_frame[y_start+pad_top:y_end+pad_top, x_start+pad_left:x_end+pad_left, :],(IMAGES_WIDTH, IMAGES_WIDTH))
-#             # except:
-#             #     print frame.shape
-#             #     print cx, x_start, x_end, 2*slack
-#             #     print cy, y_start, y_end, 2*slack
-#             #     print pad_top, pad_bottom, pad_left, pad_top
-#             #     assert(False)
-
-#             resize_ratio = [IMAGES_WIDTH / (2. * slack), IMAGES_HEIGHT / (2. * slack)]
-#             keypoints_2d = []
-#             for i in human36m['pose'][0]['original_index']:
-#                 pose_2d_x_i = (pose_2d_x[i] - x_start) * resize_ratio[0]
-#                 pose_2d_y_i = (pose_2d_y[i] - y_start) * resize_ratio[1]
-#                 keypoints_2d.extend([pose_2d_x_i,pose_2d_y_i])
-
-#             # fig = plt.figure()
-#             # ax = plt.subplot(121)
-#             # ax.imshow(frame)
-#             # ax.scatter(pose_2d_x,pose_2d_y,c='g',s=50)
-#             # ax.scatter(cx,cy,c='r',s=50)
-#             # rect  = patches.Rectangle((bbox[0],bbox[1]),bbox[2],bbox[3],linewidth=2,edgecolor='b',facecolor='none')
-#             # ax.add_patch(rect)
-#             # rect1  = patches.Rectangle((x_start,y_start),2*slack,2*slack,linewidth=2,edgecolor='y',facecolor='none')
-#             # ax.add_patch(rect1)
-#             # ax = plt.subplot(122)
-#             # ax.imshow(crop)
-#             # ax.scatter(keypoints_2d[0::2],keypoints_2d[1::2],c='g',s=50)
-#             # plt.show()
-
-#             # 3d pose associated with that frame
-#             pose_3d = features[FEATURE_TYPES.index('D3_Positions_mono')][frame_num,:]
-#             pose_3d_x = pose_3d[0::3]
-#             pose_3d_y = pose_3d[1::3]
-#             pose_3d_z = pose_3d[2::3]
-#             keypoints_3d = []
-#             for i in human36m['pose'][0]['original_index']:
-#                 keypoints_3d.extend([pose_3d_x[i],pose_3d_y[i],pose_3d_z[i]])
-#             # fig = plt.figure()
-#             # ax = fig.add_subplot(111, projection='3d')
-#             # ax.scatter(keypoints_3d[0::3],keypoints_3d[1::3],keypoints_3d[2::3])
-#             # plt.show()
-
-#             rand_id       = random.randint(0,999999)
-#             while rand_id in USED_IDS:
-#                 rand_id       = random.randint(0,999999)
-#             USED_IDS.add(rand_id)
-
-#             annotation_id = rand_id
-#             image_id      = rand_id
-
-#             annotation = {}
-#             annotation['id']   = annotation_id
-#             annotation['s_id'] = subject_id
-#             annotation['a_id'] = action_id
-#             annotation['i_id'] = image_id
-#             annotation['kpts_2d'] = map(int,keypoints_2d)
-#             annotation['kpts_3d'] = map(int,keypoints_3d)
-#             human36m['annotations'].append(annotation)
-
-#             image = {}
-#             image['id']       = image_id
-#             image['c_id']     = camera_id
-#             image['s_id']     = subject_id
-#             image['filename'] = 'human36m_train_%010d.jpg'%(image_id)
-#             image['width']    = IMAGES_WIDTH
-#             image['height']   = IMAGES_HEIGHT
-#             image['video']    = video_filename
-#             image['frame']    = frame_num
-#             human36m['images'].append(image)
-
-# #             # save the image
-# #             image_filename = '%s/human36m_train_%010d.jpg'%(IMAGES_DIR,image_id)
-# #             imageio.imwrite(image_filename, crop)
-
-#             if pad_left + pad_top != 0:
-#                 PADDED.append(image_id)
-#             frame_num += SKIP_FRAMES
-
-#         # close the frame reader before processing next action
-#         frames.close()
-
-# # with open('%s/human36m_train.json'%(ANNOTATIONS_DIR),'wb') as fp:
-# #     json.dump(human36m,fp)
-
-# # print human36m.keys()
-# # print len(human36m['annotations'])
-# # print len(human36m['images'])
-
-# # print human36m['pose']
-# # print human36m['actions']
-
-# # with open('./padded.json','wb') as fp:
-# #     json.dump(PADDED, fp)
-
-# # print len(PADDED), PADDED
+    features = []
+    for feature_type in FEATURE_TYPES:
+        cdf = pycdf.CDF(FEATURES_DIR + '/' + feature_type + '/' + '.'.join(video_info[:-1]) + '.cdf')
+        features.append(cdf['Pose'][0,:,:][...])
+        cdf.close()
+
+    shapes = [f.shape[0] for f in features]
+    assert(shapes.count(shapes[0]) == len(shapes))
+    return features, shapes[0]
+
+def crop_boxes(pose_2d):
+    """
+    square crop boxes for a (n, 2*32) array of 2d poses, computed for all the
+    frames at once. the box is centered on the pose and 20% larger than its
+    longest side. returns the int arrays x_start, y_start and slack (half side).
+    """
+    pose_2d_x = pose_2d[:, 0::2]
+    pose_2d_y = pose_2d[:, 1::2]
+
+    x_min = pose_2d_x.min(axis=1)
+    y_min = pose_2d_y.min(axis=1)
+    w  = pose_2d_x.max(axis=1) - x_min
+    h  = pose_2d_y.max(axis=1) - y_min
+    cx = (x_min + w/2.).astype(int)
+    cy = (y_min + h/2.).astype(int)
+
+    slack = np.where(w > h, (w*1.2)/2., (h*1.2)/2.).astype(int) # 20% enlarged
+    return cx - slack, cy - slack, slack
+
+def crop_and_resize(frame, x_start, y_start, slack, out):
+    """
+    crops the 2*slack square starting at (x_start, y_start) and resizes it into
+    the preallocated out. pixels outside of the frame repeat the edge pixels.
+    """
+    rows = np.clip(np.arange(y_start, y_start + 2*slack), 0, frame.shape[0] - 1)
+    cols = np.clip(np.arange(x_start, x_start + 2*slack), 0, frame.shape[1] - 1)
+    out[...] = imresize(frame[rows[:, None], cols], out.shape[:2])
+
+def extract_crops(video_path, frame_nums, x_start, y_start, slack):
+    """
+    decodes the video once, sequentially, and crops the frames in frame_nums
+    (sorted) into a preallocated (n, IMAGES_HEIGHT, IMAGES_WIDTH, 3) uint8 batch.
+    """
+    crops = np.zeros((len(frame_nums), IMAGES_HEIGHT, IMAGES_WIDTH, 3), dtype=np.uint8)
+    frames = imageio.get_reader(video_path, 'ffmpeg')
+    j = 0
+    for frame_num, frame in enumerate(frames):
+        if j == len(frame_nums): break
+        if frame_num != frame_nums[j]: continue
+        crop_and_resize(frame, x_start[j], y_start[j], slack[j], crops[j])
+        j += 1
+    # close the frame reader before processing next action
+    frames.close()
+    if j < len(frame_nums):
+        print("%s: video ended after %d of %d frames"%(video_path, j, len(frame_nums)))
+    return crops
+
+def save_image_shard(subject_id, video_filename, frame_nums, crops):
+    """writes the crops of one video as a batched image shard"""
+    shard = '%s/%s'%(IMAGES_DIR, image_shard_name(subject_id, video_filename))
+    np.save(shard + '.frames.tmp.npy', frame_nums)
+    np.save(shard + '.tmp.npy', crops)
+    rename(shard + '.frames.tmp.npy', shard + '.frames.npy')
+    rename(shard + '.tmp.npy', shard + '.npy')
+
+def process_video(work_unit):
+    """
+    worker: extracts the annotations of one (subject, video) work unit.
+    ids are derived from (subject, action, camera, frame), see human36m_ids.py,
+    so workers never hand out colliding ids.
+    """
+    subject_id, video_filename, action_id = work_unit
+    VIDEOS_DIR = '%s/S%d/MyVideos'%(DATASET_DIR, subject_id)
+    video_info, camera_id, action_name, action_version = parse_video_filename(video_filename)
+
+    # extract the features
+    features, num_features = read_features(subject_id, video_info)
+    original_index = human36m['pose'][0]['original_index']
+
+    # NOTE: number of frames and number of features might be different!
+    # assumption is that they are alligned at beginning and the final
+    # frames get discarded.
+    frame_nums = np.arange(0, num_features, SKIP_FRAMES)
+    n = len(frame_nums)
+    print("S%d %s %d %d: %d frames used out of %d"%(subject_id, action_name,
+          action_version, camera_id, n, num_features))
+
+    # 2d and 3d poses associated with the used frames
+    pose_2d = features[FEATURE_TYPES.index('D2_Positions')][frame_nums,:]
+    pose_3d = features[FEATURE_TYPES.index('D3_Positions_mono')][frame_nums,:]
+
+    x_start, y_start, slack = crop_boxes(pose_2d)
+
+    if SAVE_IMAGES:
+        crops = extract_crops(VIDEOS_DIR + '/' + video_filename, frame_nums,
+                              x_start, y_start, slack)
+        save_image_shard(subject_id, video_filename, frame_nums, crops)
+
+    # keypoints in the coordinates of the resized crop
+    keypoints_2d = np.reshape(pose_2d, (n, -1, 2))[:, original_index, :]
+    keypoints_2d[:, :, 0] = (keypoints_2d[:, :, 0] - x_start[:, None]) * (IMAGES_WIDTH / (2. * slack))[:, None]
+    keypoints_2d[:, :, 1] = (keypoints_2d[:, :, 1] - y_start[:, None]) * (IMAGES_HEIGHT / (2. * slack))[:, None]
+    keypoints_2d = np.reshape(keypoints_2d, (n, -1)).astype(int).tolist()
+
+    keypoints_3d = np.reshape(pose_3d, (n, -1, 3))[:, original_index, :]
+    keypoints_3d = np.reshape(keypoints_3d, (n, -1)).astype(int).tolist()
+
+    padded = (x_start < 0) | (y_start < 0)
+
+    records = []
+    for j in range(n):
+        annotation_id = encode_id(subject_id, action_id, camera_id, int(frame_nums[j]))
+        image_id      = annotation_id
+
+        annotation = {}
+        annotation['id']   = annotation_id
+        annotation['s_id'] = subject_id
+        annotation['a_id'] = action_id
+        annotation['i_id'] = image_id
+        annotation['kpts_2d'] = keypoints_2d[j]
+        annotation['kpts_3d'] = keypoints_3d[j]
+
+        image = {}
+        image['id']       = image_id
+        image['c_id']     = camera_id
+        image['s_id']     = subject_id
+        # the crop is in the image shard of the video, see save_image_shard
+        image['filename'] = image_shard_ref(subject_id, video_filename, int(frame_nums[j]))
+        image['width']    = IMAGES_WIDTH
+        image['height']   = IMAGES_HEIGHT
+        image['video']    = video_filename
+        image['frame']    = int(frame_nums[j])
+
+        records.append((annotation, image, bool(padded[j])))
+    return records
+
+def merge_records(writer, subject_id, video_filename, records):
+    """writes the records of one work unit to its annotation shard"""
+    annotations = [annotation for annotation, _, _ in records]
+    images      = [image for _, image, _ in records]
+    padded      = [image['id'] for _, image, was_padded in records if was_padded]
+    writer.write_shard(image_shard_name(subject_id, video_filename),
+                       annotations, images, padded=padded)
+
+def run_pipeline(num_workers=NUM_WORKERS):
+    work_units = list_work_units()
+    human36m['actions'] = build_actions(work_units)
+    action_ids = {(a['name'], a['version']): a['id'] for a in human36m['actions']}
+
+    # resume from the shards written by a previous run, if any
+    writer = ShardWriter(SHARDS_DIR, human36m['pose'], human36m['actions'])
+
+    jobs = []
+    for subject_id, video_filename in work_units:
+        if writer.is_complete(image_shard_name(subject_id, video_filename)): continue
+        _, _, action_name, action_version = parse_video_filename(video_filename)
+        jobs.append((subject_id, video_filename, action_ids[(action_name, action_version)]))
+    print("%d videos to process on %d workers, %d already done"%(
+        len(jobs), num_workers, len(work_units) - len(jobs)))
+
+    # imap yields the results in job order, which keeps the merge deterministic
+    # while still merging each work unit as soon as it and its predecessors
+    # are done.
+    pool = Pool(num_workers)
+    try:
+        for j, records in enumerate(pool.imap(process_video, jobs)):
+            subject_id, video_filename, _ = jobs[j]
+            merge_records(writer, subject_id, video_filename, records)
+    finally:
+        pool.close()
+        pool.join()
+
+    shards = load_manifest(SHARDS_DIR)['shards']
+    padded = [image_id for shard in shards for image_id in shard['padded']]
+    with open('./padded.json','wb') as fp:
+        json.dump(padded, fp)
+
+    print("%d annotations in %d shards"%(sum(shard['num_annotations'] for shard in shards), len(shards)))
+    print(human36m['actions'])
+
+if __name__ == "__main__":
+    run_pipeline()
@@ -0,0 +1,64 @@
+import itertools
+
+import numpy as np
+import pytest
+
+from human36m_ids import (encode_id, decode_id, decode_ids, id_source, action_id, action_source,
+                          ACTION_NAMES, ACTION_VERSIONS, CAMERA_IDS)
+
+SUBJECT_IDS = [1, 5, 6, 7, 8, 9, 11]
+
+
+def all_sources():
+    for subject_id, a_id, camera_id, frame in itertools.product(
+            SUBJECT_IDS, range(len(ACTION_NAMES) * ACTION_VERSIONS), CAMERA_IDS, [0, 1, 120, 99999]):
+        yield subject_id, a_id, camera_id, frame
+
+
+def test_decode_id_round_trip():
+    for source in all_sources():
+        assert decode_id(encode_id(*source)) == source
+
+
+def test_decode_ids_matches_decode_id():
+    sources = list(all_sources())
+    ids = np.array([encode_id(*source) for source in sources])
+    decoded = decode_ids(ids)
+    assert list(zip(*[column.tolist() for column in decoded])) == sources
+
+
+def test_ids_are_unique_and_fit_int32():
+    ids = [encode_id(*source) for source in all_sources()]
+    assert len(set(ids)) == len(ids)
+    assert max(ids) < 2 ** 31
+
+
+def test_documented_example():
+    assert encode_id(9, 3, 58860488, 120) == 903200120
+
+
+def test_action_id_round_trip():
+    for name, version in itertools.product(ACTION_NAMES, range(ACTION_VERSIONS)):
+        assert action_source(action_id(name, version)) == (name, version)
+
+
+def test_action_id_does_not_depend_on_other_actions():
+    # Ids of the first version 1 table; they must never change
+    assert action_id('Directions', 0) == 0
+    assert action_id('Eating', 2) == 12
+    assert action_id('WalkTogether', 1) == 81
+
+
+def test_id_source():
+    id = encode_id(11, action_id('Phoning', 3), 60457274, 42)
+    assert id_source(id) == {'subject_id': 11, 'action': 'Phoning', 'version': 3,
+                             'camera_id': 60457274, 'frame': 42}
+
+
+def test_out_of_range_fields_are_rejected():
+    with pytest.raises(AssertionError):
+        encode_id(1, 0, CAMERA_IDS[0], 100000)
+    with pytest.raises(AssertionError):
+        action_id('Dancing', 0)
+    with pytest.raises(AssertionError):
+        action_id('Walking', ACTION_VERSIONS)
@@ -0,0 +1,20 @@
+import numpy as np
+
+from human36m_store import image_shard_name, image_shard_ref, load_shard_image, load_image_ref
+
+
+def write_shard(images_dir, s_id, video, frames):
+    shard = images_dir.join(image_shard_name(s_id, video))
+    crops = np.arange(len(frames) * 4 * 4 * 3, dtype=np.uint8).reshape(len(frames), 4, 4, 3)
+    np.save(str(shard) + '.frames.npy', np.array(frames))
+    np.save(str(shard) + '.npy', crops)
+    return crops
+
+
+def test_image_shard_ref_loads_the_same_crop(tmpdir):
+    video = 'Directions 1.54138969.mp4'
+    crops = write_shard(tmpdir, 1, video, [0, 20, 40])
+
+    ref = image_shard_ref(1, video, 20)
+    np.testing.assert_array_equal(load_image_ref(ref, str(tmpdir)), crops[1])
+    np.testing.assert_array_equal(load_shard_image(1, video, 20, str(tmpdir)), crops[1])
@@ -0,0 +1,94 @@
+import sys
+
+import numpy as np
+import pytest
+
+if sys.version_info[0] >= 3:
+    pytest.skip("postprocess_original_utils is Python 2 code", allow_module_level=True)
+
+import postprocess_original_utils as pou
+
+CAMERA_NAMES = [54138969, 55011271, 58860488, 60457274]
+NUM_KPTS = 14
+
+
+def random_rotation(rng):
+    q, _ = np.linalg.qr(rng.randn(3, 3))
+    return q * np.sign(np.linalg.det(q))
+
+
+@pytest.fixture
+def cameras(monkeypatch):
+    '''Synthetic camera rotations of every (camera, subject) in the layout of the .mat files'''
+    rng = np.random.RandomState(0)
+    rotations = np.array([[random_rotation(rng) for _ in pou.LEAN_SUBJECT_IDS]
+                          for _ in CAMERA_NAMES])
+    monkeypatch.setattr(pou, 'load_rotation_matrices', lambda: rotations)
+    monkeypatch.setattr(pou, 'load_camera_names', lambda: np.array(CAMERA_NAMES))
+    return rotations
+
+
+def synthetic_rows(n, seed=1):
+    rng = np.random.RandomState(seed)
+    kpts_3d = rng.randn(n, 3 * NUM_KPTS) * 500
+    c_ids = rng.choice(CAMERA_NAMES, n)
+    s_ids = rng.choice(pou.LEAN_SUBJECT_IDS, n)
+    return kpts_3d, c_ids, s_ids
+
+
+def original_correct_lean(kpts_3d, c_ids, s_ids):
+    '''The per-image loop correct_lean ran before it was vectorized'''
+    rotation_matrices = pou.load_rotation_matrices()
+    camera_names = [int(n) for n in pou.load_camera_names()]
+
+    corrected = []
+    for kpts, c_id, s_id in zip(kpts_3d, c_ids, s_ids):
+        R = rotation_matrices[camera_names.index(c_id)][pou.LEAN_SUBJECT_IDS.index(s_id)].T
+        kpts = np.reshape(kpts, (len(kpts) // 3, 3))
+
+        # Unapply the rotation matrix
+        kpts = np.dot(kpts, R.T)
+
+        # Cancel all rotations except those about the z axis
+        theta = pou.rotationMatrixToEulerAngles(R)
+        theta[0] = 0
+        theta[1] = 0
+        kpts = np.dot(kpts, pou.eulerAnglesToRotationMatrix(theta))
+        corrected.append(kpts.flatten())
+    return np.array(corrected)
+
+
+def test_correct_lean_kpts_matches_original_loop(cameras):
+    kpts_3d, c_ids, s_ids = synthetic_rows(200)
+    # Every subject and camera is present
+    assert len(set(zip(c_ids, s_ids))) > len(CAMERA_NAMES) * 2
+
+    np.testing.assert_allclose(pou.correct_lean_kpts(kpts_3d, c_ids, s_ids),
+                               original_correct_lean(kpts_3d, c_ids, s_ids), rtol=1e-10, atol=1e-8)
+
+
+def test_correct_lean_kpts_leaves_input_untouched(cameras):
+    kpts_3d, c_ids, s_ids = synthetic_rows(20)
+    before = kpts_3d.copy()
+    pou.correct_lean_kpts(kpts_3d, c_ids, s_ids)
+    np.testing.assert_array_equal(kpts_3d, before)
+
+
+def test_correct_lean_store_matches_original_loop(cameras):
+    kpts_3d, c_ids, s_ids = synthetic_rows(50)
+    store = {'kpts_3d': kpts_3d.astype(np.float32), 'c_id': c_ids, 's_id': s_ids}
+    pou.correct_lean_store(store, cache_dir=None)
+
+    assert store['lean_corrected']
+    np.testing.assert_allclose(store['kpts_3d'], original_correct_lean(kpts_3d.astype(np.float32), c_ids, s_ids),
+                               rtol=1e-6, atol=1e-6)
+
+
+def test_correct_lean_json_matches_original_loop(cameras):
+    kpts_3d, c_ids, s_ids = synthetic_rows(30)
+    dataset = {'annotations': [{'kpts_3d': k.tolist()} for k in kpts_3d],
+               'images': [{'c_id': int(c), 's_id': int(s)} for c, s in zip(c_ids, s_ids)]}
+    pou.correct_lean(dataset)
+
+    np.testing.assert_allclose(np.array([a['kpts_3d'] for a in dataset['annotations']]),
+                               original_correct_lean(kpts_3d, c_ids, s_ids), rtol=1e-10, atol=1e-8)
@@ -76,15 +76,15 @@ actions = ['Directions']
 # i = idx
 
 # plot_image(data[i]['annotations_truth']['kpts_2d'],
-#            data[i]['images_truth']['filename'], label="relative_depth",
+#            data[i]['images_truth'], label="relative_depth",
 #            kpts_relative_depth=data[i]['annotations_truth']['kpts_relative_depth'])
 # plt.title("Ground Truth Ordering")
 # plot_image(data[i]['annotations_truth']['kpts_2d'],
-#            data[i]['images_truth']['filename'], label="relative_depth",
+#            data[i]['images_truth'], label="relative_depth",
 #            kpts_relative_depth=data[i]['trials'][0]['kpts_relative_depth'])
 # plt.title("Turker Guess Ordering")
 # plot_image(data[i]['annotations_truth']['kpts_2d'],
-#            data[i]['images_truth']['filename'], label="absolute_depth",
+#            data[i]['images_truth'], label="absolute_depth",
 #            kpts_3d=data[i]['annotations_truth']['kpts_3d'])
 # plt.title("Ground Truth Depth")
 
@@ -132,15 +132,15 @@ print idx
 i = idx
 
 plot_image(data[i]['annotations_truth']['kpts_2d'],
-           data[i]['images_truth']['filename'], label="relative_depth",
+           data[i]['images_truth'], label="relative_depth",
            kpts_relative_depth=data[i]['annotations_truth']['kpts_relative_depth'])
 plt.title("Ground Truth Ordering")
 plot_image(data[i]['annotations_truth']['kpts_2d'],
-           data[i]['images_truth']['filename'], label="relative_depth",
+           data[i]['images_truth'], label="relative_depth",
            kpts_relative_depth=data[i]['trials'][0]['kpts_relative_depth'])
 plt.title("Turker Guess Ordering")
 plot_image(data[i]['annotations_truth']['kpts_2d'],
-           data[i]['images_truth']['filename'], label="absolute_depth",
+           data[i]['images_truth'], label="absolute_depth",
            kpts_3d=data[i]['annotations_truth']['kpts_3d'])
 plt.title("Ground Truth Depth")
 
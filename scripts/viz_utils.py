@@ -3,30 +3,38 @@ import sys
 import numpy as np
 
 import matplotlib.pyplot as plt
-import matplotlib.image as mpimg
 from matplotlib.patches import Circle
 
 from constants import (HUMAN_IMAGES_DIR, I_BASELINE, J_BASELINE, LR_BASELINE,
                        I_ORIGINAL, J_ORIGINAL, LR_ORIGINAL, NUM_KPTS_ORIGINAL,
                        NUM_KPTS_ORIGINAL_NONECK, I_ORIGINAL_NONECK,
                        J_ORIGINAL_NONECK, LR_ORIGINAL_NONECK)
+from human36m_store import image_shard_name, load_shard_image
 
 sys.path.insert(0, '/Users/Robert/Documents/Caltech/CS81_Depth_Research/models/3d-pose-baseline/src')
 from viz import show3Dpose
-from scipy.misc import imread
 
 
 ################################################################################
 # VISUALIZE HITS
 ################################################################################
 
+def load_image(image):
+    '''
+    Crop of an image dict (eg. the images_truth of a HIT), read from the image
+    shard of its video. None if the shard has not been downloaded.
+    '''
+    shard_path = os.path.join(HUMAN_IMAGES_DIR, image_shard_name(image['s_id'], image['video']) + '.npy')
+    if not os.path.isfile(shard_path):
+        print "Could not find {}. Please download from the server.".format(shard_path)
+        return None
+    return load_shard_image(image['s_id'], image['video'], image['frame'])
+
 def visualize_HIT(hit, mode='groundtruth'):
-    image_filepath = os.path.join(HUMAN_IMAGES_DIR, hit['images_truth']['filename'])
-    if not os.path.isfile(image_filepath):
-        print "Could not find {}. Please download from the server.".format(image_filepath)
+    img = load_image(hit['images_truth'])
+    if img is None:
         return
 
-    img = mpimg.imread(image_filepath)
     fig, ax = plt.subplots(1)
     imgplot = ax.imshow(img)
 
@@ -194,9 +202,10 @@ def plot_2d_stickcoords(pts, plane='z', dataset='original'):
         ax.set_ylabel('Y Label')
 
 
-def plot_image(kpts_2d, image_filename, label=None, **kwargs):
+def plot_image(kpts_2d, image, label=None, **kwargs):
     '''
-    Display the image with the keypoints marked
+    Display the image with the keypoints marked. image is an image dict, eg.
+    the images_truth of a HIT, whose crop is read with load_image.
 
     label: image is annotated with different labels depending on value of label
         - None: No labels printed
@@ -210,8 +219,12 @@ def plot_image(kpts_2d, image_filename, label=None, **kwargs):
         print ("kpts_3d must be passed to plot_image.")
         return
 
+    img = load_image(image)
+    if img is None:
+        return
+
     plt.figure()
-    plt.imshow(imread(HUMAN_IMAGES_DIR + '/{}'.format(image_filename)))
+    plt.imshow(img)
     xs = kpts_2d[0::2]
     ys = kpts_2d[1::2]
     plt.scatter(xs, ys)